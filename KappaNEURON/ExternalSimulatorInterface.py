@@ -1,16 +1,12 @@
 import os
 import re
-import SpatialKappa
-from py4j.protocol import Py4JJavaError
 from neuron.rxd.generalizedReaction import GeneralizedReaction
 from neuron import h, rxd
 from neuron import nonvint_block_supervisor as nbs
 from neuron.units import mV, ms, uM
-import matplotlib.pyplot as plt
 
-h.load_file("stdrun.hoc")
-
-gateway = SpatialKappa.SpatialKappa(redirect_stdout=None)
+## Java is only started when the first sim is created
+gateway = None
 
 def report(mess):
     global verbose
@@ -56,11 +52,13 @@ class ExternalSimulatorInterface():
         #       f" in {[r.name for r in self._node.region]} has been initialized.")
         global gateway
         # global verbose
+        import SpatialKappa
+        from py4j.protocol import Py4JJavaError
 
         ## Start Java and load the SpatialKappa class, if not already
         ## loaded
-        # if not gateway:
-        #     gateway = SpatialKappa.SpatialKappa(redirect_stdout=self._sk_redirect_stdout)
+        if not gateway:
+            gateway = SpatialKappa.SpatialKappa(redirect_stdout=self._sk_redirect_stdout)
 
         # self._kappa_sims = []  # Will this destroy things properly?
         # for index in self._indices_dict[self._involved_species[0]()]:
@@ -97,44 +95,49 @@ class ExternalSimulatorInterface():
         # track of the callbacks which implicitly keeps a reference to this object
         nbs.unregister(self._callbacks)
 
-dend = h.Section(name="dend")
-dend.nseg = 3
-er = rxd.Region([dend], name="er", geometry=rxd.FractionalVolume(0.17))
-cyt = rxd.Region([dend], name="cyt")
-ca = rxd.Species([cyt, er], name="ca", charge=2, initial=0 * uM)
+if __name__ == '__main__':
+    ## Demonstration, only run when this file is run as a script
+    import matplotlib.pyplot as plt
+    h.load_file("stdrun.hoc")
+
+    dend = h.Section(name="dend")
+    dend.nseg = 3
+    er = rxd.Region([dend], name="er", geometry=rxd.FractionalVolume(0.17))
+    cyt = rxd.Region([dend], name="cyt")
+    ca = rxd.Species([cyt, er], name="ca", charge=2, initial=0 * uM)
 
-t = h.Vector().record(h._ref_t)
-ca_cyt01 = h.Vector().record(ca[cyt].nodes(dend(0.1))._ref_concentration)
-ca_cyt09 = h.Vector().record(ca[cyt].nodes(dend(0.9))._ref_concentration)
-ca_er01 = h.Vector().record(ca[er].nodes(dend(0.1))._ref_concentration)
-ca_er09 = h.Vector().record(ca[er].nodes(dend(0.9))._ref_concentration)
+    t = h.Vector().record(h._ref_t)
+    ca_cyt01 = h.Vector().record(ca[cyt].nodes(dend(0.1))._ref_concentration)
+    ca_cyt09 = h.Vector().record(ca[cyt].nodes(dend(0.9))._ref_concentration)
+    ca_er01 = h.Vector().record(ca[er].nodes(dend(0.1))._ref_concentration)
+    ca_er09 = h.Vector().record(ca[er].nodes(dend(0.9))._ref_concentration)
 
 
-es1 = ExternalSimulatorInterface(ca[cyt].nodes(dend(0.1)), kappa_file = "tests/caPump1.ka")
-es2 = ExternalSimulatorInterface(ca[er].nodes(dend(0.9)), kappa_file = "tests/caPump1.ka")
+    es1 = ExternalSimulatorInterface(ca[cyt].nodes(dend(0.1)), kappa_file = "tests/caPump1.ka")
+    es2 = ExternalSimulatorInterface(ca[er].nodes(dend(0.9)), kappa_file = "tests/caPump1.ka")
 
-h.finitialize(-65 * mV)
-h.continuerun(1.5 * ms)
+    h.finitialize(-65 * mV)
+    h.continuerun(1.5 * ms)
 
-es2.unregister()
+    es2.unregister()
 
-h.continuerun(3 * ms)
+    h.continuerun(3 * ms)
 
-subplots = []
-fig = plt.figure(figsize=(12, 4))
-for vec in [ca_cyt01, ca_er01, ca_cyt09, ca_er09]:
-  subplot = fig.add_subplot(2, 2, len(subplots) + 1)
-  subplot.plot(t, vec)
-  subplot.set_ylim(-0.5, 1.5)
-  if vec in [ca_er01, ca_er09]:
-    subplot.set_yticks([])
-  subplots.append(subplot)
+    subplots = []
+    fig = plt.figure(figsize=(12, 4))
+    for vec in [ca_cyt01, ca_er01, ca_cyt09, ca_er09]:
+      subplot = fig.add_subplot(2, 2, len(subplots) + 1)
+      subplot.plot(t, vec)
+      subplot.set_ylim(-0.5, 1.5)
+      if vec in [ca_er01, ca_er09]:
+        subplot.set_yticks([])
+      subplots.append(subplot)
 
-subplots[0].set_ylabel("dend(0.1) conc")
-subplots[0].set_title("cyt")
-subplots[1].set_title("er")
-subplots[2].set_ylabel("dend(0.9) conc")
-subplots[2].set_xlabel("t (ms)")
-subplots[3].set_xlabel("t (ms)")
+    subplots[0].set_ylabel("dend(0.1) conc")
+    subplots[0].set_title("cyt")
+    subplots[1].set_title("er")
+    subplots[2].set_ylabel("dend(0.9) conc")
+    subplots[2].set_xlabel("t (ms)")
+    subplots[3].set_xlabel("t (ms)")
 
-fig.show()
+    fig.show()
@@ -1,14 +1,11 @@
 import os
 import re
-import SpatialKappa
-from py4j.protocol import Py4JJavaError
 from neuron import h, rxd
 from neuron import nonvint_block_supervisor as nbs
 from neuron.units import mV, ms, uM
-import matplotlib.pyplot as plt
 
-h.load_file("stdrun.hoc")
-gateway = SpatialKappa.SpatialKappa(redirect_stdout=None)
+## Java is only started when the first sim is created
+gateway = None
 
 def report(mess):
     global verbose
@@ -47,6 +44,13 @@ class ExternalSimulatorInterface():
 
     def init(self):
         global gateway
+        import SpatialKappa
+        from py4j.protocol import Py4JJavaError
+
+        ## Start Java and load the SpatialKappa class, if not already
+        ## loaded
+        if not gateway:
+            gateway = SpatialKappa.SpatialKappa(redirect_stdout=self._sk_redirect_stdout)
 
         self._kappa_sims = []  # Will this destroy things properly?
         self._name = dict()
@@ -81,32 +85,36 @@ class ExternalSimulatorInterface():
     def unregister(self):
         nbs.unregister(self._callbacks)
 
+if __name__ == '__main__':
+    ## Demonstration, only run when this file is run as a script
+    import matplotlib.pyplot as plt
+    h.load_file("stdrun.hoc")
 
-dend = h.Section(name="dend")
-dend.nseg = 3
-cyt = rxd.Region([dend], name="cyt")
-A = rxd.Species([cyt], name="A", charge=0, initial=0 * uM)
-B = rxd.Species([cyt], name="B", charge=0, initial=0 * uM)
-AB = rxd.Species([cyt], name="AB", charge=0, initial=0 * uM)
+    dend = h.Section(name="dend")
+    dend.nseg = 3
+    cyt = rxd.Region([dend], name="cyt")
+    A = rxd.Species([cyt], name="A", charge=0, initial=0 * uM)
+    B = rxd.Species([cyt], name="B", charge=0, initial=0 * uM)
+    AB = rxd.Species([cyt], name="AB", charge=0, initial=0 * uM)
 
-t = h.Vector().record(h._ref_t)
-A_cyt01 = h.Vector().record(A[cyt].nodes(dend(0.1))._ref_concentration)
-B_cyt01 = h.Vector().record(B[cyt].nodes(dend(0.1))._ref_concentration)
-AB_cyt01 = h.Vector().record(AB[cyt].nodes(dend(0.1))._ref_concentration)
+    t = h.Vector().record(h._ref_t)
+    A_cyt01 = h.Vector().record(A[cyt].nodes(dend(0.1))._ref_concentration)
+    B_cyt01 = h.Vector().record(B[cyt].nodes(dend(0.1))._ref_concentration)
+    AB_cyt01 = h.Vector().record(AB[cyt].nodes(dend(0.1))._ref_concentration)
 
-es1 = ExternalSimulatorInterface(cyt, species=[A, B, AB], kappa_file="ab.ka")
+    es1 = ExternalSimulatorInterface(cyt, species=[A, B, AB], kappa_file="ab.ka")
 
-h.finitialize(-65 * mV)
-h.continuerun(100 * ms)
+    h.finitialize(-65 * mV)
+    h.continuerun(100 * ms)
 
-A_cyt01[0] = 150
-B_cyt01[0] = 100
+    A_cyt01[0] = 150
+    B_cyt01[0] = 100
 
-plt.plot(t, A_cyt01, label="A")
-plt.plot(t, B_cyt01, label="B")
-plt.plot(t, AB_cyt01, label="AB")
-plt.xlabel("Time(ms)")
-plt.ylabel("Number of molecule")
+    plt.plot(t, A_cyt01, label="A")
+    plt.plot(t, B_cyt01, label="B")
+    plt.plot(t, AB_cyt01, label="AB")
+    plt.xlabel("Time(ms)")
+    plt.ylabel("Number of molecule")
 
-plt.legend()
-plt.show()
+    plt.legend()
+    plt.show()
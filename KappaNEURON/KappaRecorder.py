@@ -0,0 +1,398 @@
+"""Record the species of a Kappa scheme to a file while it runs.
+
+Recording with h.Vector keeps every sample of every trace in memory
+until the end of the run. A KappaRecorder instead samples the
+concentrations of the species involved in a Kappa scheme, in every
+segment in which it has a sim, and optionally observables read
+directly from the sims, either at a fixed interval or at selected
+steps of the loop that couples the scheme to NEURON. Samples are stored in a preallocated ring
+buffer of a few chunks. Each chunk is written to the file in a
+background thread as soon as it is full, so memory use does not
+depend on the length of the run.
+
+Files ending in .h5 or .hdf5 are written with h5py, which must then be
+installed. Paths ending in .traces are written as trace stores (see
+KappaNEURON.TraceStore), which can be memory-mapped when they are read
+back; a trace store only holds the samples of the last run. Any other
+file is written as a zip archive in the format of numpy.savez(), with
+one member per chunk of each dataset, named
+e.g. "t/000003.npy". load_recording() reads any of these formats
+back. The datasets are:
+
+t -- Time of each sample, in ms.
+
+species -- Concentrations in mM of the involved species, with shape
+(samples, species, sims).
+
+observables -- Values of the observables, with shape (samples,
+observables, sims), if any observables are recorded.
+
+species_min, species_max -- Minimum and maximum of each species over
+the steps since the previous sample, if envelope is True.
+
+The names of the species and observables and the segments of the
+sims are stored as JSON in the attributes species_names,
+observable_names and segments, or for zip files in the member
+"attrs.json".
+"""
+
+import io
+import os
+import json
+import zipfile
+import weakref
+import warnings
+
+import numpy
+from neuron import h
+import neuron.rxd.rxd as nrr
+
+## NEURON's variable-step integrator, used to schedule samples, and
+## created when first needed
+_cvode = None
+
+
+def _get_cvode():
+    global _cvode
+    if _cvode is None:
+        _cvode = h.CVode()
+    return _cvode
+
+
+def _is_hdf5(path):
+    return path.endswith('.h5') or path.endswith('.hdf5')
+
+
+def _is_traces(path):
+    return path.rstrip(os.sep).endswith('.traces')
+
+
+## Units of each dataset
+_units = {'t': 'ms', 'species': 'mM', 'observables': 'molecules',
+          'species_min': 'mM', 'species_max': 'mM'}
+
+
+class _ZipWriter(object):
+    """Write chunks of datasets as members of a zip file."""
+    def __init__(self, path, attrs):
+        self._zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED, allowZip64=True)
+        self._zip.writestr('attrs.json', json.dumps(attrs))
+        self._count = 0
+
+    def write(self, datasets):
+        for name, data in datasets:
+            buf = io.BytesIO()
+            numpy.lib.format.write_array(buf, numpy.ascontiguousarray(data))
+            self._zip.writestr('%s/%06d.npy' % (name, self._count), buf.getvalue())
+        self._count += 1
+
+    def close(self):
+        self._zip.close()
+
+
+class _HDF5Writer(object):
+    """Append chunks of datasets to resizable HDF5 datasets."""
+    def __init__(self, path, attrs, shapes, chunk):
+        import h5py
+        self._file = h5py.File(path, 'w')
+        for key, value in attrs.items():
+            self._file.attrs[key] = json.dumps(value)
+        for name, shape in shapes:
+            self._file.create_dataset(name, shape=(0,) + shape, maxshape=(None,) + shape,
+                                      chunks=(chunk,) + shape, dtype='f8')
+
+    def write(self, datasets):
+        for name, data in datasets:
+            dset = self._file[name]
+            n = dset.shape[0]
+            dset.resize(n + len(data), axis=0)
+            dset[n:] = data
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class KappaRecorder(object):
+    def __init__(self, kappa, path, interval=1.0, observables=None, chunk=1024, chunks=4,
+                 decimate=1, envelope=False, window=None, delta=None):
+        """Record the species of a Kappa scheme to path while it runs.
+
+        Sampling starts at the next initialisation of NEURON and stops
+        when close() is called, which must be done to write the last
+        samples. Each initialisation restarts the sampling times, and
+        the samples are appended to those of the previous run, except
+        in a trace store, whose times must not decrease. There each
+        initialisation discards the samples of the previous run, with
+        a warning if that run went beyond its start.
+
+        If interval is None, samples are instead taken in the loop
+        that couples the scheme to NEURON: at the end of every fixed
+        step, or at every exchange under CVODE. The remaining keyword
+        arguments control which of these steps are recorded, so that
+        long quiet periods take little space while transients are
+        recorded at full resolution.
+
+        Keyword arguments:
+
+        kappa -- The Kappa scheme.
+
+        path -- Name of the file to write; see above for the formats.
+
+        interval -- Interval between samples in ms, or None to sample
+        in the coupling loop.
+
+        observables -- List of names of Kappa observables or variables
+        to read from each sim at each sample. Reading these requires a
+        call to each sim per name per sample.
+
+        chunk -- Number of samples written to the file at once.
+
+        chunks -- Number of chunks in the ring buffer. When this many
+        chunks are waiting to be written, sampling waits for the
+        oldest to be written.
+
+        decimate -- Record at least every decimate-th step.
+
+        envelope -- Boolean indicating if the minimum and maximum of
+        each species over the steps since the previous sample are also
+        recorded, in the datasets species_min and species_max.
+
+        window -- Record every step for window ms after each event
+        from a NetCon added to the scheme with Kappa.add_netcon() and
+        after each change larger than delta.
+
+        delta -- Record any step in which a species has changed by more
+        than delta mM since the previous sample.
+
+        """
+        if interval is not None and (decimate != 1 or envelope or window is not None or delta is not None):
+            raise Exception('decimate, envelope, window and delta require interval=None')
+        self._kappa = kappa
+        self._path = path
+        self._interval = None if interval is None else float(interval)
+        self._observables = list(observables or [])
+        self._chunk = chunk
+        self._nchunks = max(2, chunks)
+        self._decimate = decimate
+        self._envelope = envelope
+        self._window = window
+        self._delta = delta
+        self._writer = None
+        self._pool = None
+        self._pending = [None]*self._nchunks
+        ## Number of samples taken, and number written or being written
+        self._n = 0
+        self._n_flushed = 0
+        self._t0 = None
+        ## Steps since the previous sample, windows of dense recording
+        ## as (start, end) times, and the species at the previous
+        ## sample
+        self._steps = 0
+        self._windows = []
+        self._last = None
+        self._fih = h.FInitializeHandler(3, self._init)
+        if self._interval is None:
+            kappa._recorders.append(weakref.ref(self))
+
+    def _open(self):
+        """Allocate the ring buffer and open the file, once the number
+        of sims is known."""
+        k = self._kappa
+        nspecies, nsims = k._obs_indices.shape
+        size = self._chunk*self._nchunks
+        self._t = numpy.empty(size)
+        self._species = numpy.empty((size, nspecies, nsims))
+        self._obs = numpy.empty((size, len(self._observables), nsims))
+        if self._envelope:
+            self._species_min = numpy.empty((size, nspecies, nsims))
+            self._species_max = numpy.empty((size, nspecies, nsims))
+        ## Segment of each sim, e.g. "sh(0.5)"
+        nodes = dict((node._index, node) for node in k._involved_species[0]().nodes)
+        attrs = {'species_names': [sptr().name for sptr in k._involved_species],
+                 'observable_names': self._observables,
+                 'segments': [str(nodes[i].segment) for i in k._obs_indices[0]],
+                 'interval': self._interval,
+                 'decimate': self._decimate,
+                 'window': self._window,
+                 'delta': self._delta}
+        shapes = [('t', ()), ('species', (nspecies, nsims))]
+        if self._observables:
+            shapes.append(('observables', (len(self._observables), nsims)))
+        if self._envelope:
+            shapes += [('species_min', (nspecies, nsims)), ('species_max', (nspecies, nsims))]
+        if _is_hdf5(self._path):
+            self._writer = _HDF5Writer(self._path, attrs, shapes, self._chunk)
+        elif _is_traces(self._path):
+            from KappaNEURON.TraceStore import TraceWriter
+            self._writer = TraceWriter(self._path, 't', attrs)
+            for name, shape in shapes:
+                self._writer.add_column(name, shape, _units[name])
+        else:
+            self._writer = _ZipWriter(self._path, attrs)
+        from multiprocessing.pool import ThreadPool
+        self._pool = ThreadPool(1)
+
+    def _init(self):
+        if self._writer is None:
+            self._open()
+        elif self._n and _is_traces(self._path):
+            self._discard()
+        self._t0 = h.t
+        self._m = 0
+        self._steps = 0
+        self._windows = []
+        if self._interval is None:
+            self._record(h.t, nrr.node._get_states()[self._kappa._obs_indices])
+        else:
+            self._sample()
+
+    def _discard(self):
+        """Discard the samples of the previous run from the trace store,
+        so that its times keep increasing."""
+        for c, pending in enumerate(self._pending):
+            if pending is not None:
+                pending.get()
+                self._pending[c] = None
+        t_last = self._t[(self._n - 1) % len(self._t)]
+        if t_last > self._t0:
+            warnings.warn('Discarding the samples up to t = %g recorded in %s before re-initialisation' % (t_last, self._path), UserWarning)
+        self._writer.truncate()
+        self._n = 0
+        self._n_flushed = 0
+
+    def _sample(self):
+        """Take a sample and schedule the next."""
+        if self._writer is None:
+            ## The recorder has been closed
+            return
+        self._record(h.t, nrr.node._get_states()[self._kappa._obs_indices])
+        self._m += 1
+        _get_cvode().event(self._t0 + self._m*self._interval, self._sample)
+
+    def _step(self, t):
+        """Record the step of the coupling loop ending at time t, if
+        required."""
+        if self._writer is None:
+            return
+        species = nrr.node._get_states()[self._kappa._obs_indices]
+        self._steps += 1
+        if self._envelope:
+            numpy.minimum(self._env_min, species, out=self._env_min)
+            numpy.maximum(self._env_max, species, out=self._env_max)
+        record = self._steps >= self._decimate
+        if self._delta is not None and abs(species - self._last).max() > self._delta:
+            record = True
+            if self._window is not None:
+                self._windows.append((t, t + self._window))
+        self._windows = [w for w in self._windows if w[1] >= t]
+        if any(start <= t for start, end in self._windows):
+            record = True
+        if record:
+            self._record(t, species)
+
+    def _trigger(self, t):
+        """Record every step for the window after an event at time t."""
+        if self._window is not None:
+            self._windows.append((t, t + self._window))
+
+    def _record(self, t, species):
+        """Store a sample of the species at time t in the ring buffer,
+        and start writing the chunk if it is full.
+
+        Observables are read from the sims, so in pipeline mode this
+        first waits for any step running on them in the background.
+        Its result is left for the coupling loop to collect.
+        """
+        k = self._kappa
+        size = len(self._t)
+        i = self._n % size
+        c = i//self._chunk
+        ## Wait until the chunk being overwritten has been written
+        if i % self._chunk == 0 and self._pending[c] is not None:
+            self._pending[c].get()
+            self._pending[c] = None
+        self._t[i] = t
+        self._species[i] = species
+        if self._observables and k._pending is not None:
+            k._pending.wait()
+        for j, name in enumerate(self._observables):
+            for n, kappa_sim in enumerate(k._kappa_sims):
+                self._obs[i, j, n] = kappa_sim.getVariable(name)
+        if self._envelope:
+            if self._steps:
+                self._species_min[i] = numpy.minimum(self._env_min, species)
+                self._species_max[i] = numpy.maximum(self._env_max, species)
+            else:
+                self._species_min[i] = species
+                self._species_max[i] = species
+            self._env_min = species.copy()
+            self._env_max = species.copy()
+        self._last = species.copy()
+        self._steps = 0
+        self._n += 1
+        if self._n % self._chunk == 0:
+            self._flush()
+
+    def _flush(self):
+        """Write the samples not yet written in the background."""
+        if self._n == self._n_flushed:
+            return
+        size = len(self._t)
+        lo = self._n_flushed % size
+        hi = lo + (self._n - self._n_flushed)
+        datasets = [('t', self._t[lo:hi]), ('species', self._species[lo:hi])]
+        if self._observables:
+            datasets.append(('observables', self._obs[lo:hi]))
+        if self._envelope:
+            datasets += [('species_min', self._species_min[lo:hi]), ('species_max', self._species_max[lo:hi])]
+        self._pending[lo//self._chunk] = self._pool.apply_async(self._writer.write, (datasets,))
+        self._n_flushed = self._n
+
+    def close(self):
+        """Write any remaining samples and close the file."""
+        if self._writer is None:
+            return
+        self._flush()
+        for c, pending in enumerate(self._pending):
+            if pending is not None:
+                pending.get()
+                self._pending[c] = None
+        self._pool.close()
+        self._pool.join()
+        self._writer.close()
+        self._writer = None
+        self._fih = None
+
+
+def load_recording(path):
+    """Return a dictionary of the datasets recorded by a KappaRecorder
+    in path, and of its attributes. The datasets of a trace store are
+    memory-mapped rather than read."""
+    result = {}
+    if _is_traces(path):
+        from KappaNEURON.TraceStore import open_traces
+        store = open_traces(path)
+        result.update(store.attrs)
+        for name in store:
+            result[name] = store[name]
+        return result
+    if _is_hdf5(path):
+        import h5py
+        with h5py.File(path, 'r') as f:
+            for key, value in f.attrs.items():
+                result[key] = json.loads(value)
+            for name in f:
+                result[name] = f[name][:]
+        return result
+    chunks = {}
+    with zipfile.ZipFile(path) as z:
+        for member in sorted(z.namelist()):
+            if member == 'attrs.json':
+                result.update(json.loads(z.read(member).decode('utf-8')))
+                continue
+            name = member.split('/')[0]
+            chunks.setdefault(name, []).append(numpy.lib.format.read_array(io.BytesIO(z.read(member))))
+    for name, arrays in chunks.items():
+        result[name] = numpy.concatenate(arrays)
+    return result
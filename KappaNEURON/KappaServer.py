@@ -0,0 +1,262 @@
+"""Serve SpatialKappa sims to many KappaNEURON processes from one JVM.
+
+Starting Java and loading SpatialKappa takes several seconds, which
+dominates the run time of short simulations such as those in a
+parameter sweep. A KappaNEURON server, started once per machine with
+
+    python -m KappaNEURON.KappaServer
+
+keeps one SpatialKappa gateway running and creates sims for any number
+of client processes, which use it by creating Kappa objects with the
+server argument.
+
+Each client connection is served by its own thread, using the same
+requests as the workers of a KappaSimPool. The sims created through a
+connection can only be reached through that connection, and they are
+released when the client closes the connection or dies. A client
+process opens one connection to each server it uses and shares it
+between all its Kappa schemes, each of which is given its own block of
+sim indices on the connection by KappaServerPool.
+
+Requests and replies are pickled, so anyone who can connect to a
+server, or make a client connect to them, can run code in the other
+process. By default the server listens on a Unix socket in a directory
+that only the user can enter, and clients refuse a socket that belongs
+to another user. A server can instead listen on a TCP port, which any
+local user can reach, but only with an authentication key.
+"""
+
+import os
+import stat
+import tempfile
+import threading
+import argparse
+from multiprocessing.connection import Listener, Client, AuthenticationError
+
+import SpatialKappa
+
+from KappaNEURON.KappaSimPool import KappaSimPool, _serve
+
+
+try:
+    _string_types = basestring
+except NameError:
+    _string_types = str
+
+
+def _is_socket_path(address):
+    """Return True if address is the path of a Unix socket rather than
+    a (host, port) tuple."""
+    return isinstance(address, _string_types)
+
+
+def _private_dir():
+    """Return the directory holding the default socket, creating it if
+    necessary: KappaNEURON in $XDG_RUNTIME_DIR if that is set, or
+    otherwise KappaNEURON-<uid> in the temporary directory. Raise
+    RuntimeError if it is not a directory that only the user can
+    enter."""
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        path = os.path.join(runtime_dir, 'KappaNEURON')
+    else:
+        path = os.path.join(tempfile.gettempdir(), 'KappaNEURON-%d' % (os.getuid()))
+    try:
+        os.mkdir(path, 0o700)
+    except OSError:
+        if not os.path.lexists(path):
+            raise
+    ## Another user may have created the path first, e.g. in /tmp
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise RuntimeError('%s is not a directory private to this user; remove it or give the server address explicitly' % (path))
+    return path
+
+
+def _check_owner(address):
+    """Raise RuntimeError if the Unix socket address exists and belongs
+    to another user."""
+    if _is_socket_path(address) and os.path.lexists(address) \
+       and os.lstat(address).st_uid != os.getuid():
+        raise RuntimeError('%s belongs to another user' % (address))
+
+
+def default_address():
+    """Return the address of the server on this machine: a Unix socket
+    in a directory private to the user."""
+    return os.path.join(_private_dir(), 'server.sock')
+
+
+def _authkey(authkey):
+    """Return authkey as the bytes that multiprocessing expects."""
+    if authkey is not None and not isinstance(authkey, bytes):
+        authkey = authkey.encode()
+    return authkey
+
+
+def _client_main(conn, gateway):
+    """Serve one client until it closes the connection or dies."""
+    _serve(conn, gateway)
+    conn.close()
+
+
+def serve(address=None, authkey=None, redirect_stdout=None):
+    """Start Java and serve sims to clients until interrupted.
+
+    Keyword arguments:
+
+    address -- Path of a Unix socket, or (host, port) tuple, on which
+    to listen. Default is default_address().
+
+    authkey -- Authentication key that clients must give. It is
+    required when listening on a TCP port.
+
+    redirect_stdout -- Passed to SpatialKappa.
+
+    """
+    if address is None:
+        address = default_address()
+    authkey = _authkey(authkey)
+    if not _is_socket_path(address) and not authkey:
+        raise RuntimeError('An authkey is required to listen on a TCP port')
+    _check_owner(address)
+    if _is_socket_path(address) and os.path.exists(address):
+        ## The socket may have been left behind by a server that died
+        try:
+            Client(address, authkey=authkey).close()
+        except AuthenticationError:
+            raise RuntimeError('A KappaNEURON server is already listening on %s' % (address))
+        except (IOError, OSError):
+            os.unlink(address)
+        else:
+            raise RuntimeError('A KappaNEURON server is already listening on %s' % (address))
+    gateway = SpatialKappa.SpatialKappa(redirect_stdout=redirect_stdout)
+    ## Only the user may connect to the socket
+    umask = os.umask(0o077)
+    try:
+        listener = Listener(address, authkey=authkey)
+    finally:
+        os.umask(umask)
+    try:
+        while True:
+            try:
+                conn = listener.accept()
+            except (AuthenticationError, IOError, OSError):
+                continue
+            thread = threading.Thread(target=_client_main, args=(conn, gateway))
+            thread.daemon = True
+            thread.start()
+    finally:
+        listener.close()
+
+
+class _Connection(object):
+    """Connection from this process to a server, shared by the pools of
+    all the Kappa schemes using the server."""
+    def __init__(self, address, authkey):
+        self.conn = Client(address, authkey=authkey)
+        ## Held from sending a request until receiving its answer, so
+        ## that pools used from different threads do not interleave
+        ## their requests
+        self.lock = threading.Lock()
+        ## Index in the server of the first sim of the next pool
+        self.next_index = 0
+
+## Open connections, indexed by address
+_connections = {}
+
+
+class KappaServerPool(KappaSimPool):
+    def __init__(self, nsims, address=None, authkey=None):
+        """Create the sims of one Kappa scheme in a KappaNEURON server.
+
+        The connection to the server is opened when the first pool
+        using it is created, and then reused by every pool in this
+        process.
+
+        Keyword arguments:
+
+        nsims -- Number of sims that will be created with kappa_sim().
+
+        address -- Address of the server. Default is
+        default_address().
+
+        authkey -- Authentication key of the server, which is required
+        if it listens on a TCP port.
+
+        """
+        if address is None:
+            address = default_address()
+        if not _is_socket_path(address):
+            address = tuple(address)
+            if not authkey:
+                raise RuntimeError('An authkey is required to connect to a KappaNEURON server on a TCP port')
+        self._address = address
+        self._connection = _connections.get(address)
+        if self._connection is None:
+            _check_owner(address)
+            try:
+                self._connection = _Connection(address, _authkey(authkey))
+            except (IOError, OSError) as e:
+                raise RuntimeError('Cannot connect to KappaNEURON server at %s: %s. Start one with "python -m KappaNEURON.KappaServer"' % (address, e))
+            _connections[address] = self._connection
+        self._nsims = nsims
+        ## The server acts as a single worker holding all the sims
+        self._nworkers = 1
+        self._bounds = [0, nsims]
+        self._conns = [self._connection.conn]
+        self._procs = []
+        self._first = self._connection.next_index
+        self._connection.next_index += nsims
+        self._next_index = 0
+        self._nmemb = 0
+
+    def _locked(self, method, *args):
+        """Call a method of KappaSimPool while holding the connection."""
+        with self._connection.lock:
+            try:
+                return method(self, *args)
+            except (EOFError, IOError, OSError) as e:
+                ## The next pool will try to reconnect
+                if _connections.get(self._address) is self._connection:
+                    del _connections[self._address]
+                raise RuntimeError('Lost connection to KappaNEURON server at %s: %s' % (self._address, e))
+
+    def _request(self, w, cmd, args):
+        return self._locked(KappaSimPool._request, w, cmd, args)
+
+    def exchange(self, payload, dt):
+        return self._locked(KappaSimPool.exchange, payload, dt)
+
+    def run_free(self, times):
+        return self._locked(KappaSimPool.run_free, times)
+
+    def close(self):
+        """Release the sims of this pool in the server. The connection
+        stays open for other pools."""
+        if self._conns:
+            try:
+                self._request(0, 'release', (self._first, self._indices(0, self._nsims)))
+            except RuntimeError:
+                pass
+            self._conns = []
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve SpatialKappa sims to KappaNEURON processes on this machine.')
+    parser.add_argument('--address', default=None,
+                        help='Path of the Unix socket on which to listen (default: server.sock in a directory private to the user)')
+    parser.add_argument('--port', type=int, default=None,
+                        help='Listen on this TCP port of localhost instead of a Unix socket; requires an authkey')
+    parser.add_argument('--authkey', default=os.environ.get('KAPPANEURON_AUTHKEY'),
+                        help='Authentication key that clients must give (default: $KAPPANEURON_AUTHKEY, which unlike the command line is not visible to other users)')
+    args = parser.parse_args()
+    if args.port is not None and not args.authkey:
+        parser.error('--port requires --authkey or $KAPPANEURON_AUTHKEY')
+    address = args.address
+    if args.port is not None:
+        address = ('localhost', args.port)
+    try:
+        serve(address, args.authkey)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,317 @@
+"""Run the SpatialKappa sims of a Kappa scheme in worker processes.
+
+Each worker process starts its own SpatialKappa gateway (and hence its
+own JVM) and owns a contiguous block of the sims of a scheme. The sims
+are created and manipulated through _RemoteKappaSim proxies, which
+forward method calls to the worker that owns the sim, so that the
+setup code in the Kappa class works unchanged. At each time step
+KappaSimPool.exchange() scatters fluxes and membrane potentials to all
+the workers at once, lets them step their sims concurrently and gathers
+the results in sim order.
+
+Every sim is created with the same arguments, including the seed, that
+it would have been given in the main process, and each sim only ever
+sees its own inputs, so results do not depend on the number of
+workers.
+"""
+
+import multiprocessing
+import numpy
+
+import SpatialKappa
+from py4j.protocol import Py4JJavaError
+from py4j.java_collections import JavaArray, JavaList, JavaMap
+
+
+class RemoteJavaError(Py4JJavaError):
+    """A Java exception raised by a sim in a worker process.
+
+    The Java exception itself cannot be sent between processes, so
+    java_exception is its string representation. This allows error
+    handling code written for Py4JJavaError to be used unchanged.
+    """
+    def __init__(self, msg, java_exception):
+        Exception.__init__(self, msg)
+        self.java_exception = java_exception
+
+    def __str__(self):
+        return '%s\n%s' % (self.args[0], self.java_exception)
+
+
+class _RemoteRef(object):
+    """Reference to a Java object held by a worker process."""
+    def __init__(self, ref):
+        self.ref = ref
+
+
+def _to_python(obj, refs):
+    """Convert a value returned by py4j into something that can be
+    pickled, keeping Java objects in the worker and returning
+    references to them."""
+    if isinstance(obj, JavaMap):
+        return dict((k, _to_python(v, refs)) for k, v in obj.items())
+    if isinstance(obj, (JavaList, JavaArray)):
+        return [_to_python(v, refs) for v in obj]
+    if hasattr(obj, '_target_id'):
+        refs[id(obj)] = obj
+        return _RemoteRef(id(obj))
+    return obj
+
+
+def _from_python(obj, refs):
+    """Replace references sent back to a worker by the Java objects."""
+    if isinstance(obj, _RemoteRef):
+        if obj.ref not in refs:
+            raise ValueError('The Java object referred to has been released; references '
+                             'returned by a sim are only valid until it is next run')
+        return refs[obj.ref]
+    if isinstance(obj, dict):
+        return dict((k, _from_python(v, refs)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_from_python(v, refs) for v in obj)
+    return obj
+
+
+def _serve(conn, gateway):
+    """Serve requests for sims created through gateway arriving on conn
+    until told to close or until the other end of conn is closed.
+
+    The sims belong to the connection, and are released when this
+    returns. Sims are identified by indices chosen by the client, and
+    the names used by 'step' are set separately for each block of
+    sims, identified by the index of its first sim.
+
+    Java objects returned by a call to a sim are held, so that they can
+    be passed back to it, only until the sim is next run or released.
+    That is long enough for the calls that set initial values, e.g.
+    overrideInitialValue(agentList(getVariableComplex(name)), n),
+    and keeps a long-lived connection from holding every object ever
+    returned.
+    """
+    sims = {}
+    ## Java objects returned to the client, by sim
+    refs = {}
+    ## Totals of membrane species at the end of the last step of each sim
+    stot = {}
+    names = {}
+    while True:
+        try:
+            cmd, args = conn.recv()
+        except (EOFError, IOError, OSError):
+            break
+        if cmd == 'close':
+            break
+        try:
+            result = None
+            if cmd == 'create':
+                index, time_units, verbose, seed = args
+                sims[index] = gateway.kappa_sim(time_units, verbose, seed)
+                refs[index] = {}
+            elif cmd == 'call':
+                index, method, margs = args
+                ## Any call may change the state of the sim
+                stot.pop(index, None)
+                sim_refs = refs.setdefault(index, {})
+                margs = _from_python(margs, sim_refs)
+                if method == 'runForTime':
+                    sim_refs.clear()
+                result = _to_python(getattr(sims[index], method)(*margs), sim_refs)
+            elif cmd == 'names':
+                first, create_names, total_names, obs_names = args
+                names[first] = (create_names, total_names, obs_names)
+            elif cmd == 'step':
+                first, indices, fluxes, v, dt = args
+                create_names, total_names, obs_names = names[first]
+                delta = numpy.empty((len(total_names), len(indices)))
+                obs = numpy.empty((len(obs_names), len(indices)))
+                for n, index in enumerate(indices):
+                    sim = sims[index]
+                    refs[index].clear()
+                    for j, name in enumerate(create_names):
+                        sim.setTransitionRateOrVariable(name, float(fluxes[j, n]))
+                    sim.setTransitionRateOrVariable('V', float(v[n]))
+                    Stot0 = stot.get(index)
+                    if Stot0 is None:
+                        Stot0 = numpy.array([sim.getVariable(name) for name in total_names])
+                    sim.runForTime(dt, False)
+                    Stot1 = numpy.array([sim.getVariable(name) for name in total_names])
+                    stot[index] = Stot1
+                    delta[:, n] = Stot1 - Stot0
+                    obs[:, n] = [sim.getVariable(name) for name in obs_names]
+                result = (delta, obs)
+            elif cmd == 'run':
+                indices, times = args
+                for index, t in zip(indices, times):
+                    refs[index].clear()
+                    sims[index].runForTime(float(t), True)
+                    stot.pop(index, None)
+            elif cmd == 'release':
+                first, indices = args
+                names.pop(first, None)
+                for index in indices:
+                    sims.pop(index, None)
+                    refs.pop(index, None)
+                    stot.pop(index, None)
+            conn.send(('ok', result))
+        except Py4JJavaError as e:
+            conn.send(('java_error', (str(e.args[0]), str(e.java_exception))))
+        except Exception as e:
+            conn.send(('error', '%s: %s' % (type(e).__name__, e)))
+    ## Dropping the last references to the Java objects lets py4j
+    ## release them in the JVM
+    sims.clear()
+    refs.clear()
+
+
+def _worker_main(conn, redirect_stdout):
+    """Serve requests from a KappaSimPool until told to close."""
+    gateway = SpatialKappa.SpatialKappa(redirect_stdout=redirect_stdout)
+    _serve(conn, gateway)
+    conn.close()
+
+
+class _RemoteKappaSim(object):
+    """Proxy for a SpatialKappa sim living in a worker process."""
+    def __init__(self, pool, worker, index):
+        self._pool = pool
+        self._worker = worker
+        self._index = index
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+        def call(*args):
+            return self._pool._request(self._worker, 'call', (self._index, method, args))
+        return call
+
+
+class KappaSimPool(object):
+    def __init__(self, nworkers, nsims, redirect_stdout=None):
+        """Start worker processes to hold the sims of one Kappa scheme.
+
+        Keyword arguments:
+
+        nworkers -- Number of worker processes. No more workers than
+        sims are started.
+
+        nsims -- Number of sims that will be created with kappa_sim().
+
+        redirect_stdout -- Passed to SpatialKappa in each worker.
+
+        """
+        self._nsims = nsims
+        self._nworkers = max(1, min(nworkers, nsims))
+        ## Worker w owns the contiguous block of sims
+        ## _bounds[w]:_bounds[w + 1]
+        self._bounds = [(w*nsims)//self._nworkers for w in range(self._nworkers + 1)]
+        self._conns = []
+        self._procs = []
+        for w in range(self._nworkers):
+            parent_conn, child_conn = multiprocessing.Pipe()
+            proc = multiprocessing.Process(target=_worker_main, args=(child_conn, redirect_stdout))
+            proc.daemon = True
+            proc.start()
+            self._conns.append(parent_conn)
+            self._procs.append(proc)
+        ## Sims are numbered in the workers from _first, so that the
+        ## sims of several pools can share a worker
+        self._first = 0
+        self._next_index = 0
+        self._nmemb = 0
+
+    def _worker_of(self, index):
+        for w in range(self._nworkers):
+            if index < self._bounds[w + 1]:
+                return w
+        raise IndexError('sim index %d out of range' % (index))
+
+    def _receive(self, w):
+        status, result = self._conns[w].recv()
+        if status == 'java_error':
+            raise RemoteJavaError(*result)
+        if status == 'error':
+            raise RuntimeError('Error in Kappa worker %d: %s' % (w, result))
+        return result
+
+    def _gather(self):
+        """Receive the answer of every worker to a request sent to all
+        of them, and return the results in worker order.
+
+        Every answer is read before any error is raised, so that the
+        connections are left ready for the next request.
+        """
+        results = []
+        error = None
+        for w in range(self._nworkers):
+            try:
+                results.append(self._receive(w))
+            except (RemoteJavaError, RuntimeError) as e:
+                results.append(None)
+                if error is None:
+                    error = e
+        if error is not None:
+            raise error
+        return results
+
+    def _indices(self, lo, hi):
+        """Return the indices in the workers of sims lo to hi."""
+        return list(range(self._first + lo, self._first + hi))
+
+    def _request(self, w, cmd, args):
+        self._conns[w].send((cmd, args))
+        return self._receive(w)
+
+    def kappa_sim(self, time_units, verbose, seed=None):
+        """Create the next sim in its worker and return a proxy for it."""
+        index = self._next_index
+        w = self._worker_of(index)
+        self._request(w, 'create', (self._first + index, time_units, verbose, seed))
+        self._next_index += 1
+        return _RemoteKappaSim(self, w, self._first + index)
+
+    def set_exchange_names(self, create_names, total_names, obs_names):
+        """Set the names of the creation transitions, totals and
+        observables used by exchange()."""
+        self._nmemb = len(create_names)
+        self._nobs = len(obs_names)
+        for w in range(self._nworkers):
+            self._request(w, 'names', (self._first, create_names, total_names, obs_names))
+
+    def exchange(self, payload, dt):
+        """Set fluxes and membrane potentials, run every sim for dt and
+        return the net change in totals and the observables.
+
+        payload and the returned buffer are big-endian doubles laid
+        out as described in KappaNEURON._kappa_advance().
+        """
+        x = numpy.frombuffer(payload, dtype='>f8').reshape((self._nmemb + 1, self._nsims))
+        ## Scatter to all workers before gathering, so that the
+        ## workers run concurrently
+        for w in range(self._nworkers):
+            lo, hi = self._bounds[w], self._bounds[w + 1]
+            self._conns[w].send(('step', (self._first, self._indices(lo, hi), x[:self._nmemb, lo:hi], x[self._nmemb, lo:hi], dt)))
+        delta = numpy.empty((self._nmemb, self._nsims))
+        obs = numpy.empty((self._nobs, self._nsims))
+        for w, result in enumerate(self._gather()):
+            lo, hi = self._bounds[w], self._bounds[w + 1]
+            delta[:, lo:hi], obs[:, lo:hi] = result
+        return numpy.concatenate((delta.ravel(), obs.ravel())).astype('>f8').tobytes()
+
+    def run_free(self, times):
+        """Run each sim for the corresponding time in times, without
+        exchanging anything, with the workers running concurrently."""
+        for w in range(self._nworkers):
+            lo, hi = self._bounds[w], self._bounds[w + 1]
+            self._conns[w].send(('run', (self._indices(lo, hi), list(times[lo:hi]))))
+        self._gather()
+
+    def close(self):
+        """Stop the worker processes."""
+        for conn, proc in zip(self._conns, self._procs):
+            try:
+                conn.send(('close', None))
+            except (IOError, OSError):
+                pass
+            proc.join()
+        self._conns = []
+        self._procs = []
@@ -0,0 +1,226 @@
+"""Convert mass-action Kappa rules into rxd reactions.
+
+Many rules in the schemes coupled to NEURON through Kappa are plain
+mass-action reactions between unstructured agents, for example the
+pump in tests/caPump1.ka that tests/caPump1.mod mirrors. NEURON can
+integrate these deterministically far faster than SpatialKappa can
+simulate them stochastically. kappa_to_rxd() finds such rules in a
+Kappa file and returns equivalent rxd.Reaction and rxd.Rate objects,
+and write_remaining_kappa() writes a copy of the file without them, to
+be passed to Kappa, so that only the genuinely rule-based part is
+simulated by SpatialKappa.
+
+A rule can be converted if each of its reactants and products is
+either a single agent with no sites in internal states and no bonds,
+or a complex that is counted exactly by an observable, each of these
+agents or observables corresponds by name to one of the rxd.Species
+given, and its rate does not depend on the membrane potential. Rules
+that change the number of a membrane species, such as the extrusion in
+tests/caPump1.ka, are never converted: Kappa passes such changes to
+NEURON as a transmembrane current, which an rxd reaction would not
+carry. Nor are rules that change a species that Kappa reads back into
+NEURON at every step, which would undo the rxd reaction. The files are
+read with the parser of the numpy backend, so only the flat subset of
+Kappa that it supports can be converted.
+"""
+
+import warnings
+
+import neuron.rxd as rxd
+import neuron.rxd.constants as constants
+
+from KappaNEURON.NumpyKappa import _parse_file, _depends_on
+
+molecules_per_mM_um3 = constants.molecules_per_mM_um3()
+
+
+def _species_name(model, i):
+    """Return the name under which species i of model may correspond to
+    an rxd.Species: the name of the agent if the species is a single
+    agent with no internal states or bonds, or the name of an
+    observable matching exactly the species if it is a complex, or
+    None otherwise."""
+    key = model.species[i]
+    if len(key) == 1:
+        name, sites = key[0]
+        for site, state, bond in sites:
+            if state or bond:
+                return None
+        return name
+    for name in sorted(model.obs):
+        if model.weights(name)[i] and len(model.obs[name]) > 1:
+            return name
+    return None
+
+
+def _side(model, counts, species):
+    """Return the rxd expression for one side of a reaction, or None if
+    it cannot be expressed in terms of species."""
+    expr = None
+    for i, mult in sorted(counts.items()):
+        name = _species_name(model, i)
+        if name is None or name not in species:
+            return None
+        term = species[name] if mult == 1 else mult*species[name]
+        expr = term if expr is None else expr + term
+    return expr
+
+
+def _net_change(model, counts, name):
+    """Return the number of agents called name in the species counted
+    in counts."""
+    return sum(mult*len([agent for agent, sites in model.species[i] if agent == name])
+               for i, mult in counts.items())
+
+
+def _free_agents(model, name):
+    """Return the number of agents called name with no bonds in each
+    species of model."""
+    return [len([agent for agent, sites in key
+                 if agent == name and not any(bond for site, state, bond in sites)])
+            for key in model.species]
+
+
+def _change(counts, weights):
+    """Return the weighted sum of the species counted in counts."""
+    return sum(mult*weights[i] for i, mult in counts.items())
+
+
+def kappa_to_rxd(kappa_file, species, volume=None, variables=None, time_units='ms', regions=None,
+                 membrane_species=None, kappa_species=None):
+    """Return rxd reactions equivalent to the mass-action rules in a
+    Kappa file, and the names of the rules converted.
+
+    Keyword arguments:
+
+    kappa_file -- Name of the Kappa file.
+
+    species -- List of rxd.Species, matched to Kappa agents and to
+    observables of complexes by name.
+
+    volume -- Volume in um3 in which the Kappa rates apply. Kappa rates
+    of rules with more or less than one reactant depend on the volume,
+    so these rules are only converted if it is given.
+
+    variables -- Dictionary of values of Kappa variables overriding
+    those in the file, as would be given to Kappa.setVariable().
+
+    time_units -- The units in which rate constants in the Kappa file
+    are defined: "ms" or "s".
+
+    regions -- List of rxd.Regions to which the reactions are
+    restricted. By default they apply wherever their species are.
+
+    membrane_species -- List of the rxd.Species that will be passed to
+    Kappa as membrane species. Rules that change the total number of
+    any of these are not converted, and a warning is given for each.
+
+    kappa_species -- List of the rxd.Species that will be passed to
+    Kappa as species. Kappa overwrites these, and membrane species,
+    with its own counts at every step, so rules that change the number
+    of free agents of a membrane species, or the observable named
+    after any other of these species, are not converted either, and a
+    warning is given for each.
+
+    Returns a tuple of the list of rxd.Reaction and rxd.Rate objects
+    and the list of names of the rules they replace.
+
+    """
+    model = _parse_file(kappa_file)
+    species = dict((s.name, s) for s in species)
+    time_factor = {'ms': 1.0, 's': 0.001}[time_units]
+
+    def value(name):
+        if variables and name in variables:
+            return float(variables[name])
+        return model.vars[name].evaluate(value)
+
+    kwargs = {}
+    if regions is not None:
+        kwargs['regions'] = regions
+    ## Weights of the species of model in the value Kappa reads back
+    ## into each rxd.Species it observes
+    observed = []
+    for s in membrane_species or []:
+        observed.append((s.name, _free_agents(model, s.name)))
+    for s in kappa_species or []:
+        observed.append((s.name, model.weights(s.name) if s.name in model.obs else _free_agents(model, s.name)))
+
+    reactions = []
+    converted = []
+    for rule in model.rules:
+        if _depends_on(model, rule.rate, 'V'):
+            continue
+        crossing = [s.name for s in membrane_species or []
+                    if _net_change(model, rule.products, s.name) != _net_change(model, rule.reactants, s.name)]
+        if crossing:
+            warnings.warn('Not converting rule %s, which changes the number of membrane species %s' % (rule.name, ', '.join(crossing)), UserWarning)
+            continue
+        shared = [name for name, weights in observed
+                  if _change(rule.products, weights) != _change(rule.reactants, weights)]
+        if shared:
+            warnings.warn('Not converting rule %s, which changes %s, which Kappa sets at every step' % (rule.name, ', '.join(shared)), UserWarning)
+            continue
+        order = sum(rule.reactants.values())
+        if order != 1 and volume is None:
+            continue
+        lhs = _side(model, rule.reactants, species)
+        rhs = _side(model, rule.products, species)
+        if (rule.reactants and lhs is None) or (rule.products and rhs is None) \
+           or (lhs is None and rhs is None):
+            continue
+        try:
+            k = rule.rate.evaluate(value)*time_factor
+        except (KeyError, RuntimeError):
+            continue
+        ## Kappa rates are per combination of molecules; convert to a
+        ## rate per combination of concentrations in mM
+        if order != 1:
+            k *= (molecules_per_mM_um3*volume)**(order - 1)
+        if rhs is None:
+            ## Degradation of each reactant at the mass-action rate
+            rate = k
+            for i, mult in rule.reactants.items():
+                for j in range(mult):
+                    rate = rate*species[_species_name(model, i)]
+            for i, mult in rule.reactants.items():
+                reactions.append(rxd.Rate(species[_species_name(model, i)], -mult*rate, **kwargs))
+        elif lhs is None:
+            ## Creation, at a constant rate in mM/ms
+            for i, mult in rule.products.items():
+                reactions.append(rxd.Rate(species[_species_name(model, i)], k*mult, **kwargs))
+        else:
+            reactions.append(rxd.Reaction(lhs > rhs, k, **kwargs))
+        converted.append(rule.name)
+    return reactions, converted
+
+
+def write_remaining_kappa(kappa_file, converted, path):
+    """Write a copy of a Kappa file to path with the rules named in
+    converted, as returned by kappa_to_rxd(), commented out. Lines
+    defining a reversible rule are only commented out if both
+    directions have been converted."""
+    model = _parse_file(kappa_file)
+    keep = set()
+    drop = set()
+    for rule in model.rules:
+        if rule.lineno is None:
+            continue
+        if rule.name in converted:
+            drop.add(rule.lineno)
+        else:
+            keep.add(rule.lineno)
+    drop -= keep
+    with open(kappa_file) as f:
+        lines = f.read().split('\n')
+    for lineno in sorted(drop):
+        ## Comment out every line of a rule continued over several
+        i = lineno
+        while True:
+            continued = lines[i].endswith('\\')
+            lines[i] = '# Converted to rxd: ' + lines[i]
+            i += 1
+            if not continued or i == len(lines):
+                break
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines))
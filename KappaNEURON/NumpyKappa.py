@@ -0,0 +1,806 @@
+"""Simulate flat Kappa models in-process with NumPy.
+
+Small mass-action schemes such as tests/caPump1.ka, tests/caPump2.ka
+and ab.ka spend far longer in round trips through the SpatialKappa
+gateway than in simulation. This module provides an alternative
+backend, selected with Kappa(..., backend='numpy'), that parses the
+flat subset of Kappa into a reaction network and simulates it with
+Gillespie's direct method, vectorised across all the sims of a scheme.
+Optionally, reactions between species present in large numbers can be
+approximated by tau-leaping (see _tau_leap()).
+
+NumpyKappa stands in for the SpatialKappa gateway and NumpyKappaSim
+for a SpatialKappa sim, providing the methods that the Kappa class
+uses. NumpyKappaSimGroup provides the exchange() used for
+batch_exchange, advancing all the sims of a scheme at once.
+
+The flat subset consists of models in which every complex that can
+arise is written out in the file: every agent in a rule, %init or
+multi-agent %obs must give the state and binding of all its sites,
+and bonds may only be written with numbers. Single-agent %obs may use
+the wildcards ? and !_. Rate expressions may use numbers, variables,
++ - * / ^ and [exp], [log], [sin], [cos], [tan], [sqrt] and [pi], but
+not observables. Compartments, %mod, %plot and the like are not
+supported; loading a model that uses them raises a RuntimeError.
+"""
+
+import re
+import math
+import copy
+import pickle
+import itertools
+import numpy
+
+## Largest number of agents in a complex. Complexes are put in
+## canonical form by trying every ordering of their agents.
+_MAX_AGENTS = 6
+
+_AGENT_RE = re.compile(r"\s*([A-Za-z][\w+-]*)\s*\(([^()]*)\)\s*")
+_SITE_RE = re.compile(r"^([A-Za-z0-9][\w+-]*)(~[\w+-]+)?(!(\d+|_)|\?)?$")
+_DECL_SITE_RE = re.compile(r"^([A-Za-z0-9][\w+-]*)((~[\w+-]+)*)$")
+_RULE_RE = re.compile(r"^('[^']*')?\s*(.*?)\s*(<?->)\s*(.*?)\s*@\s*(.*)$")
+
+_FUNCTIONS = {'_exp': numpy.exp, '_log': numpy.log, '_sin': numpy.sin,
+              '_cos': numpy.cos, '_tan': numpy.tan, '_sqrt': numpy.sqrt,
+              '_pi': math.pi}
+
+
+class _Expression(object):
+    """An arithmetic expression in Kappa syntax."""
+    def __init__(self, text):
+        self.text = text
+        self.names = re.findall(r"'([^']*)'", text)
+        py = re.sub(r"'([^']*)'", lambda m: '_v(%r)' % (m.group(1)), text)
+        py = re.sub(r"\[(\w+)\]", r"_\1", py)
+        py = py.replace('^', '**')
+        rest = re.sub(r"_v\('[^']*'\)", '', py)
+        if set(re.findall(r"_\w+", rest)) - set(_FUNCTIONS) or \
+           not re.match(r"^[\d.eE+\-*/() ]*$", re.sub(r"_\w+", '', rest)):
+            raise ValueError('Unsupported expression %s' % (text))
+        self._code = compile(py, '<kappa>', 'eval')
+
+    def __getstate__(self):
+        return self.text
+
+    def __setstate__(self, text):
+        self.__init__(text)
+
+    def evaluate(self, lookup):
+        namespace = dict(_FUNCTIONS)
+        namespace['_v'] = lookup
+        namespace['__builtins__'] = {}
+        return float(eval(self._code, namespace))
+
+
+def _parse_pattern(text):
+    """Parse a Kappa pattern into a list of agents, each a tuple of the
+    agent name and a dictionary mapping site names to (state, bond).
+    state is None if not given; bond is None for a free site, a bond
+    number, '_' for bound to anything or '?' for don't care."""
+    agents = []
+    text = text.strip()
+    pos = 0
+    while pos < len(text):
+        m = _AGENT_RE.match(text, pos)
+        if not m:
+            raise ValueError('Cannot parse pattern %s' % (text))
+        name, site_text = m.group(1), m.group(2)
+        sites = {}
+        for site in [x.strip() for x in site_text.split(',') if x.strip()]:
+            sm = _SITE_RE.match(site)
+            if not sm:
+                raise ValueError('Unsupported site %s in pattern %s' % (site, text))
+            state = sm.group(2)[1:] if sm.group(2) else None
+            if sm.group(3) == '?':
+                bond = '?'
+            elif sm.group(4) == '_':
+                bond = '_'
+            elif sm.group(4):
+                bond = int(sm.group(4))
+            else:
+                bond = None
+            sites[sm.group(1)] = (state, bond)
+        agents.append((name, sites))
+        pos = m.end()
+        if pos < len(text):
+            if text[pos] != ',':
+                raise ValueError('Cannot parse pattern %s' % (text))
+            pos += 1
+    return agents
+
+
+def _pattern_from_dict(pattern):
+    """Convert a pattern given as a dictionary, as used by SpatialKappa,
+    into the form returned by _parse_pattern()."""
+    agents = []
+    for name, sites in pattern.items():
+        agent_sites = {}
+        for site, spec in sites.items():
+            link = spec.get('l')
+            if link is None:
+                bond = None
+            elif link in ('?', '_'):
+                bond = link
+            else:
+                bond = int(link)
+            agent_sites[site] = (spec.get('s'), bond)
+        agents.append((name, agent_sites))
+    return agents
+
+
+def _pattern_to_dict(agents):
+    """Inverse of _pattern_from_dict()."""
+    pattern = {}
+    for name, sites in agents:
+        pattern[name] = {}
+        for site, (state, bond) in sites.items():
+            spec = {}
+            if state is not None:
+                spec['s'] = state
+            if bond is not None:
+                spec['l'] = bond
+            pattern[name][site] = spec
+    return pattern
+
+
+def _split_complexes(agents):
+    """Split a list of agents into lists of agents joined by bonds."""
+    parent = list(range(len(agents)))
+    def find(i):
+        while parent[i] != i:
+            i = parent[i]
+        return i
+    ends = {}
+    for i, (name, sites) in enumerate(agents):
+        for state, bond in sites.values():
+            if isinstance(bond, int):
+                ends.setdefault(bond, []).append(i)
+    for bond, members in ends.items():
+        if len(members) != 2:
+            raise ValueError('Bond %d must join exactly two sites' % (bond))
+        parent[find(members[0])] = find(members[1])
+    groups = {}
+    for i in range(len(agents)):
+        groups.setdefault(find(i), []).append(agents[i])
+    return [groups[root] for root in sorted(groups)]
+
+
+def _canonical(agents):
+    """Return a hashable canonical form of a fully specified complex."""
+    if len(agents) > _MAX_AGENTS:
+        raise ValueError('Complexes of more than %d agents are not supported' % (_MAX_AGENTS))
+    best = None
+    for order in itertools.permutations(agents):
+        labels = {}
+        key = []
+        for name, sites in order:
+            agent_key = []
+            for site in sorted(sites):
+                state, bond = sites[site]
+                if bond is None:
+                    bond = 0
+                elif bond not in labels:
+                    labels[bond] = len(labels) + 1
+                    bond = labels[bond]
+                else:
+                    bond = labels[bond]
+                agent_key.append((site, state or '', bond))
+            key.append((name, tuple(agent_key)))
+        key = tuple(key)
+        if best is None or key < best:
+            best = key
+    return best
+
+
+def _render(species):
+    """Return a species in canonical form as a Kappa pattern."""
+    agents = []
+    for name, sites in species:
+        site_text = []
+        for site, state, bond in sites:
+            site_text.append(site + ('~' + state if state else '') + ('!%d' % (bond) if bond else ''))
+        agents.append('%s(%s)' % (name, ','.join(site_text)))
+    return ', '.join(agents)
+
+
+class _Rule(object):
+    def __init__(self, name, reactants, products, rate, lineno=None):
+        self.name = name
+        ## Line of the kappa file defining the rule, counting from 0
+        self.lineno = lineno
+        ## Dictionaries mapping species indices to multiplicities
+        self.reactants = reactants
+        self.products = products
+        self.rate = rate
+
+
+class _Model(object):
+    """A flat Kappa model as a reaction network."""
+    def __init__(self):
+        ## Agent name -> list of (site, list of states)
+        self.agents = {}
+        self.vars = {}
+        ## Observable name -> pattern
+        self.obs = {}
+        self.rules = []
+        self.species = []
+        self.species_index = {}
+        ## List of (species index, number)
+        self.inits = []
+        self._weights = {}
+
+    def add_species(self, key):
+        if key not in self.species_index:
+            self.species_index[key] = len(self.species)
+            self.species.append(key)
+            self._weights = {}
+        return self.species_index[key]
+
+    def complete(self, agents, fill):
+        """Check that every site of every agent is fully specified,
+        filling in missing sites with free sites in their default state
+        if fill is True."""
+        out = []
+        for name, sites in agents:
+            if name not in self.agents:
+                raise ValueError('Agent %s has not been declared' % (name))
+            sites = dict(sites)
+            for site, states in self.agents[name]:
+                if site not in sites:
+                    if not fill:
+                        raise ValueError('Site %s of agent %s must be given' % (site, name))
+                    sites[site] = (states[0] if states else None, None)
+                state, bond = sites[site]
+                if bond in ('?', '_'):
+                    raise ValueError('Wildcard bonds are not supported in agent %s' % (name))
+                if states and state is None:
+                    if not fill:
+                        raise ValueError('State of site %s of agent %s must be given' % (site, name))
+                    sites[site] = (states[0], bond)
+            out.append((name, sites))
+        return out
+
+    def species_of(self, agents, fill=False):
+        """Return a dictionary mapping the indices of the species in a
+        pattern to their multiplicities."""
+        counts = {}
+        for cx in _split_complexes(self.complete(agents, fill)):
+            i = self.add_species(_canonical(cx))
+            counts[i] = counts.get(i, 0) + 1
+        return counts
+
+    def add_obs(self, name, agents):
+        complexes = _split_complexes(agents)
+        if len(complexes) != 1:
+            raise ValueError('Observable %s must be a single complex' % (name))
+        if len(agents) > 1:
+            ## Register the complex so that it can be counted
+            self.species_of(agents)
+        self.obs[name] = agents
+        self._weights.pop(name, None)
+
+    def weights(self, name):
+        """Return the number of matches of observable name in each
+        species."""
+        if name not in self._weights:
+            agents = self.obs[name]
+            w = numpy.zeros(len(self.species))
+            if len(agents) > 1:
+                w[self.species_index[_canonical(self.complete(agents, False))]] = 1
+            else:
+                pname, psites = agents[0]
+                for i, species in enumerate(self.species):
+                    for name_s, sites in species:
+                        if name_s == pname and _matches(psites, dict((s, (st, b)) for s, st, b in sites)):
+                            w[i] += 1
+            self._weights[name] = w
+        return self._weights[name]
+
+
+def _matches(psites, sites):
+    """Return True if the sites of an agent match those of a pattern."""
+    for site, (pstate, pbond) in psites.items():
+        state, bond = sites[site]
+        if pstate is not None and pstate != state:
+            return False
+        if (pbond is None and bond) or (pbond == '_' and not bond):
+            return False
+    return True
+
+
+def _logical_lines(path):
+    """Return the lines of a Kappa file, without comments, joining
+    lines continued with a backslash, as (line number, line) pairs."""
+    lines = []
+    with open(path) as f:
+        physical = f.read().split('\n')
+    start, pending = 0, ''
+    for i, line in enumerate(physical):
+        if not pending:
+            start = i
+        if line.endswith('\\'):
+            pending += line[:-1] + ' '
+            continue
+        line = (pending + line).split('#')[0].strip()
+        pending = ''
+        if line:
+            lines.append((start, line))
+    return lines
+
+
+def _parse_file(path):
+    """Parse the Kappa file path into a _Model."""
+    model = _Model()
+    for lineno, line in _logical_lines(path):
+        try:
+            if line.startswith('%agent:'):
+                m = _AGENT_RE.match(line[len('%agent:'):])
+                if not m:
+                    raise ValueError('Cannot parse agent declaration')
+                sites = []
+                for site in [x.strip() for x in m.group(2).split(',') if x.strip()]:
+                    dm = _DECL_SITE_RE.match(site)
+                    if not dm:
+                        raise ValueError('Cannot parse site %s' % (site))
+                    sites.append((dm.group(1), [s for s in dm.group(2).split('~') if s]))
+                model.agents[m.group(1)] = sites
+            elif line.startswith('%var:'):
+                m = re.match(r"'([^']*)'\s+(.*)$", line[len('%var:'):].strip())
+                model.vars[m.group(1)] = _Expression(m.group(2))
+            elif line.startswith('%obs:'):
+                m = re.match(r"'([^']*)'\s+(.*)$", line[len('%obs:'):].strip())
+                model.add_obs(m.group(1), _parse_pattern(m.group(2)))
+            elif line.startswith('%init:'):
+                m = re.match(r"(\S+|'[^']*')\s+(.*)$", line[len('%init:'):].strip())
+                number = _Expression(m.group(1))
+                for i, mult in model.species_of(_parse_pattern(m.group(2)), fill=True).items():
+                    model.inits.append((i, (number, mult)))
+            elif line.startswith('%'):
+                raise ValueError('%s is not supported' % (line.split()[0]))
+            else:
+                m = _RULE_RE.match(line)
+                if not m:
+                    raise ValueError('Cannot parse rule')
+                name = m.group(1)[1:-1] if m.group(1) else 'rule %d' % (lineno + 1)
+                lhs = _parse_pattern(m.group(2)) if m.group(2) else []
+                rhs = _parse_pattern(m.group(4)) if m.group(4) else []
+                rates = [r.strip() for r in m.group(5).split(',')]
+                if m.group(3) == '<->':
+                    if len(rates) != 2:
+                        raise ValueError('Reversible rule needs two rates')
+                    model.rules.append(_Rule(name, model.species_of(lhs), model.species_of(rhs, True), _Expression(rates[0]), lineno))
+                    model.rules.append(_Rule(name + ' (reverse)', model.species_of(rhs), model.species_of(lhs, True), _Expression(rates[1]), lineno))
+                else:
+                    model.rules.append(_Rule(name, model.species_of(lhs), model.species_of(rhs, True), _Expression(rates[0]), lineno))
+        except (ValueError, AttributeError) as e:
+            raise RuntimeError('Error in kappa file %s, line %d: %s' % (path, lineno + 1, e))
+    return model
+
+
+def _network(rules, nspecies):
+    """Return the net change in each species for each rule, and the
+    terms of the mass action propensity of each rule as (species,
+    offset) pairs, so that a rule consuming two of species s has
+    propensity k*n_s*(n_s - 1)."""
+    stoich = numpy.zeros((len(rules), nspecies))
+    terms = []
+    for r, rule in enumerate(rules):
+        for s, m in rule.reactants.items():
+            stoich[r, s] -= m
+        for s, m in rule.products.items():
+            stoich[r, s] += m
+        terms.append([(s, i) for s, m in rule.reactants.items() for i in range(m)])
+    return stoich, terms
+
+
+def _propensities(c, rates, terms):
+    a = rates.copy()
+    for r, rule_terms in enumerate(terms):
+        for s, i in rule_terms:
+            a[:, r] *= numpy.maximum(c[:, s] - i, 0)
+    return a
+
+
+def _draw(rngs, rows, method, params=None):
+    """Return a random number from method of the generator of each of
+    rows, with the corresponding element of params as argument if
+    given. Each sim draws from its own generator, so that its
+    trajectory does not depend on the other sims run with it."""
+    if params is None:
+        return numpy.array([getattr(rngs[i], method)() for i in rows], dtype=float)
+    return numpy.array([getattr(rngs[i], method)(p) for i, p in zip(rows, params)])
+
+
+def _choose(a, a0, rngs, rows):
+    """Choose a reaction in each row of a, which belong to the sims
+    rows, with probability proportional to its propensity."""
+    target = (1.0 - _draw(rngs, rows, 'random_sample'))*a0
+    return numpy.minimum((numpy.cumsum(a, axis=1) < target[:, None]).sum(axis=1), a.shape[1] - 1)
+
+
+def _ssa(counts, rates, rules, t_end, rngs):
+    """Run Gillespie's direct method on every row of counts in place.
+
+    counts -- Array with one row per sim and one column per species.
+
+    rates -- Array of rate constants with one row per sim and one
+    column per rule.
+
+    rules -- List of _Rule objects.
+
+    t_end -- Time for which to run each sim, in the time units of the
+    rates; a scalar or an array with one element per sim.
+
+    rngs -- List of numpy RandomStates, one for each row of counts.
+    """
+    nsims = counts.shape[0]
+    if not rules or nsims == 0:
+        return
+    stoich, terms = _network(rules, counts.shape[1])
+    t_end = numpy.asarray(t_end, dtype=float)*numpy.ones(nsims)
+    t = numpy.zeros(nsims)
+    active = numpy.arange(nsims)
+    while active.size:
+        a = _propensities(counts[active], rates[active], terms)
+        a0 = a.sum(axis=1)
+        with numpy.errstate(divide='ignore'):
+            tau = numpy.where(a0 > 0, _draw(rngs, active, 'exponential')/a0, numpy.inf)
+        t_new = t[active] + tau
+        fire = t_new <= t_end[active]
+        active = active[fire]
+        if not active.size:
+            break
+        t[active] = t_new[fire]
+        counts[active] += stoich[_choose(a[fire], a0[fire], rngs, active)]
+
+
+## A reaction that could exhaust one of its reactants in fewer than
+## this many firings is critical, and is not leapt over
+_CRITICAL_FIRINGS = 10
+
+
+def _tau_leap(counts, rates, rules, t_end, rngs, tol):
+    """Run the tau-leaping method of Cao, Gillespie & Petzold (2006) on
+    every row of counts in place.
+
+    Reactions between species present in large numbers are fired in
+    Poisson-distributed batches over leaps whose length is chosen so
+    that no propensity is expected to change by more than a fraction
+    tol. Critical reactions, which could exhaust a species present in
+    small numbers, are simulated exactly, as are sims in which a leap
+    would be no longer than a few exact steps.
+
+    Arguments are as for _ssa(), and tol is the error-control
+    tolerance.
+    """
+    nsims = counts.shape[0]
+    if not rules or nsims == 0:
+        return
+    stoich, terms = _network(rules, counts.shape[1])
+    consumed = numpy.maximum(-stoich, 0)
+    ## Highest order of the reactions consuming each species
+    orders = numpy.array([len(rule_terms) for rule_terms in terms], dtype=float)
+    g = numpy.where(consumed > 0, orders[:, None], 0).max(axis=0)
+    t_end = numpy.asarray(t_end, dtype=float)*numpy.ones(nsims)
+    t = numpy.zeros(nsims)
+    ## Factor by which leaps are shortened after being rejected for
+    ## making a count negative
+    shrink = numpy.ones(nsims)
+    active = numpy.arange(nsims)
+    while active.size:
+        c = counts[active]
+        a = _propensities(c, rates[active], terms)
+        a0 = a.sum(axis=1)
+        remaining = t_end[active] - t[active]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            firings = numpy.where(consumed[None, :, :] > 0,
+                                  numpy.floor(c[:, None, :]/consumed[None, :, :]),
+                                  numpy.inf).min(axis=2)
+            critical = (firings < _CRITICAL_FIRINGS) & (a > 0)
+            a_leap = numpy.where(critical, 0.0, a)
+            mu = abs(numpy.dot(a_leap, stoich))
+            sigma2 = numpy.dot(a_leap, stoich**2)
+            bound = numpy.maximum(tol*c/numpy.where(g > 0, g, numpy.inf), 1.0)
+            tau1 = numpy.minimum(numpy.where(mu > 0, bound/mu, numpy.inf),
+                                 numpy.where(sigma2 > 0, bound**2/sigma2, numpy.inf))
+            tau1 = numpy.where(g > 0, tau1, numpy.inf).min(axis=1)*shrink[active]
+            exact = (a0 == 0) | (tau1 < 10.0/a0)
+
+        sims = active[exact]
+        if sims.size:
+            ae, a0e = a[exact], a0[exact]
+            with numpy.errstate(divide='ignore'):
+                tau = numpy.where(a0e > 0, _draw(rngs, sims, 'exponential')/a0e, numpy.inf)
+            fire = tau <= remaining[exact]
+            t[sims[~fire]] = t_end[sims[~fire]]
+            t[sims[fire]] += tau[fire]
+            counts[sims[fire]] += stoich[_choose(ae[fire], a0e[fire], rngs, sims[fire])]
+
+        leap = ~exact
+        sims = active[leap]
+        if sims.size:
+            a_crit = a[leap] - a_leap[leap]
+            a0_crit = a_crit.sum(axis=1)
+            with numpy.errstate(divide='ignore'):
+                tau2 = numpy.where(a0_crit > 0, _draw(rngs, sims, 'exponential')/a0_crit, numpy.inf)
+            tau = numpy.minimum(numpy.minimum(tau1[leap], tau2), remaining[leap])
+            dx = numpy.dot(_draw(rngs, sims, 'poisson', a_leap[leap]*tau[:, None]), stoich)
+            ## At most one critical reaction fires in a leap
+            crit = tau2 <= tau
+            if crit.any():
+                dx[crit] += stoich[_choose(a_crit[crit], a0_crit[crit], rngs, sims[crit])]
+            ok = (counts[sims] + dx >= 0).all(axis=1)
+            counts[sims[ok]] += dx[ok]
+            t[sims[ok]] += tau[ok]
+            shrink[sims[ok]] = 1.0
+            shrink[sims[~ok]] *= 0.5
+
+        active = active[t[active] < t_end[active]]
+
+
+def _advance(counts, rates, rules, t_end, rngs, tau_tol=None):
+    """Run the sims in counts with _ssa(), or with _tau_leap() if
+    tau_tol is given."""
+    if tau_tol is None:
+        _ssa(counts, rates, rules, t_end, rngs)
+    else:
+        _tau_leap(counts, rates, rules, t_end, rngs, tau_tol)
+
+
+class NumpyKappaSim(object):
+    """In-process counterpart of a SpatialKappa sim."""
+    def __init__(self, time_units='ms', verbose=False, seed=None, tau_tol=None):
+        ## Convert times in ms to the time units of the rates
+        self._time_factor = {'ms': 1.0, 's': 0.001}[time_units]
+        self._tau_tol = tau_tol
+        self._seed = seed
+        self._rng = numpy.random.RandomState(seed)
+        self._model = _Model()
+        ## Values of variables and transition rates set from Python
+        self._values = {}
+        self._init_overrides = {}
+        self._counts = numpy.zeros(0)
+        self._rates = numpy.zeros(0)
+        self._dirty = True
+        self._grouped = False
+        self._time = 0.0
+        self._initialised = False
+
+    def _ensure_arrays(self):
+        nspecies, nrules = len(self._model.species), len(self._model.rules)
+        if len(self._counts) != nspecies or len(self._rates) != nrules:
+            if self._grouped:
+                raise RuntimeError('Cannot add species or rules to a sim in a group')
+            counts = numpy.zeros(nspecies)
+            counts[:len(self._counts)] = self._counts
+            self._counts = counts
+            self._rates = numpy.zeros(nrules)
+            self._dirty = True
+
+    def _value(self, name):
+        if name in self._values:
+            return self._values[name]
+        if name in self._model.vars:
+            return self._model.vars[name].evaluate(self._value)
+        if name in self._model.obs:
+            raise RuntimeError('Variables that depend on observables, such as %s, are not supported' % (name))
+        raise RuntimeError('There is no variable called %s' % (name))
+
+    def _update_rates(self):
+        """Evaluate the rate constants of the rules in place."""
+        self._ensure_arrays()
+        if self._dirty:
+            for r, rule in enumerate(self._model.rules):
+                self._rates[r] = rule.rate.evaluate(self._value)
+            self._dirty = False
+
+    def loadFile(self, path):
+        self._model = _parse_file(path)
+        self._ensure_arrays()
+
+    def getAgentDeclaration(self, name):
+        if name not in self._model.agents:
+            raise RuntimeError('There is no agent called %s' % (name))
+        return dict((site, list(states)) for site, states in self._model.agents[name])
+
+    def addTransition(self, name, lhs, rhs, rate):
+        model = self._model
+        model.rules.append(_Rule(name, model.species_of(_pattern_from_dict(lhs)),
+                                 model.species_of(_pattern_from_dict(rhs), True),
+                                 _Expression("'%s'" % (name))))
+        self._values[name] = float(rate)
+        self._ensure_arrays()
+
+    def addVariable(self, name, value):
+        if isinstance(value, dict):
+            self._model.add_obs(name, _pattern_from_dict(value))
+            self._ensure_arrays()
+        else:
+            self.setTransitionRateOrVariable(name, value)
+
+    def setTransitionRateOrVariable(self, name, value):
+        self._values[name] = float(value)
+        self._dirty = True
+
+    def isVariable(self, name):
+        return name in self._values or name in self._model.vars or name in self._model.obs
+
+    def isAgent(self, name):
+        return name in self._model.agents
+
+    def getVariable(self, name):
+        if name in self._model.obs:
+            return float(numpy.dot(self._model.weights(name), self._counts))
+        return self._value(name)
+
+    def getVariableComplex(self, name):
+        return _pattern_to_dict(self._model.obs[name])
+
+    def agentList(self, pattern):
+        return pattern
+
+    def overrideInitialValue(self, pattern, number):
+        for i in self._model.species_of(_pattern_from_dict(pattern), True):
+            self._init_overrides[i] = float(number)
+        self._ensure_arrays()
+
+    def initialiseSim(self):
+        self._ensure_arrays()
+        self._counts[:] = 0
+        for i, (number, mult) in self._model.inits:
+            if i not in self._init_overrides:
+                self._counts[i] += round(number.evaluate(self._value))*mult
+        for i, number in self._init_overrides.items():
+            self._counts[i] = number
+        self._time = 0.0
+        self._initialised = True
+
+    def isInitialised(self):
+        return self._initialised
+
+    def runForTime(self, t, progress=False):
+        self._update_rates()
+        _advance(self._counts[None, :], self._rates[None, :], self._model.rules,
+                 float(t)*self._time_factor, [self._rng], self._tau_tol)
+        self._time += float(t)
+
+    def getTime(self):
+        return self._time
+
+    def getDebugOutput(self):
+        return '\n'.join('%s: %d' % (_render(s), n) for s, n in zip(self._model.species, self._counts))
+
+    def cloneSim(self, seed=None):
+        sim = NumpyKappaSim(verbose=False, seed=seed, tau_tol=self._tau_tol)
+        sim._time_factor = self._time_factor
+        sim._model = copy.deepcopy(self._model)
+        sim._values = dict(self._values)
+        sim._init_overrides = dict(self._init_overrides)
+        sim._counts = self._counts.copy()
+        sim._rates = self._rates.copy()
+        sim._time = self._time
+        sim._initialised = self._initialised
+        return sim
+
+    def saveModel(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump((self._model, self._values), f, 2)
+
+    def loadModel(self, path):
+        with open(path, 'rb') as f:
+            self._model, values = pickle.load(f)
+        self._values.update(values)
+        self._ensure_arrays()
+
+    def saveState(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump({'counts': self._counts.copy(), 'time': self._time,
+                         'values': self._values, 'rng': self._rng.get_state()}, f, 2)
+
+    def loadState(self, path):
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+        self._counts[:] = state['counts']
+        self._time = state['time']
+        self._values = state['values']
+        self._rng.set_state(state['rng'])
+        self._dirty = True
+
+
+class NumpyKappaSimGroup(object):
+    """The sims of one Kappa scheme, advanced together."""
+    def __init__(self, sims, create_names, total_names, obs_names):
+        self._sims = sims
+        model = sims[0]._model
+        for sim in sims:
+            sim._ensure_arrays()
+            if sim._model.species != model.species or len(sim._model.rules) != len(model.rules):
+                raise RuntimeError('The sims of a group must have the same model')
+        self._rules = model.rules
+        self._time_factor = sims[0]._time_factor
+        self._tau_tol = sims[0]._tau_tol
+        ## Each sim keeps drawing from its own generator, which is the
+        ## one saved with its state
+        self._rngs = [sim._rng for sim in sims]
+        ## Hold the counts and rates of all the sims in one array, and
+        ## make the arrays of each sim views of its row
+        self._counts = numpy.array([sim._counts for sim in sims])
+        self._rates = numpy.array([sim._rates for sim in sims])
+        for n, sim in enumerate(sims):
+            sim._counts = self._counts[n]
+            sim._rates = self._rates[n]
+            sim._grouped = True
+        rule_index = dict((rule.name, r) for r, rule in enumerate(self._rules))
+        self._create_names = create_names
+        self._create_rules = [rule_index[name] for name in create_names]
+        self._total_weights = _weight_matrix(model, total_names)
+        self._obs_weights = _weight_matrix(model, obs_names)
+        ## Whether rates need to be recalculated when V changes
+        self._v_dependent = any(_depends_on(model, rule.rate, 'V') for rule in self._rules)
+
+    def exchange(self, payload, dt):
+        """Set fluxes and membrane potentials, run every sim for dt and
+        return the net change in totals and the observables, in the
+        same format as KappaSimPool.exchange()."""
+        nmemb, nsims = len(self._create_names), len(self._sims)
+        x = numpy.frombuffer(payload, dtype='>f8').reshape((nmemb + 1, nsims))
+        for n, sim in enumerate(self._sims):
+            for j, name in enumerate(self._create_names):
+                sim._values[name] = float(x[j, n])
+            sim._values['V'] = float(x[nmemb, n])
+            if self._v_dependent:
+                sim._dirty = True
+            sim._update_rates()
+        ## The creation rates are set directly, so there is no need to
+        ## re-evaluate all the rates when only they have changed
+        self._rates[:, self._create_rules] = x[:nmemb].T
+        totals0 = numpy.dot(self._counts, self._total_weights.T)
+        _advance(self._counts, self._rates, self._rules, float(dt)*self._time_factor, self._rngs, self._tau_tol)
+        for sim in self._sims:
+            sim._time += float(dt)
+        delta = (numpy.dot(self._counts, self._total_weights.T) - totals0).T
+        obs = numpy.dot(self._counts, self._obs_weights.T).T
+        return numpy.concatenate((delta.ravel(), obs.ravel())).astype('>f8').tobytes()
+
+    def run_free(self, times):
+        """Run each sim for the corresponding time in times."""
+        for sim in self._sims:
+            sim._update_rates()
+        _advance(self._counts, self._rates, self._rules,
+                 numpy.asarray(times, dtype=float)*self._time_factor, self._rngs, self._tau_tol)
+        for sim, t in zip(self._sims, times):
+            sim._time += float(t)
+
+
+def _weight_matrix(model, names):
+    """Return an array whose rows are the weights of the observables
+    names in each species, with no rows if names is empty."""
+    weights = numpy.zeros((len(names), len(model.species)))
+    for j, name in enumerate(names):
+        weights[j] = model.weights(name)
+    return weights
+
+
+def _depends_on(model, expression, name):
+    """Return True if expression depends on variable name, directly or
+    through other variables."""
+    for ref in expression.names:
+        if ref == name or (ref in model.vars and _depends_on(model, model.vars[ref], name)):
+            return True
+    return False
+
+
+class NumpyKappa(object):
+    """In-process stand-in for the SpatialKappa gateway.
+
+    If tau_tol is given, the sims are run with tau-leaping with that
+    error-control tolerance rather than exactly.
+    """
+    def __init__(self, tau_tol=None):
+        self._tau_tol = tau_tol
+
+    def kappa_sim(self, time_units, verbose, seed=None):
+        return NumpyKappaSim(time_units, verbose, seed, self._tau_tol)
+
+    def kappa_sim_group(self, sims, create_names, total_names, obs_names):
+        return NumpyKappaSimGroup(sims, create_names, total_names, obs_names)
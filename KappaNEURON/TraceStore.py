@@ -0,0 +1,206 @@
+"""Store traces as raw columns that can be memory-mapped.
+
+numpy.load() of an .npz file reads, and decompresses, every array that
+is indexed into memory, which is slow or impossible for long runs. A
+trace store is instead a directory holding a JSON header, header.json,
+and one file per column of raw little-endian values with one row per
+sample. Columns are opened with numpy.memmap, so slicing a time window
+out of them only reads that window from disk.
+
+The header records the number of rows, the name of the column holding
+the time of each row, if any, and for each column its file, data type,
+the shape of each row and its units. It also holds a dictionary of
+attributes of the whole store, e.g. the names of the species and
+segments in the columns. The header is rewritten after each block of
+rows is appended, so a store being written can be read up to the last
+complete block.
+
+TraceWriter writes a store a block of rows at a time, and is used by
+KappaRecorder for paths ending in .traces. Since window() bisects the
+time column, the times written to a store must not decrease.
+write_traces() writes whole arrays, e.g. those recorded with h.Vector,
+at once. open_traces() opens a store for reading.
+"""
+
+import os
+import json
+
+import numpy
+
+HEADER = 'header.json'
+
+
+def _write_header(path, header):
+    ## Write to a temporary file first so that readers never see a
+    ## partly written header
+    tmp = os.path.join(path, HEADER + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(header, f, indent=1, sort_keys=True)
+    os.rename(tmp, os.path.join(path, HEADER))
+
+
+class TraceWriter(object):
+    def __init__(self, path, time=None, attrs=None):
+        """Create a trace store in the directory path, replacing the
+        columns of any store already there.
+
+        Keyword arguments:
+
+        path -- Directory of the store, created if necessary.
+
+        time -- Name of the column holding the time of each row.
+
+        attrs -- Dictionary of attributes of the store, which must be
+        serialisable as JSON.
+
+        """
+        self._path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._header = {'format': 'KappaNEURON traces',
+                        'version': 1,
+                        'length': 0,
+                        'time': time,
+                        'columns': [],
+                        'attrs': attrs or {}}
+        self._columns = {}
+
+    def add_column(self, name, shape=(), units=None, dtype='<f8'):
+        """Add a column called name whose rows are arrays of the given
+        shape, stored with the given little-endian numpy dtype."""
+        dtype = numpy.dtype(dtype).newbyteorder('<')
+        column = {'name': name,
+                  'file': '%s.bin' % (name),
+                  'dtype': dtype.str,
+                  'shape': list(shape),
+                  'units': units}
+        self._header['columns'].append(column)
+        self._columns[name] = column
+        open(os.path.join(self._path, column['file']), 'wb').close()
+        _write_header(self._path, self._header)
+
+    def write(self, rows):
+        """Append rows to every column.
+
+        rows -- Dictionary or list of (name, array) pairs, with an array
+        for every column with the same number of rows.
+
+        """
+        rows = dict(rows)
+        if set(rows) != set(self._columns):
+            raise Exception('Rows must be given for each of the columns %s' % (sorted(self._columns)))
+        n = None
+        for name, column in self._columns.items():
+            data = numpy.asarray(rows[name], dtype=column['dtype'])
+            if data.shape[1:] != tuple(column['shape']) or (n is not None and len(data) != n):
+                raise Exception('Rows of column %s have shape %s, not (%s,) + %s' % (name, data.shape, n, tuple(column['shape'])))
+            n = len(data)
+            with open(os.path.join(self._path, column['file']), 'ab') as f:
+                f.write(numpy.ascontiguousarray(data).tobytes())
+        self._header['length'] += n
+        _write_header(self._path, self._header)
+
+    def truncate(self):
+        """Discard every row written so far, keeping the columns."""
+        for column in self._columns.values():
+            open(os.path.join(self._path, column['file']), 'wb').close()
+        self._header['length'] = 0
+        _write_header(self._path, self._header)
+
+    def close(self):
+        _write_header(self._path, self._header)
+
+
+def write_traces(path, columns, units=None, time=None, attrs=None):
+    """Write whole traces to a trace store in the directory path.
+
+    Keyword arguments:
+
+    columns -- Dictionary or list of (name, array) pairs. Each array,
+    e.g. an h.Vector or a list, has one row per sample.
+
+    units -- Dictionary of the units of each column.
+
+    time -- Name of the column holding the time of each row.
+
+    attrs -- Dictionary of attributes of the store.
+
+    """
+    columns = [(name, numpy.asarray(data, dtype=float)) for name, data in
+               (columns.items() if isinstance(columns, dict) else columns)]
+    writer = TraceWriter(path, time, attrs)
+    for name, data in columns:
+        writer.add_column(name, data.shape[1:], (units or {}).get(name))
+    writer.write(columns)
+    writer.close()
+
+
+class TraceStore(object):
+    def __init__(self, path):
+        """Open the trace store in the directory path for reading.
+
+        Columns are indexed by name, e.g. store['t'], and are returned
+        as read-only numpy.memmap arrays, which are only read from disk
+        where they are accessed.
+        """
+        self._path = path
+        with open(os.path.join(path, HEADER)) as f:
+            self.header = json.load(f)
+        if self.header.get('format') != 'KappaNEURON traces':
+            raise Exception('%s is not a KappaNEURON trace store' % (path))
+        self.length = self.header['length']
+        self.attrs = self.header['attrs']
+        self.time = self.header['time']
+        self._columns = dict((column['name'], column) for column in self.header['columns'])
+        self._maps = {}
+
+    def keys(self):
+        return [column['name'] for column in self.header['columns']]
+
+    def __contains__(self, name):
+        return name in self._columns
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __getitem__(self, name):
+        if name not in self._maps:
+            column = self._columns[name]
+            shape = (self.length,) + tuple(column['shape'])
+            if self.length == 0:
+                ## Empty files cannot be mapped
+                self._maps[name] = numpy.empty(shape, dtype=column['dtype'])
+            else:
+                self._maps[name] = numpy.memmap(os.path.join(self._path, column['file']),
+                                                dtype=column['dtype'], mode='r', shape=shape)
+        return self._maps[name]
+
+    def units(self, name):
+        """Return the units of column name, or None if not given."""
+        return self._columns[name]['units']
+
+    def window(self, start=None, stop=None, time=None):
+        """Return a dictionary of the rows of each column whose times
+        lie from start up to, but not including, stop.
+
+        The rows are found by bisecting the time column, which must be
+        in increasing order, so only the pages holding the window are
+        read from disk.
+
+        Keyword arguments:
+
+        start, stop -- Bounds of the window. None means no bound.
+
+        time -- Name of the time column. Default is the one given when
+        the store was written.
+
+        """
+        t = self[time or self.time]
+        lo = 0 if start is None else int(numpy.searchsorted(t, start, 'left'))
+        hi = self.length if stop is None else int(numpy.searchsorted(t, stop, 'left'))
+        return dict((name, self[name][lo:hi]) for name in self.keys())
+
+
+def open_traces(path):
+    """Open the trace store in the directory path; see TraceStore."""
+    return TraceStore(path)
@@ -13,26 +13,211 @@ from neuron.rxd.generalizedReaction import GeneralizedReaction
 
 from neuron.rxd.multiCompartmentReaction import MultiCompartmentReaction
 import weakref
+import functools
+import threading
+import importlib
 import random
 import itertools
 
-import SpatialKappa
-from py4j.protocol import * 
-
-from scipy.stats import poisson
 import numpy
 import re
 import os, sys
 import warnings
+import logging
+import json
+import time
+import hashlib
+import shutil
+
+## These submodules have the names of the classes they export.
+## Importing a submodule binds it to its name on the package the first
+## time, which would hide a stand-in, or the class itself, bound there
+## before. They are therefore imported here, so that the classes are
+## bound after the submodules; with their bytecode cached they take a
+## couple of milliseconds to import.
+from KappaNEURON.NumpyKappa import NumpyKappa, NumpyKappaSimGroup
+from KappaNEURON.KappaRecorder import KappaRecorder, load_recording
+
+## Names exported from the other submodules, by submodule
+_lazy_names = {}
+
+def _lazy(module, attr):
+    """Return a function standing in for attr of the submodule module,
+    which imports the submodule when it is first called and then
+    replaces itself and the other names from the submodule by the real
+    objects, so that importing KappaNEURON does not import submodules
+    that are not used. Code that needs the object itself before using
+    it, e.g. to subclass it, should import it from the submodule.
+    attr must not be the name of a submodule, for the reason given
+    above."""
+    _lazy_names.setdefault(module, []).append(attr)
+    def load(*args, **kwargs):
+        mod = importlib.import_module('%s.%s' % (name, module))
+        for lazy_attr in _lazy_names[module]:
+            globals()[lazy_attr] = getattr(mod, lazy_attr)
+        return getattr(mod, attr)(*args, **kwargs)
+    load.__name__ = attr
+    load.__doc__ = 'See %s.%s.%s' % (name, module, attr)
+    return load
+
+kappa_to_rxd = _lazy('KappaToRxd', 'kappa_to_rxd')
+write_remaining_kappa = _lazy('KappaToRxd', 'write_remaining_kappa')
+TraceWriter = _lazy('TraceStore', 'TraceWriter')
+write_traces = _lazy('TraceStore', 'write_traces')
+open_traces = _lazy('TraceStore', 'open_traces')
 
 molecules_per_mM_um3 = constants.molecules_per_mM_um3()
 FARADAY = h.FARADAY
+## NEURON's variable-step integrator, created when first needed
+_cvode = None
+
+def _get_cvode():
+    global _cvode
+    if _cvode is None:
+        _cvode = h.CVode()
+    return _cvode
+
+## Debugging output. Messages are grouped by the phase of the
+## simulation in which they arise, each of which has its own logger,
+## e.g. logging.getLogger('KappaNEURON.advance'):
+##
+## init     -- creation and initialisation of Kappa sims
+## step     -- start of each fixed step, and the fluxes b
+## flux     -- fluxes and membrane potentials passed to Kappa
+## advance  -- running Kappa sims
+## readback -- net changes returned by Kappa and the resulting fluxes
+## states   -- rxd state vector before and after the update
+##
+## Setting verbose to True prints all messages, as in earlier versions.
 verbose = False
-def report(mess):
-    global verbose
-    if (verbose):
-        print(mess)
+_loggers = {}
+
+def _logger(phase):
+    if phase not in _loggers:
+        _loggers[phase] = logging.getLogger('%s.%s' % (name, phase))
+    return _loggers[phase]
+
+def _reporting(phase='general', level=logging.DEBUG):
+    """Return True if messages in phase at level would be reported."""
+    return verbose or _logger(phase).isEnabledFor(level)
+
+def report(mess, *args, **kwargs):
+    """Report a debugging message.
+
+    The message is only formatted, as mess % args, if it is going to
+    be reported, so arguments should be passed separately rather than
+    formatted by the caller.
+
+    Keyword arguments:
+
+    phase -- Phase of the simulation; see above. Default "general".
+
+    level -- Logging level. Default logging.DEBUG.
+
+    """
+    phase = kwargs.get('phase', 'general')
+    level = kwargs.get('level', logging.DEBUG)
+    if verbose:
+        print(mess % args if args else mess)
+    else:
+        log = _logger(phase)
+        if log.isEnabledFor(level):
+            log.log(level, mess, *args)
+
+## Instrumentation of the coupling loop. When switched on with
+## enable_stats(), _stats holds the cumulative wall time spent in each
+## phase of the fixed step, and the number of gateway calls made by
+## each Kappa scheme, per method.
+_stats = None
+
+def enable_stats(enable=True):
+    """Switch collection of timings and gateway call counts on or off.
+
+    Switching on resets any statistics collected so far. The
+    statistics can be read with stats() and saved with dump_stats().
+    """
+    global _stats
+    if enable:
+        _stats = {'time': {}, 'calls': {}, 'skipped': {}}
+    else:
+        _stats = None
+
+def stats():
+    """Return the statistics collected since enable_stats() was called.
+
+    The result is a dictionary with three entries:
+
+    time -- Cumulative wall time in seconds spent in each phase:
+    flux_push, kappa_advance, totals_readback, reaction_matrix_solve,
+    state_write_back and transfer_to_legacy. In pipelined mode the
+    Kappa phases overlap with the NEURON phases.
+
+    calls -- For each Kappa scheme, the number of gateway calls made
+    during the coupling loop, by method.
+
+    skipped -- For each Kappa scheme, the number of exchanges with its
+    sims that were skipped because the sim was quiescent; see the
+    skip_quiescent argument of Kappa.
+
+    Returns None if statistics are not being collected.
+    """
+    if _stats is None:
+        return None
+    return {'time': dict(_stats['time']),
+            'calls': dict((k, dict(c)) for k, c in _stats['calls'].items()),
+            'skipped': dict(_stats['skipped'])}
+
+def dump_stats(path):
+    """Write the statistics returned by stats() to path as JSON."""
+    with open(path, 'w') as f:
+        json.dump(stats(), f, indent=2, sort_keys=True)
+
+## Calls may be counted from several threads at once
+_count_lock = threading.Lock()
+
+def _count(k, method, n=1):
+    """Record n gateway calls to method by Kappa scheme k."""
+    if _stats is not None:
+        with _count_lock:
+            calls = _stats['calls'].setdefault(k._stats_name, {})
+            calls[method] = calls.get(method, 0) + n
+
+def _count_skipped(k):
+    """Record an exchange skipped by Kappa scheme k."""
+    if _stats is not None:
+        with _count_lock:
+            skipped = _stats['skipped']
+            skipped[k._stats_name] = skipped.get(k._stats_name, 0) + 1
+
+class _Timing(object):
+    """Context manager that adds the time spent in it to a phase."""
+    def __init__(self, phase):
+        self._phase = phase
+
+    def __enter__(self):
+        self._t0 = time.time()
+
+    def __exit__(self, *exc):
+        if _stats is not None:
+            times = _stats['time']
+            times[self._phase] = times.get(self._phase, 0.0) + time.time() - self._t0
+
+class _NoTiming(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+_no_timing = _NoTiming()
+
+def _timing(phase):
+    if _stats is None:
+        return _no_timing
+    return _Timing(phase)
+
 _kappa_schemes = []
+_kappa_scheme_count = 0
 
 progress = 1.0
 t_next_progress = 0.0
@@ -55,6 +240,421 @@ def _kn_init():
         if k is not None: k.re_init()
     t_next_progress = 0
 
+def _step_and_report(k, n, kappa_sim, dt):
+    """Run kappa_sim, the nth sim of scheme k, for dt and return the net
+    change in the total of each membrane species.
+
+    SpatialKappa has no call that runs a sim and reports the change in
+    its totals, so the totals are read after each run and those read at
+    the end of the previous step are reused as the starting totals.
+    For m membrane species this takes 1 + m gateway calls rather than
+    1 + 2m. Anything else that changes the numbers of molecules in the
+    sim must reset k._Stot[n] to None, as re_init(), run_free() and
+    load_state() do, so that the starting totals are read afresh.
+    """
+    Stot0 = k._Stot[n]
+    if Stot0 is None:
+        with _timing('totals_readback'):
+            Stot0 = numpy.array([kappa_sim.getVariable(name) for name in k._total_names])
+        _count(k, 'getVariable', len(k._total_names))
+    with _timing('kappa_advance'):
+        kappa_sim.runForTime(dt, False)
+    with _timing('totals_readback'):
+        Stot1 = numpy.array([kappa_sim.getVariable(name) for name in k._total_names])
+    _count(k, 'runForTime')
+    _count(k, 'getVariable', len(k._total_names))
+    report("Stot0 = %s, Stot1 = %s", Stot0, Stot1, phase='advance')
+    k._Stot[n] = Stot1
+    return Stot1 - Stot0
+
+def _load_cached_model(kappa_sim, path):
+    """Load the augmented model cached in path into kappa_sim. Return
+    False if it could not be loaded, in which case the kappa file should
+    be loaded instead."""
+    try:
+        kappa_sim.loadModel(path)
+    except Exception as e:
+        ## A stale or truncated entry is not fatal
+        warnings.warn('Could not load cached model %s: %s' % (path, e), UserWarning)
+        return False
+    return True
+
+def _save_cached_model(kappa_sim, path):
+    """Save the augmented model of kappa_sim to path. The model is
+    written to a temporary file that is then renamed, so that jobs
+    sharing the cache never see a partly written entry."""
+    cache_dir = os.path.dirname(path)
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                raise
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    kappa_sim.saveModel(tmp)
+    os.rename(tmp, path)
+    report("Saved model to cache %s", path, phase='init')
+
+## Attributes of a Kappa scheme that hold the state of its coupling to
+## NEURON, saved by Kappa.save_state()
+_coupling_state = ['_memb_flux_rate', '_spread_left', '_coupling_count',
+                   '_coupling_interval', '_b_acc', '_v_acc', '_t_acc',
+                   '_v_last', '_lag', '_idle_count', '_v_sleep',
+                   '_last_observed', '_catch_up_rate', '_catch_up_left']
+
+def _check_state_backend():
+    """Raise RuntimeError unless the state of the sims of every Kappa
+    scheme can be saved and loaded. SpatialKappa cannot save the state
+    of a sim, so this requires the numpy backend."""
+    for kptr in _kappa_schemes:
+        k = kptr()
+        if k._backend != 'numpy':
+            raise RuntimeError('Saving and loading state requires backend="numpy" in every Kappa scheme')
+
+def _save_kappa_state(path):
+    """Save the state of the sims and coupling of every Kappa scheme to
+    the directory path and return a header describing it."""
+    _check_state_backend()
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    header = {'version': 1, 'schemes': []}
+    for i, kptr in enumerate(_kappa_schemes):
+        k = kptr()
+        k._pipeline_wait()
+        header['schemes'].append({'kappa_file': os.path.basename(k._kappa_file),
+                                  'nsims': len(k._kappa_sims)})
+        for n, kappa_sim in enumerate(k._kappa_sims):
+            kappa_sim.saveState(os.path.join(path, 'scheme%d_sim%d.state' % (i, n)))
+        coupling = dict((name, numpy.asarray(getattr(k, name)))
+                        for name in _coupling_state
+                        if getattr(k, name) is not None)
+        numpy.savez(os.path.join(path, 'scheme%d.npz' % (i)), **coupling)
+    return header
+
+def _check_kappa_state(path, header):
+    """Check that the state in path was saved from the current schemes."""
+    _check_state_backend()
+    if len(header['schemes']) != len(_kappa_schemes):
+        raise RuntimeError('State in %s has %d Kappa schemes, but there are %d' % (path, len(header['schemes']), len(_kappa_schemes)))
+    for i, (kptr, saved) in enumerate(zip(_kappa_schemes, header['schemes'])):
+        k = kptr()
+        if saved['kappa_file'] != os.path.basename(k._kappa_file) \
+           or saved['nsims'] != len(k._kappa_sims):
+            raise RuntimeError('State of scheme %d in %s is for %d sims of %s, not %d sims of %s' % (i, path, saved['nsims'], saved['kappa_file'], len(k._kappa_sims), os.path.basename(k._kappa_file)))
+
+def _load_kappa_state(path, header):
+    """Restore the state of the sims and coupling of every Kappa scheme
+    saved by _save_kappa_state()."""
+    _check_kappa_state(path, header)
+    for i, kptr in enumerate(_kappa_schemes):
+        k = kptr()
+        k._pipeline_wait()
+        for n, kappa_sim in enumerate(k._kappa_sims):
+            kappa_sim.loadState(os.path.join(path, 'scheme%d_sim%d.state' % (i, n)))
+        coupling = numpy.load(os.path.join(path, 'scheme%d.npz' % (i)))
+        for name in _coupling_state:
+            value = coupling[name] if name in coupling.files else None
+            if value is not None and value.ndim == 0:
+                value = value.item()
+            setattr(k, name, value)
+        ## Totals are read afresh from the restored sims
+        k._Stot = [None]*len(k._kappa_sims)
+        if k._memb_flux_rate is not None:
+            for kappa_flux, rate in zip(k._kappa_fluxes, k._memb_flux_rate):
+                kappa_flux._memb_flux[:] = rate
+
+def _run_sims_free(t_run, threads=None):
+    """Run the sims of every Kappa scheme for t_run without exchanging
+    anything with NEURON.
+
+    The sims are independent while running free, so they are run
+    concurrently by a pool of threads, each of which has its own
+    connection to the gateway. Sims held by worker processes are run by
+    their workers, which run concurrently with each other, and sims of
+    the numpy backend are run together by their group.
+
+    Keyword arguments:
+
+    threads -- Number of threads. Default is the number of CPUs.
+    """
+    tasks = []
+    for kptr in _kappa_schemes:
+        k = kptr()
+        ## The result of a step still running in the background is
+        ## superseded by the free run
+        k._pipeline_wait()
+        ## Include any time that a quiescent sim is behind
+        times = [float(t_run + (0.0 if k._lag is None else k._lag[n]))
+                 for n in range(len(k._kappa_sims))]
+        if hasattr(k._sim_group, 'run_free'):
+            tasks.append((k._sim_group.run_free, (times,)))
+        else:
+            tasks.extend((kappa_sim.runForTime, (t, True))
+                         for kappa_sim, t in zip(k._kappa_sims, times))
+        k._lag = None
+        k._Stot = [None]*len(k._kappa_sims)
+
+    if threads is None:
+        import multiprocessing
+        threads = multiprocessing.cpu_count()
+    threads = min(threads, len(tasks))
+    if threads <= 1:
+        for f, args in tasks:
+            f(*args)
+        return
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(threads)
+    try:
+        pool.map(_call, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+def _call(task):
+    f, args = task
+    return f(*args)
+
+def _free_observables():
+    """Return the number of molecules of every species of every sim of
+    every Kappa scheme, as one flat array."""
+    observed = []
+    for kptr in _kappa_schemes:
+        k = kptr()
+        for kappa_sim in k._kappa_sims:
+            observed.extend([kappa_sim.getVariable(sptr().name) for sptr in k._involved_species])
+    return numpy.array(observed, dtype=float)
+
+def _steady(history, window, tol):
+    """Return True if the mean and variance of each column of history
+    over the last window rows are within tol of those over the window
+    before."""
+    old, new = history[-2*window:-window], history[-window:]
+    mean_old, mean_new = old.mean(axis=0), new.mean(axis=0)
+    var_old, var_new = old.var(axis=0), new.var(axis=0)
+    ## Compare relative to the magnitude of the means, so that
+    ## species present in small numbers are not held to an unreachable
+    ## absolute tolerance; a floor of one molecule avoids dividing by
+    ## zero for absent species
+    scale = numpy.maximum(numpy.maximum(abs(mean_old), abs(mean_new)), 1.0)
+    return numpy.all(abs(mean_new - mean_old) <= tol*scale) \
+        and numpy.all(abs(numpy.sqrt(var_new) - numpy.sqrt(var_old)) <= tol*scale)
+
+def _equilibration_key(*args):
+    """Return a hash identifying the configuration of every Kappa scheme
+    and the arguments of run_free(), args."""
+    volumes = nrr.node._get_data()[0]
+    states = nrr.node._get_states()
+    sha = hashlib.sha1()
+    sha.update(repr(args).encode('utf-8'))
+    for kptr in _kappa_schemes:
+        k = kptr()
+        with open(k._kappa_file, 'rb') as f:
+            sha.update(f.read())
+        sha.update(repr([s.name for s in k._membrane_species]).encode('utf-8'))
+        sha.update(repr(sorted(k._variables.items())).encode('utf-8'))
+        ## The restored sims continue the random number streams they
+        ## had when they were saved, so runs with different seeds must
+        ## not share an entry
+        sha.update(repr(k._seed).encode('utf-8'))
+        ## Volumes and initial concentrations determine the initial
+        ## numbers of molecules in each sim
+        sha.update(repr(['%.12g' % x for x in volumes[k._obs_indices].ravel()]).encode('utf-8'))
+        sha.update(repr(['%.12g' % x for x in states[k._obs_indices].ravel()]).encode('utf-8'))
+    return sha.hexdigest()
+
+def _sim_seed(seed, n):
+    """Return the seed for the nth sim of a scheme created with seed.
+
+    Each sim gets its own random number stream. The first sim uses seed
+    itself, so that single-segment results are unchanged.
+    """
+    if seed is None:
+        return None
+    return (seed + 0x9E3779B9*n) % 2**31
+
+def _kappa_advance(k, fluxes, v, dt):
+    """Pass fluxes and membrane potentials to the sims of Kappa scheme
+    k, run them for dt and return the net change in the total of each
+    membrane species and the value of each observable.
+
+    Keyword arguments:
+
+    fluxes -- Array with one row per membrane species and one column
+    per sim, giving the creation rate of the species in molecules/ms
+
+    v -- Membrane potential of each sim in mV
+
+    dt -- Time step
+
+    Returns DeltaStot and observed, where DeltaStot[j][n] is the net
+    change in membrane species j in sim n and observed[j][n] is the
+    number of involved species j in sim n.
+
+    If the scheme has a sim group (a NumpyKappaSimGroup, or a
+    KappaSimPool of workers or a server), the fluxes and membrane
+    potentials are packed into one buffer of big-endian doubles, laid
+    out as [flux of species 0 in sims 0..n-1, ..., V in sims 0..n-1].
+    The group sets them, runs each sim for dt and returns one buffer
+    laid out as [DeltaStot of species 0 in sims 0..n-1, ...,
+    observable of involved species 0 in sims 0..n-1, ...].
+
+    Otherwise the variables of each sim are exchanged one by one by
+    _advance_sim(). SpatialKappa has no call that reaches several
+    sims, so with batch_exchange these calls are made for all the
+    sims at once from a pool of threads, each of which has its own
+    connection to the gateway. The number of calls is the same, but
+    their round trips overlap.
+    """
+    nsims = len(k._kappa_sims)
+    nmemb = len(k._membrane_species)
+
+    if k._sim_group is not None:
+        ## Run all sims and read back totals and observables in one call
+        payload = numpy.empty((nmemb + 1, nsims))
+        payload[:nmemb] = fluxes
+        payload[nmemb] = v
+        with _timing('kappa_advance'):
+            out = k._sim_group.exchange(bytearray(payload.astype('>f8').tobytes()), float(dt))
+        _count(k, 'exchange')
+        out = numpy.frombuffer(out, dtype='>f8')
+        return out[:nmemb*nsims].reshape((nmemb, nsims)), \
+            out[nmemb*nsims:].reshape((len(k._involved_species), nsims))
+
+    nobs = len(k._involved_species)
+    if k._skip_quiescent and k._lag is None:
+        k._lag = numpy.zeros(nsims)
+        k._idle_count = numpy.zeros(nsims, dtype=int)
+        k._v_sleep = numpy.zeros(nsims)
+        k._last_observed = numpy.empty((nobs, nsims))
+        k._last_observed.fill(numpy.nan)
+        k._catch_up_rate = numpy.zeros((nmemb, nsims))
+        k._catch_up_left = numpy.zeros(nsims)
+    DeltaStot = numpy.zeros((nmemb, nsims))
+    observed = numpy.empty((nobs, nsims))
+    if k._exchange_pool is not None:
+        ## Overlap the round trips to the gateway of the sims
+        k._exchange_pool.map(_call, [(_advance_sim, (k, n, fluxes, v, dt, DeltaStot, observed))
+                                     for n in range(nsims)])
+    else:
+        for n in range(nsims):
+            _advance_sim(k, n, fluxes, v, dt, DeltaStot, observed)
+    k._last_observed = observed
+    return DeltaStot, observed
+
+def _advance_sim(k, n, fluxes, v, dt, DeltaStot, observed):
+    """Exchange variables with the nth sim of Kappa scheme k one by one
+    and run it for dt, as described for _kappa_advance(), writing its
+    results into column n of DeltaStot and observed."""
+    kappa_sim = k._kappa_sims[n]
+    if k._skip_quiescent:
+        ## A sim that has been quiet for long enough, with no
+        ## inbound flux, sleeps until something happens or it has
+        ## slept for max_skip_time. It then catches up in one run,
+        ## with the inputs it had when it went to sleep.
+        if not numpy.any(fluxes[:, n]) \
+           and k._idle_count[n] >= k._quiescent_steps \
+           and k._lag[n] + dt < k._max_skip_time \
+           and abs(v[n] - k._v_sleep[n]) <= k._v_tol:
+            k._lag[n] += dt
+            observed[:, n] = k._last_observed[:, n]
+            _count_skipped(k)
+            _catch_up(k, n, dt, DeltaStot)
+            return
+        if k._lag[n] > 0:
+            report("Catching up sim %d by %f", n, k._lag[n], phase='advance')
+            ## The net change during the catch-up is passed back at a
+            ## constant rate over as long as the sim slept, rather
+            ## than all at once, which would give a pulse of current
+            change = _step_and_report(k, n, kappa_sim, k._lag[n])
+            left = k._catch_up_left[n]
+            k._catch_up_left[n] = max(left, k._lag[n])
+            k._catch_up_rate[:, n] = (k._catch_up_rate[:, n]*left + change)/k._catch_up_left[n]
+            k._lag[n] = 0
+
+    with _timing('flux_push'):
+        for s, flux_n in zip(k._membrane_species, fluxes[:, n]):
+            kappa_sim.setTransitionRateOrVariable('Create %s' % (s.name), float(flux_n))
+            report("Sim %d: setting %s flux to %f", n, s.name, flux_n, phase='flux')
+        report("Sim %d: setting V = %f", n, v[n], phase='flux')
+        kappa_sim.setTransitionRateOrVariable("V", float(v[n]))
+    _count(k, 'setTransitionRateOrVariable', len(k._membrane_species) + 1)
+
+    DeltaStot[:, n] += _step_and_report(k, n, kappa_sim, dt)
+    if _reporting('advance'):
+        report("Sim %d: kappa time now %f", n, kappa_sim.getTime(), phase='advance')
+    with _timing('totals_readback'):
+        observed[:, n] = [kappa_sim.getVariable(sptr().name) for sptr in k._involved_species]
+    _count(k, 'getVariable', len(k._involved_species))
+
+    if k._skip_quiescent:
+        if not numpy.any(fluxes[:, n]) and not numpy.any(DeltaStot[:, n]) \
+           and numpy.array_equal(observed[:, n], k._last_observed[:, n]):
+            k._idle_count[n] += 1
+        else:
+            k._idle_count[n] = 0
+        k._v_sleep[n] = v[n]
+        _catch_up(k, n, dt, DeltaStot)
+
+def _catch_up(k, n, dt, DeltaStot):
+    """Add the part of the net change from the last catch-up of the nth
+    sim of Kappa scheme k that falls in the next dt to DeltaStot."""
+    left = k._catch_up_left[n]
+    if left > 0:
+        frac = min(left, dt)
+        DeltaStot[:, n] += k._catch_up_rate[:, n]*frac
+        k._catch_up_left[n] = left - frac
+
+def _spread_memb_flux(k, dt):
+    """Set the membrane flux of each KappaFlux of Kappa scheme k for the
+    next step, between exchanges with Kappa.
+
+    The membrane flux computed at an exchange is a rate that is
+    applied for the length of the interval that Kappa has just
+    simulated. Once that time has been used up, the membrane flux is
+    zero until the next exchange.
+    """
+    frac = max(0.0, min(k._spread_left, dt))/dt
+    k._spread_left -= frac*dt
+    for f, rate in zip(k._kappa_fluxes, k._memb_flux_rate):
+        numpy.multiply(rate, frac, out=f._memb_flux)
+
+def _coupling_active(k, b0, v):
+    """Return True if the flux or membrane potential in Kappa scheme k
+    has changed enough since the last exchange that the adaptive
+    coupling interval should snap back to one step."""
+    if b0.size and numpy.max(numpy.abs(b0)) >= k._flux_tol:
+        return True
+    if k._v_last is not None and v.size and numpy.max(numpy.abs(v - k._v_last)) > k._v_tol:
+        return True
+    return False
+
+def _event_awake(k, dt):
+    """Return True if Kappa scheme k is handling an event in the step
+    from t to t + dt, i.e. if the step overlaps the window after a
+    NetCon event or a threshold crossing."""
+    t = nrr.h.t
+    for threshold in k._thresholds:
+        value = threshold[0][0]
+        last = threshold[2]
+        if last is not None and (last - threshold[1])*(value - threshold[1]) < 0:
+            k._event_windows.append((t, t + k._event_window))
+        threshold[2] = value
+    k._event_windows = [w for w in k._event_windows if w[1] >= t]
+    return any(start <= t + dt for start, end in k._event_windows)
+
+def _netcon_event(kref, netcon):
+    """Wake Kappa scheme kref() when the event from netcon arrives, and
+    tell its recorders."""
+    k = kref()
+    if k is not None:
+        t = nrr.h.t + netcon.delay
+        if k._event_driven:
+            k._event_windows.append((t, t + k._event_window))
+        for rref in k._recorders:
+            rec = rref()
+            if rec is not None:
+                rec._trigger(t)
+
 def _run_kappa_continuous(states, b, dt):
     global _kappa_schemes
     #############################################################################
@@ -67,112 +667,151 @@ def _run_kappa_continuous(states, b, dt):
 
     ## Go through each kappa scheme. The region belonging to each
     ## kappa scheme should not overlap with any other kappa scheme's
-    ## region.
-    volumes = nrr.node._get_data()[0]
+    ## region. The index and conversion arrays used here are set up
+    ## by Kappa._update_exchange_arrays().
     for kptr in _kappa_schemes:
         k = kptr()
-        report("\nPASSING FLUXES TO KAPPA")
-        for s in k._membrane_species:
-            report("ION: %s" % (s.name))
-            for kappa_sim, i in zip(k._kappa_sims, k._indices_dict[s]):
-                ## Number of ions
-                ## Flux b has units of mM/ms
-                ## Volumes has units of um3
-                ## _conversion factor has units of molecules mM^-1 um^-3
-                flux = b[i] * molecules_per_mM_um3 * volumes[i]
-                kappa_sim.setTransitionRateOrVariable('Create %s' % (s.name), flux)
-                report("Setting %s flux[%d] to b[%d]*NA*vol[%d] = %f*%f*%f = %f" % (s.name, i, i, i,  b[i], molecules_per_mM_um3, volumes[i], flux))
-
-        report("PASSING MEMBRANE POTENTIAL TO KAPPA")
-        for kappa_sim, v_ptr in zip(k._kappa_sims, k._v_ptrs):
-            report("Setting V = %f" % (v_ptr[0]))
-            kappa_sim.setTransitionRateOrVariable("V", float(v_ptr[0]))
-
+        ## Accumulate fluxes and membrane potentials over the
+        ## coupling interval. Between exchanges NEURON integrates the
+        ## fluxes as they are, and the membrane flux computed at the
+        ## last exchange is spread over the steps.
+        b0 = b[k._memb_indices]
+        v = numpy.fromiter((v_ptr[0] for v_ptr in k._v_ptrs), float, len(k._v_ptrs))
+        k._b_acc += b0*dt
+        k._v_acc += v*dt
+        k._t_acc += dt
+        k._coupling_count += 1
+        if k._adaptive_coupling and _coupling_active(k, b0, v):
+            ## Exchange now, and at every step until things are quiet again
+            k._coupling_interval = k._coupling_count
+        if k._event_driven:
+            ## Exchange at every step while an event is being handled,
+            ## and otherwise let the sims run free until the next
+            ## event or the end of the run
+            if _event_awake(k, dt) or nrr.h.t + 1.5*dt > neuron.h.tstop \
+               or (k._max_event_interval is not None and k._t_acc >= k._max_event_interval):
+                k._coupling_interval = k._coupling_count
+            else:
+                k._coupling_interval = sys.maxsize
+        if k._coupling_count < k._coupling_interval:
+            _spread_memb_flux(k, dt)
+            k._observed = None
+            continue
+
+        ## Mean fluxes and membrane potentials over the interval
+        nsteps = k._coupling_count
+        dt_k = k._t_acc
+        k._v_last = v
+        b0 = k._b_acc/dt_k
+        v = k._v_acc/dt_k
+        k._b_acc.fill(0.0)
+        k._v_acc.fill(0.0)
+        k._t_acc = 0.0
+        k._coupling_count = 0
+
+        ## Number of ions
+        ## Flux b has units of mM/ms
+        ## Volumes has units of um3
+        ## _memb_conv has units of molecules mM^-1, being the
+        ## volume multiplied by molecules_per_mM_um3
+        fluxes = b0*k._memb_conv
 
         #############################################################################
         ## 2. Run the rule-based simulator from t to t + dt
         #############################################################################
+        if k._pipeline:
+            ## Start this step in the background and carry on with
+            ## the result of the previous step
+            result = k._pipeline_wait()
+            k._pending = k._pipeline_pool.apply_async(_kappa_advance, (k, fluxes, v, dt_k))
+            k._pending_inputs = (b0, dt_k)
+            k._observed = None
+            if result is None:
+                k._memb_flux_rate.fill(0.0)
+                for f in k._kappa_fluxes:
+                    f._memb_flux.fill(0.0)
+                continue
+            (DeltaStot, k._observed), (b0, dt_k) = result
+        else:
+            DeltaStot, k._observed = _kappa_advance(k, fluxes, v, dt_k)
+
         #############################################################################
         ## 3. Compute the net change Delta Stot in the number of each
         ## bridging species S and convert back into a current.
         #############################################################################
+        bnew = DeltaStot/(dt_k*k._memb_conv)
+
         #############################################################################
         ## 4. Set the corresponding elements of the flux to the
-        ## currents computed in step 3
+        ## currents computed in step 3. As _memb_flux is a rate, it
+        ## is spread evenly over an interval of the length that Kappa
+        ## has just simulated. Any part of the previous correction
+        ## that has not yet been applied is added on.
         #############################################################################
-
-        for kptr in _kappa_schemes:
-            k = kptr()
-
-            ## Recording total starting value of each species
-            Stot0 = {}
-            for f in k._kappa_fluxes:
-                for sptr in f._sources:
-                    s = sptr()._species()
-                    Stot0[s.name] = {}
-                    for kappa_sim, i in zip(k._kappa_sims, k._indices_dict[s]):
-                        Stot0[s.name][i] = kappa_sim.getVariable('Total %s' % (s.name))
-                        report("Stot0[%s][%d] = %f" % (s.name, i, Stot0[s.name][i]))
-
-            report("RUN 1 KAPPA STEP")  
-            for kappa_sim in k._kappa_sims:
-                kappa_sim.runForTime(dt, False)     
-                t_kappa = kappa_sim.getTime()
-                report("kappa time now %f" % (t_kappa))
-
-            ## Recording total ending value of each membrane species
-            for f in k._kappa_fluxes:
-                f._memb_flux = []
-                for sptr in f._sources:
-                    s = sptr()._species()
-                    for kappa_sim, i in zip(k._kappa_sims, k._indices_dict[s]):
-                        ## For ions, compute the current
-                        Stot1 = kappa_sim.getVariable('Total %s' % (s.name))
-                        report("Stot1[%s][%d] = %f" % (s.name, i, Stot1))
-                        DeltaStot = Stot1 - Stot0[s.name][i]
-                        bnew = DeltaStot/(dt*molecules_per_mM_um3*volumes[i])
-                        f._memb_flux.append(-(bnew - b[i]))
-                        report("Species %s: DeltaStot=%d, bnew=%f, b=%f, _memb_flux=%f" % (s.name, DeltaStot, bnew, b[i], f._memb_flux[-1]))
-                        b[i] = bnew
+        if k._spread_left > 0:
+            k._memb_flux_rate *= k._spread_left/dt_k
+        else:
+            k._memb_flux_rate.fill(0.0)
+        k._memb_flux_rate -= bnew - b0
+        for f, rate in zip(k._kappa_fluxes, k._memb_flux_rate):
+            f._memb_flux[:] = rate
+        b[k._memb_indices] = bnew
+        k._spread_left = dt_k - dt
+        report("DeltaStot=%s, bnew=%s, b=%s, _memb_flux=%s", DeltaStot, bnew, b0, k._memb_flux_rate, phase='readback')
+
+        ## Widen the adaptive coupling interval while fluxes and
+        ## changes in Kappa are small
+        if k._adaptive_coupling:
+            quiet = DeltaStot.size == 0 or numpy.max(numpy.abs(DeltaStot)) < k._delta_tol*nsteps
+            if quiet and not _coupling_active(k, b0, v):
+                k._coupling_interval = min(2*k._coupling_interval, k._max_coupling_interval)
+            else:
+                k._coupling_interval = 1
         
-        report("States before update")
-        report(states)
+    report("States before update\n%s", states, phase='states')
         
-        #############################################################################
-        ## 5. Update the continuous variables according to the update step
-        #############################################################################
+    #############################################################################
+    ## 5. Update the continuous variables according to the update step
+    #############################################################################
+    with _timing('reaction_matrix_solve'):
         states[:] += nrr._reaction_matrix_solve(dt, states, nrr._diffusion_matrix_solve(dt, dt * b))
-        report("States after continuous update")
-        report(states)
+    report("States after continuous update\n%s", states, phase='states')
 
-        #############################################################################
-        ## 6. Voltage step overrides states, possibly making them negative so put back actual states
-        #############################################################################
+    #############################################################################
+    ## 6. Voltage step overrides states, possibly making them negative so put back actual states
+    #############################################################################
+    with _timing('state_write_back'):
         for kptr in _kappa_schemes:
             k = kptr()
-            ## Recording total ending value of each species
-            for sptr in k._involved_species:
-                s = sptr()
-                for kappa_sim, i in zip(k._kappa_sims, k._indices_dict[s]):
-                    ## Update concentration
-                    states[i] = kappa_sim.getVariable(s.name) \
-                                /(molecules_per_mM_um3 * volumes[i])
-        report("States after kappa update")
-        report(states)
+            if k._observed is None:
+                continue
+            ## Update concentrations from total ending value of each species
+            states[k._obs_indices] = k._observed/k._obs_conv
+    report("States after kappa update\n%s", states, phase='states')
 
     return states
 
 
+def _record_step(t, schemes=None):
+    """Pass the end of a step of the coupling loop at time t to the
+    recorders of each Kappa scheme in schemes, by default all."""
+    for kptr in (_kappa_schemes if schemes is None else schemes):
+        k = kptr()
+        if k is None:
+            continue
+        for rref in k._recorders:
+            rec = rref()
+            if rec is not None:
+                rec._step(t)
+
 ## Override the NEURON nonvint _fixed_step_solve callback   
 def _kn_fixed_step_solve(raw_dt):
     nrr.initializer._do_init()
     global _kappa_schemes
     global progress, t_next_progress
 
-    report("")
-    report("---------------------------------------------------------------------------")
-    report("FIXED STEP SOLVE. NEURON time %f" % nrr.h.t)
-    report("states")
+    report("\n---------------------------------------------------------------------------\n"
+           "FIXED STEP SOLVE. NEURON time %f", nrr.h.t, phase='step')
 
     # allow for skipping certain fixed steps
     # warning: this risks numerical errors!
@@ -186,16 +825,15 @@ def _kn_fixed_step_solve(raw_dt):
 
     ## states is a reference to rxd.node._states
     states = nrr._node_get_states()[:]
-    report(states)
+    report("states\n%s", states, phase='step')
 
-    report("flux b")
     ## DCS: This gets fluxes (from ica, ik etc) and computes changes
     ## due to reactions
 
     ## DCS FIXME: This is different from the old rxd.py file - need check what
     ## the difference is
     b = nrr._rxd_reaction(states) - nrr._diffusion_matrix * states
-    report(b)
+    report("flux b\n%s", b, phase='step')
     
     if not nrr.species._has_3d:
         states = _run_kappa_continuous(states, b, dt)
@@ -208,7 +846,8 @@ def _kn_fixed_step_solve(raw_dt):
         # NEURON solver
         # TODO: refactor so this isn't in section1d...
         # probably belongs in node
-        nrr._section1d_transfer_to_legacy()
+        with _timing('transfer_to_legacy'):
+            nrr._section1d_transfer_to_legacy()
     else:
         # the actual advance via implicit euler
         n = len(states)
@@ -224,6 +863,8 @@ def _kn_fixed_step_solve(raw_dt):
     
     t = nrr.h.t + dt
 
+    _record_step(t)
+
     if progress:
         if t + dt >= t_next_progress:
             sys.stdout.write("\rTime = %12.5f/%5.5f [%3.3f%%]" % (t, neuron.h.tstop, t/neuron.h.tstop*100))
@@ -234,30 +875,120 @@ def _kn_fixed_step_solve(raw_dt):
     sys.stdout.flush()
 
 
-nrr._callbacks[4] = _kn_fixed_step_solve
-_fih3 = neuron.h.FInitializeHandler(2, _kn_init)
-
-## FIXME: The next two lines are needed as a workaround, because of
-## bug in the production version of NEURON from 2015-11-09. The diff
-## below shows what the code should be.
-#
-# diff -u -x '*.pyc' -r 7.4-2015-11-09/lib64/python/neuron/rxd/rxd.py 7.4/lib64/python/neuron/rxd/rxd.py
-# --- 7.4-2015-11-09/lib64/python/neuron/rxd/rxd.py	2018-09-12 14:36:58.558292264 +0100
-# +++ 7.4/lib64/python/neuron/rxd/rxd.py	2018-08-14 16:27:53.828204184 +0100
-# @@ -899,7 +899,7 @@
-#  _has_nbs_registered = False
-#  _nbs = None
-#  def _do_nbs_register():
-# -    global _has_nbs_registered, _nbs
-# +    global _has_nbs_registered, _nbs, _fih, _fih2
+def _cvode_exchange(kref):
+    """Exchange variables between NEURON and the sims of a Kappa scheme
+    under variable-step integration.
+
+    CVODE integrates the continuous part of the model, so that the
+    membrane fluxes accumulate in the concentrations of the membrane
+    species. At each exchange point the mean flux since the last one is
+    passed to Kappa, the sims are advanced over the interval, the
+    concentrations are set from the sims and the discontinuity is
+    signalled to CVODE by reinitialising it.
+    """
+    k = kref()
+    if k is None or not _get_cvode().active():
+        return
+    dt_k = h.t - k._cvode_t_last
+    if dt_k > 0:
+        states = nrr.node._get_states()
+        b0 = (states[k._memb_indices] - k._cvode_memb_last)/dt_k
+        v = numpy.fromiter((v_ptr[0] for v_ptr in k._v_ptrs), float, len(k._v_ptrs))
+        DeltaStot, observed = _kappa_advance(k, b0*k._memb_conv, v, dt_k)
+        ## As for the fixed step, the difference between the flux
+        ## passed to Kappa and the flux it produced is applied as a
+        ## membrane flux until the next exchange
+        bnew = DeltaStot/(dt_k*k._memb_conv)
+        k._memb_flux_rate[:] = b0 - bnew
+        for f, rate in zip(k._kappa_fluxes, k._memb_flux_rate):
+            f._memb_flux[:] = rate
+        states[k._obs_indices] = observed/k._obs_conv
+        nrr._section1d_transfer_to_legacy()
+        _get_cvode().re_init()
+        report("CVODE exchange at t = %f after %f ms", h.t, dt_k, phase='step')
+        _record_step(h.t, [kref])
+    k._cvode_t_last = h.t
+    k._cvode_memb_last = nrr.node._get_states()[k._memb_indices].copy()
+    _get_cvode().event(h.t + k._cvode_interval, k._cvode_callback)
+
+def _kn_cvode_init():
+    """Schedule the first exchange of each Kappa scheme, if CVODE is
+    active."""
+    if not _get_cvode().active():
+        return
+    for kptr in _kappa_schemes:
+        k = kptr()
+        if k is None:
+            continue
+        k._cvode_t_last = h.t
+        k._cvode_memb_last = nrr.node._get_states()[k._memb_indices].copy()
+        k._cvode_callback = functools.partial(_cvode_exchange, kptr)
+        _get_cvode().event(h.t + k._cvode_interval, k._cvode_callback)
+
+## The handlers below are only installed when the first Kappa scheme
+## is created, so that importing this module does not change how
+## NEURON runs models without Kappa schemes
+_fih = _fih2 = _fih3 = _fih4 = None
+
+def _install_handlers():
+    """Hook KappaNEURON into rxd and NEURON's initialisation, if not
+    already done."""
+    global _fih, _fih2, _fih3, _fih4
+    if _fih3 is not None:
+        return
+    nrr._callbacks[4] = _kn_fixed_step_solve
+    _fih3 = neuron.h.FInitializeHandler(2, _kn_init)
+    ## Events can only be scheduled at the end of initialisation
+    _fih4 = neuron.h.FInitializeHandler(3, _kn_cvode_init)
+
+    ## FIXME: The next two lines are needed as a workaround, because of
+    ## bug in the production version of NEURON from 2015-11-09. The diff
+    ## below shows what the code should be.
+    #
+    # diff -u -x '*.pyc' -r 7.4-2015-11-09/lib64/python/neuron/rxd/rxd.py 7.4/lib64/python/neuron/rxd/rxd.py
+    # --- 7.4-2015-11-09/lib64/python/neuron/rxd/rxd.py	2018-09-12 14:36:58.558292264 +0100
+    # +++ 7.4/lib64/python/neuron/rxd/rxd.py	2018-08-14 16:27:53.828204184 +0100
+    # @@ -899,7 +899,7 @@
+    #  _has_nbs_registered = False
+    #  _nbs = None
+    #  def _do_nbs_register():
+    # -    global _has_nbs_registered, _nbs
+    # +    global _has_nbs_registered, _nbs, _fih, _fih2
      
-#      if not _has_nbs_registered:
-#          from neuron import nonvint_block_supervisor as _nbs
-_fih = h.FInitializeHandler(nrr._init)
-_fih2 = h.FInitializeHandler(3, nrr.initializer._do_ion_register)
-
+    #      if not _has_nbs_registered:
+    #          from neuron import nonvint_block_supervisor as _nbs
+    _fih = h.FInitializeHandler(nrr._init)
+    _fih2 = h.FInitializeHandler(3, nrr.initializer._do_ion_register)
+
+## SpatialKappa and py4j are only imported, and Java only started,
+## when the first SpatialKappa sims are created; see _get_gateway().
+## Until then no py4j exception can be raised, so the exception names
+## are bound to a class that nothing raises.
+class _NoPy4JError(Exception):
+    pass
+
+SpatialKappa = None
+Py4JError = _NoPy4JError
+Py4JJavaError = _NoPy4JError
 gateway = None
 
+def _import_spatialkappa():
+    """Import SpatialKappa and the py4j names used by this module, if
+    not already imported."""
+    global SpatialKappa, Py4JError, Py4JJavaError
+    if SpatialKappa is None:
+        import SpatialKappa
+        from py4j.protocol import Py4JError, Py4JJavaError
+
+def _get_gateway(redirect_stdout=None):
+    """Return the gateway to SpatialKappa, starting Java and loading
+    the SpatialKappa class if not already done."""
+    global gateway
+    _import_spatialkappa()
+    if not gateway:
+        gateway = SpatialKappa.SpatialKappa(redirect_stdout=redirect_stdout)
+    return gateway
+
 def setSeed(seed):
     raise RuntimeError('setSeed() is deprecated. Instead create the Kappa() object with the "seed" argument')
 
@@ -297,6 +1028,127 @@ class Kappa(GeneralizedReaction):
         time_units -- The units in which rate constants in the Kappa
         file are defined. Can be milliseconds ("ms") or or seconds
         ("s").
+
+        batch_exchange -- Boolean indicating if fluxes, membrane
+        potentials, totals and observables should be exchanged with all
+        the sims in this scheme at once, rather than with one sim after
+        another. SpatialKappa has no call that reaches several sims, so
+        the calls, one per variable per segment, are made concurrently
+        from a pool of threads, and their round trips overlap. The
+        numpy backend, workers and servers always exchange with all the
+        sims in one call per time step.
+
+        workers -- Number of worker processes over which to share the
+        sims of this scheme. Each worker runs its own SpatialKappa
+        gateway and the workers advance their sims concurrently at
+        each time step. Results with a given seed do not depend on
+        the number of workers. If None (the default), all sims run
+        through the gateway in this process.
+
+        server -- Address of a KappaNEURON server in which to create
+        the sims of this scheme instead of starting Java in this
+        process, or True for the default address on this machine; see
+        KappaNEURON.KappaServer. All the schemes in a process share
+        one connection to each server. Cannot be combined with
+        workers.
+
+        server_authkey -- Authentication key of the server, if it was
+        started with one.
+
+        pipeline -- Boolean indicating if the sims should be advanced
+        in a background thread while NEURON carries out the rest of
+        the time step. This introduces a lag of one time step: the
+        membrane fluxes and concentrations that Kappa returns at step
+        n are those computed from the fluxes and membrane potentials
+        passed to it at step n-1, and there is no Kappa contribution
+        to the first step after initialisation. Ions are still
+        conserved, since each correction is applied exactly once.
+
+        coupling_interval -- Number of NEURON time steps between
+        exchanges with Kappa (default 1). NEURON integrates every
+        step, while the fluxes and membrane potentials are averaged
+        over the interval and passed to Kappa, which then runs for the
+        whole interval in one go. The membrane flux that results is
+        applied at a constant rate over the following interval, so
+        charge is conserved. Concentrations of Kappa species are
+        updated from Kappa once per interval.
+
+        If coupling_interval is "adaptive", the interval starts at one
+        step and is doubled after each exchange, up to
+        max_coupling_interval steps (default 64), as long as the flux
+        of every membrane species is smaller than flux_tol in mM/ms
+        (default 1e-6) and the net change in every membrane species
+        is smaller than delta_tol molecules per step (default 0.5).
+        As soon as a flux reaches flux_tol or the membrane potential
+        moves more than v_tol mV (default 1) from its value at the
+        last exchange, Kappa is brought up to date and the interval
+        snaps back to one step.
+
+        skip_quiescent -- Boolean indicating if sims that are idle
+        should not be advanced at every exchange. A sim is regarded as
+        idle once it has had no inbound flux, no net change in its
+        membrane species and no change in its observables for
+        quiescent_steps consecutive exchanges (default 10). It is then
+        left behind until it receives a flux, the membrane potential
+        moves more than v_tol mV from its value when it went to sleep,
+        or it has been idle for max_skip_time ms (default 1). At that
+        point it catches up in one run. Any net change in its membrane
+        species during the catch-up contributes to the membrane flux at
+        a constant rate over as long as the sim was idle, so charge is
+        conserved without a pulse of current. The number of skipped
+        exchanges is reported by stats(). Sims of the numpy backend,
+        workers or a server, which are exchanged with all at once, are
+        not skipped.
+
+        event_driven -- Boolean indicating if the sims should only be
+        exchanged with NEURON around events. Events are registered with
+        add_netcon() and add_threshold(). For event_window ms (default
+        1) after each event, variables are exchanged at every time
+        step. At other times the sims are left to run free and are
+        advanced in one run over the whole quiet period, with the
+        fluxes accumulated over it, when the next event arrives or the
+        run ends, or when max_event_interval ms (default 1) have
+        passed. The number of exchanges therefore depends on the number
+        of events rather than the number of steps. Between exchanges
+        the species observed by Kappa keep the values of the last
+        exchange, so max_event_interval bounds how long they can lag
+        behind Kappa. If it is None they are frozen for the whole of
+        each quiet period.
+
+        cvode_interval -- Time in ms between exchanges of variables
+        with Kappa when NEURON's variable-step integrator (CVODE) is
+        active (default 0.1). Between exchanges CVODE integrates the
+        rest of the model with steps as large as it likes, and each
+        exchange is treated as a discontinuity.
+
+        backend -- Simulator used for the sims: "spatialkappa" (the
+        default) or "numpy". The numpy backend simulates the flat
+        subset of Kappa, in which every complex is written out in
+        full, in this process with a vectorised stochastic simulation
+        algorithm, avoiding the startup of Java and the cost of calls
+        through the gateway. It always exchanges variables as with
+        batch_exchange and cannot be combined with workers.
+
+        tau_tol -- If given, the sims are advanced approximately by
+        tau-leaping rather than exactly, which requires the numpy
+        backend. Reactions between species present in large numbers,
+        such as the creation of free calcium, are fired in batches over
+        leaps chosen so that no propensity is expected to change by
+        more than the fraction tau_tol (0.03 is typical), while
+        reactions that could exhaust a species present in small
+        numbers are still simulated exactly. Means are preserved, but
+        the spread of species near equilibrium is overestimated, e.g.
+        by about 15% with tau_tol=0.03 and 5% with 0.01 for the
+        calcium pump in the tests. Default None.
+
+        model_cache -- Directory in which to cache the kappa file once
+        it has been parsed and augmented with the membrane species, so
+        that later runs can load the model without parsing it. If True,
+        the directory ~/.cache/KappaNEURON is used. Entries are keyed by
+        a hash of the contents of the kappa file and the names of the
+        membrane species, so editing the file invalidates them. Only
+        sims of the numpy backend can be saved, so caching requires
+        backend="numpy". Default None, i.e. no caching.
         
         .. seealso::
         
@@ -304,6 +1156,8 @@ class Kappa(GeneralizedReaction):
 
         """
         
+        _install_handlers()
+
         # additional keyword arguments
         membrane_species = kwargs.get('membrane_species', [])
         species = kwargs.get('species', [])
@@ -312,13 +1166,92 @@ class Kappa(GeneralizedReaction):
         membrane_flux = kwargs.get('membrane_flux', True)
         time_units = kwargs.get('time_units', 'ms')
         seed = kwargs.get('seed', None)
+        self._seed = seed
         self._sk_redirect_stdout = kwargs.get('sk_redirect_stdout', None)
+        self._batch_exchange = kwargs.get('batch_exchange', False)
+        self._workers = kwargs.get('workers', None)
+        self._server = kwargs.get('server', None)
+        self._server_authkey = kwargs.get('server_authkey', None)
+        if self._server and self._workers:
+            raise Exception('workers cannot be combined with server')
+        self._sim_pool = None
+        self._pipeline = kwargs.get('pipeline', False)
+        self._coupling_interval = kwargs.get('coupling_interval', 1)
+        self._adaptive_coupling = (self._coupling_interval == 'adaptive')
+        if self._adaptive_coupling:
+            self._coupling_interval = 1
+        elif int(self._coupling_interval) != self._coupling_interval or self._coupling_interval < 1:
+            raise Exception('coupling_interval must be a positive integer or "adaptive"')
+        self._max_coupling_interval = kwargs.get('max_coupling_interval', 64)
+        self._flux_tol = kwargs.get('flux_tol', 1e-6)
+        self._delta_tol = kwargs.get('delta_tol', 0.5)
+        self._v_tol = kwargs.get('v_tol', 1.0)
+        self._v_last = None
+        self._spread_left = 0.0
+        self._skip_quiescent = kwargs.get('skip_quiescent', False)
+        self._quiescent_steps = kwargs.get('quiescent_steps', 10)
+        self._max_skip_time = kwargs.get('max_skip_time', 1.0)
+        self._model_cache = kwargs.get('model_cache', None)
+        self._cvode_interval = kwargs.get('cvode_interval', 0.1)
+        self._event_driven = kwargs.get('event_driven', False)
+        self._event_window = kwargs.get('event_window', 1.0)
+        self._max_event_interval = kwargs.get('max_event_interval', 1.0)
+        self._event_windows = []
+        self._thresholds = []
+        self._netcons = []
+        ## Weak references to the KappaRecorders sampling in the
+        ## coupling loop
+        self._recorders = []
+        if self._event_driven and self._adaptive_coupling:
+            raise Exception('event_driven cannot be combined with an adaptive coupling_interval')
+        self._cvode_callback = None
+        self._backend = kwargs.get('backend', 'spatialkappa')
+        if self._backend not in ('spatialkappa', 'numpy'):
+            raise Exception('backend must be "spatialkappa" or "numpy"')
+        if self._backend == 'numpy' and self._workers:
+            raise Exception('workers cannot be used with the numpy backend')
+        if self._backend == 'numpy' and self._server:
+            raise Exception('server cannot be used with the numpy backend')
+        self._tau_tol = kwargs.get('tau_tol', None)
+        if self._tau_tol is not None and self._backend != 'numpy':
+            raise Exception('tau_tol requires backend="numpy"')
+        if self._model_cache and self._backend != 'numpy':
+            raise Exception('model_cache requires backend="numpy"')
+        if self._model_cache is True:
+            self._model_cache = os.path.join(os.path.expanduser('~'), '.cache', 'KappaNEURON')
+        self._lag = None
+        self._idle_count = None
+        self._v_sleep = None
+        self._last_observed = None
+        self._catch_up_rate = None
+        self._catch_up_left = None
+        self._coupling_count = 0
+        self._b_acc = None
+        self._v_acc = None
+        self._t_acc = 0.0
+        self._memb_flux_rate = None
+        self._pipeline_pool = None
+        self._exchange_pool = None
+        self._pending = None
+        self._pending_inputs = None
+        if self._pipeline:
+            from multiprocessing.pool import ThreadPool
+            self._pipeline_pool = ThreadPool(1)
 
         ## Gateway is link to Java instance, _kappa_sims will be list
         ## of Java SpatialKappaSim objects
         global gateway
         self._kappa_sims = []
         self._kappa_file = os.path.join(os.getcwd(), kappa_file)
+        ## Sites of the membrane species agents, looked up when the
+        ## kappa file is first loaded
+        self._site_names = None
+        ## Variables set with setVariable()
+        self._variables = {}
+        ## Name under which gateway calls are counted by stats()
+        global _kappa_scheme_count
+        _kappa_scheme_count += 1
+        self._stats_name = '%s#%d' % (os.path.basename(kappa_file), _kappa_scheme_count)
 
         ## Species
         self._species = []
@@ -370,10 +1303,10 @@ class Kappa(GeneralizedReaction):
 
         ## Create Kappa simulations and register them with KappaNEURON and NEURON
         self._create_kappa_sims(seed)
-        report('Registering kappa scheme')
+        report('Registering kappa scheme', phase='init')
         _register_kappa_scheme(self)
         nrr._register_reaction(self)
-        report(_kappa_schemes)
+        report("%s", _kappa_schemes, phase='init')
         if nrr.initializer.is_initialized():
             self._do_init()
         self._weakref = weakref.ref(self) # Seems to be needed for the destructor
@@ -381,7 +1314,7 @@ class Kappa(GeneralizedReaction):
         
     def _do_init(self):
         _kn_init()
-        report("Kappa is initialized")
+        report("Kappa is initialized", phase='init')
         # self._update_rates()
     
     def __repr__(self):
@@ -397,6 +1330,17 @@ class Kappa(GeneralizedReaction):
         for kappa_flux in self._kappa_fluxes:
             kappa_flux.__del__()
 
+        if self._pipeline_pool is not None:
+            self._pipeline_wait()
+            self._pipeline_pool.close()
+            self._pipeline_pool = None
+        if self._exchange_pool is not None:
+            self._exchange_pool.close()
+            self._exchange_pool = None
+        if self._sim_pool is not None:
+            self._sim_pool.close()
+            self._sim_pool = None
+
         ## Needed to ensure cleanup and no exit errors in python2.7
         if (len(_kappa_schemes) == 0):
             gateway = None
@@ -405,53 +1349,203 @@ class Kappa(GeneralizedReaction):
         """Create the kappa simulations.
         
         Keyword arguments:
-        seed -- Seed to initialise random number generator
+        seed -- Seed to initialise random number generator. Each sim
+        gets its own stream, derived from seed and the index of the sim.
         """
         
         global gateway
-        global verbose
         
-        ## Start Java and load the SpatialKappa class, if not already
-        ## loaded
-        if not gateway:
-            gateway = SpatialKappa.SpatialKappa(redirect_stdout=self._sk_redirect_stdout)
+        indices = self._indices_dict[self._involved_species[0]()]
+        if self._backend == 'numpy':
+            from KappaNEURON.NumpyKappa import NumpyKappa
+            sim_factory = NumpyKappa(self._tau_tol)
+        elif self._workers:
+            ## Sims are created in worker processes, each with its own
+            ## gateway
+            _import_spatialkappa()
+            from KappaNEURON.KappaSimPool import KappaSimPool
+            self._sim_pool = KappaSimPool(self._workers, len(indices), self._sk_redirect_stdout)
+            sim_factory = self._sim_pool
+        elif self._server:
+            ## Sims are created in a server process that is already
+            ## running Java
+            _import_spatialkappa()
+            from KappaNEURON.KappaServer import KappaServerPool
+            address = None if self._server is True else self._server
+            self._sim_pool = KappaServerPool(len(indices), address, self._server_authkey)
+            sim_factory = self._sim_pool
+        else:
+            sim_factory = _get_gateway(self._sk_redirect_stdout)
 
         self._kappa_sims = []   # Will this destroy things properly?
-        for index in self._indices_dict[self._involved_species[0]()]:
-            report("Creating Kappa Simulation in index %d" % (index))
-            kappa_sim = gateway.kappa_sim(self._time_units, True, seed)
-            try:
-                kappa_sim.loadFile(self._kappa_file)
-            except Py4JJavaError as e:
-                java_err = re.sub(r'java.lang.IllegalStateException: ', r'', str(e.java_exception))
-                errstr = 'Error in kappa file %s: %s' % (self._kappa_file, java_err)
-                raise RuntimeError(errstr)
-                
-            ## Set up transitions to create membrane species in Kappa
-            ## simulation and measure the total amount of the agent
-            ## corresponding to the membrane species
+        self._total_names = ['Total %s' % (s.name) for s in self._membrane_species]
+        ## The first sim is loaded from the kappa file and augmented
+        ## with the membrane species, which also looks up the site
+        ## names and fills the model cache
+        seeds = [_sim_seed(seed, n) for n in range(len(indices))]
+        report("Creating Kappa Simulation in index %d", indices[0], phase='init')
+        template = sim_factory.kappa_sim(self._time_units, True, seeds[0])
+        self._load_kappa_sim(template)
+        self._kappa_sims.append(template)
+        if self._backend == 'numpy':
+            ## NumpyKappa sims are copied from the first, so that the
+            ## file is only parsed once
+            for index, sim_seed in zip(indices[1:], seeds[1:]):
+                report("Cloning Kappa Simulation in index %d", index, phase='init')
+                self._kappa_sims.append(template.cloneSim(sim_seed))
+        else:
+            for index, sim_seed in zip(indices[1:], seeds[1:]):
+                report("Creating Kappa Simulation in index %d", index, phase='init')
+                self._kappa_sims.append(sim_factory.kappa_sim(self._time_units, True, sim_seed))
+            if self._sim_pool is None and len(self._kappa_sims) > 2:
+                ## SpatialKappa cannot copy a sim, so every sim parses
+                ## the file. py4j gives each thread its own connection
+                ## to the JVM, so the sims are loaded concurrently.
+                import multiprocessing
+                from multiprocessing.pool import ThreadPool
+                pool = ThreadPool(min(len(self._kappa_sims) - 1, multiprocessing.cpu_count()))
+                try:
+                    pool.map(self._load_kappa_sim, self._kappa_sims[1:])
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                for kappa_sim in self._kappa_sims[1:]:
+                    self._load_kappa_sim(kappa_sim)
+        ## TODO: Should we check if we are inserting two kappa schemes
+        ## in the same place?
+
+        ## Totals of membrane species at the end of the last step of
+        ## each sim; see _step_and_report()
+        self._Stot = [None]*len(self._kappa_sims)
+
+        ## Group the sims so that each time step needs only one
+        ## gateway call; see _kappa_advance()
+        self._sim_group = None
+        self._exchange_pool = None
+        self._observed = None
+        if self._sim_pool is not None:
+            ## The pool steps the sims in its workers
+            self._sim_pool.set_exchange_names(
+                ['Create %s' % (s.name) for s in self._membrane_species],
+                self._total_names,
+                [sptr().name for sptr in self._involved_species])
+            self._sim_group = self._sim_pool
+        elif self._backend == 'numpy':
+            ## The numpy backend advances all the sims at once
+            self._sim_group = sim_factory.kappa_sim_group(
+                self._kappa_sims,
+                ['Create %s' % (s.name) for s in self._membrane_species],
+                self._total_names,
+                [sptr().name for sptr in self._involved_species])
+        elif self._batch_exchange:
+            ## SpatialKappa cannot exchange with several sims in one
+            ## call, so the calls to the sims are made concurrently
+            import multiprocessing
+            from multiprocessing.pool import ThreadPool
+            self._exchange_pool = ThreadPool(min(len(self._kappa_sims), multiprocessing.cpu_count()))
+        self._mult = [1]
+
+    def _model_cache_file(self):
+        """Return the path of the cached model for this scheme, or None
+        if models are not being cached."""
+        if not self._model_cache:
+            return None
+        sha = hashlib.sha1()
+        with open(self._kappa_file, 'rb') as f:
+            sha.update(f.read())
+        for s in self._membrane_species:
+            sha.update(b'\0' + s.name.encode('utf-8'))
+        root = os.path.splitext(os.path.basename(self._kappa_file))[0]
+        return os.path.join(self._model_cache, '%s-%s.model' % (root, sha.hexdigest()))
+
+    def _load_kappa_sim(self, kappa_sim):
+        """Load the kappa file into kappa_sim and augment it with the
+        transitions and variables used to exchange membrane species.
+
+        If a model cache is in use, the augmented model is loaded from
+        the cache if it is there, and otherwise saved to it.
+        """
+        cache_file = self._model_cache_file()
+        if cache_file is not None and os.path.exists(cache_file):
+            if _load_cached_model(kappa_sim, cache_file):
+                report("Loaded cached model %s", cache_file, phase='init')
+                return
+
+        try:
+            kappa_sim.loadFile(self._kappa_file)
+        except Py4JJavaError as e:
+            java_err = re.sub(r'java.lang.IllegalStateException: ', r'', str(e.java_exception))
+            errstr = 'Error in kappa file %s: %s' % (self._kappa_file, java_err)
+            raise RuntimeError(errstr)
+
+        ## Set up transitions to create membrane species in Kappa
+        ## simulation and measure the total amount of the agent
+        ## corresponding to the membrane species. The site names only
+        ## need to be looked up for the first sim.
+        if self._site_names is None:
+            self._site_names = []
             for s in self._membrane_species:
                 ## Get description of agent
                 agent_delcaration = kappa_sim.getAgentDeclaration(s.name)
                 site_names = agent_delcaration.keys()
                 if (len(site_names) > 1):
                     errstr = 'Error in kappa file %s: Agent %s has more than one site' % (self._kappa_file, s.name)
-                    raise RuntimeError()
-                
-                site_name = site_names[0]
-                
-                ## Add transition to create 
-                kappa_sim.addTransition('Create %s' % (s.name), {}, {s.name: {site_name: {}}}, 0.0)
-                
-                ## Add variable to measure total species
-                kappa_sim.addVariable('Total %s' % (s.name), {s.name: {site_name: {'l': '?'}}})
-                ## Add observation variable
-                kappa_sim.addVariable('%s' % (s.name), {s.name: {site_name: {}}})
-
-            self._kappa_sims.append(kappa_sim)
-            ## TODO: Should we check if we are inserting two kappa schemes
-            ## in the same place?
-        self._mult = [1]
+                    raise RuntimeError(errstr)
+                self._site_names.append(site_names[0])
+
+        for s, site_name in zip(self._membrane_species, self._site_names):
+            ## Add transition to create 
+            kappa_sim.addTransition('Create %s' % (s.name), {}, {s.name: {site_name: {}}}, 0.0)
+
+            ## Add variable to measure total species
+            kappa_sim.addVariable('Total %s' % (s.name), {s.name: {site_name: {'l': '?'}}})
+            ## Add observation variable
+            kappa_sim.addVariable('%s' % (s.name), {s.name: {site_name: {}}})
+
+        if cache_file is not None and not os.path.exists(cache_file):
+            _save_cached_model(kappa_sim, cache_file)
+
+    def _update_exchange_arrays(self):
+        """Set up the arrays used to exchange variables with Kappa at
+        each time step.
+
+        _memb_indices and _obs_indices hold the indices in the state
+        vector of each membrane species and each involved species, in
+        rows ordered as _membrane_species and _involved_species, with
+        one column per sim. _memb_conv and _obs_conv hold the
+        corresponding numbers of molecules per mM. The accumulators
+        for the coupling interval and the membrane fluxes of the
+        KappaFlux objects are preallocated so that they can be updated
+        in place.
+        """
+        volumes = nrr.node._get_data()[0]
+        nsims = len(self._kappa_sims)
+        self._memb_indices = numpy.array([self._indices_dict[s] for s in self._membrane_species],
+                                         dtype=int).reshape((len(self._membrane_species), nsims))
+        self._obs_indices = numpy.array([self._indices_dict[sptr()] for sptr in self._involved_species],
+                                        dtype=int).reshape((len(self._involved_species), nsims))
+        self._memb_conv = molecules_per_mM_um3*volumes[self._memb_indices]
+        self._obs_conv = molecules_per_mM_um3*volumes[self._obs_indices]
+        self._b_acc = numpy.zeros(self._memb_indices.shape)
+        self._v_acc = numpy.zeros(nsims)
+        self._memb_flux_rate = numpy.zeros(self._memb_indices.shape)
+        for kappa_flux in self._kappa_fluxes:
+            kappa_flux._memb_flux = numpy.zeros(nsims)
+
+    def _pipeline_wait(self):
+        """Wait for the step running in the background, if any.
+
+        Returns the result of _kappa_advance() and the inputs to it
+        that are needed to compute the membrane fluxes, or None if no
+        step is running.
+        """
+        if self._pending is None:
+            return None
+        result = (self._pending.get(), self._pending_inputs)
+        self._pending = None
+        self._pending_inputs = None
+        return result
 
     def _update_v_ptrs(self):
         # TODO: make sure this is redone whenever nseg changes
@@ -479,12 +1573,13 @@ class Kappa(GeneralizedReaction):
         value -- Float to set the variable to.
 
         """
+        self._variables[variable] = float(value)
         for kappa_sim in self._kappa_sims:
             kappa_sim.addVariable(variable, float(value))
             if kappa_sim.isInitialised():
                 kappa_sim.setTransitionRateOrVariable(variable, float(value))
 
-    def run_free(self, t_run):
+    def run_free(self, t_run, tol=None, chunk=100.0, window=5, equilibration_cache=None, threads=None):
         """Run Kappa simulations free of NEURON
 
         During run_free() invocations, there is no passing or
@@ -492,20 +1587,173 @@ class Kappa(GeneralizedReaction):
 
         Keyword arguments:
 
-        t_run -- Time in millseconds for which to run.
+        t_run -- Time in millseconds for which to run. If tol is given,
+        this is the maximum time.
+
+        tol -- If given, run until the sims have reached a steady state
+        rather than for t_run. The sims are run in chunks, and the
+        number of molecules of each of the species of each scheme is
+        read after each chunk. The steady state is reached when, for
+        every species in every sim, the mean and variance over the last
+        window chunks differ from those over the window before by no
+        more than tol times their magnitude.
+
+        chunk -- Length in milliseconds of each chunk (default 100).
+
+        window -- Number of chunks in each window (default 5).
+
+        equilibration_cache -- Directory in which to cache the state of
+        the sims at the end of the run. The cache is keyed by the kappa
+        files, membrane species, variables set with setVariable(),
+        seeds, volumes, initial numbers of molecules and the arguments
+        above, so a later run with the same configuration restores the
+        state instead of running the sims. As with save_state(), every
+        scheme must use backend="numpy". Every scheme must also have
+        a seed, since otherwise restoring the state would make
+        independent runs identical; if one does not, a warning is
+        given and the cache is not used.
+
+        threads -- Number of threads used to run the sims concurrently
+        (default: the number of CPUs). Sims held by worker processes
+        (see the workers argument of Kappa) are run by their workers.
+
+        Returns the time for which the sims were run.
 
         """
-        for kptr in _kappa_schemes:
-            k = kptr()
-            # for s in k._membrane_species:
-            #     report("ION: %s" % (s.name))
-            #     for kappa_sim, i in zip(k._kappa_sims, k._indices_dict[s]):
-            #         kappa_sim.setTransitionRate('Create %s' % (s.name), 0.0)
-            #         ## report("Setting %s flux[%d] to b[%d]*NA*vol[%d] = %f*%f*%f = %f" % (s.name, i, i, i,  b[i], molecules_per_mM_um3, volumes[i], flux))
+        cache_dir = None
+        if equilibration_cache:
+            _check_state_backend()
+            if any(kptr()._seed is None for kptr in _kappa_schemes):
+                warnings.warn('Not using equilibration_cache, as not every Kappa scheme has a seed', UserWarning)
+                equilibration_cache = None
+        if equilibration_cache:
+            cache_dir = os.path.join(equilibration_cache, _equilibration_key(t_run, tol, chunk, window))
+            if os.path.isdir(cache_dir):
+                report("Restoring equilibrated state from %s", cache_dir, phase='init')
+                with open(os.path.join(cache_dir, 'header.json')) as f:
+                    header = json.load(f)
+                _load_kappa_state(cache_dir, header)
+                return header['t_run']
+
+        if tol is None:
+            _run_sims_free(t_run, threads)
+            t_done = t_run
+        else:
+            t_done = 0.0
+            history = []
+            while t_done < t_run:
+                dt = min(chunk, t_run - t_done)
+                _run_sims_free(dt, threads)
+                t_done += dt
+                history.append(_free_observables())
+                if len(history) >= 2*window:
+                    history = history[-2*window:]
+                    if _steady(numpy.array(history), window, tol):
+                        report("Steady state reached after %f ms", t_done, phase='init')
+                        break
+            else:
+                warnings.warn('Kappa sims did not reach a steady state within %f ms' % (t_run), UserWarning)
+
+        if cache_dir is not None:
+            ## Write to a temporary directory and rename it, so that
+            ## jobs sharing the cache never see a partial entry
+            tmp = '%s.%d.tmp' % (cache_dir, os.getpid())
+            header = _save_kappa_state(tmp)
+            header['t_run'] = t_done
+            with open(os.path.join(tmp, 'header.json'), 'w') as f:
+                json.dump(header, f, indent=2)
+            try:
+                os.rename(tmp, cache_dir)
+            except OSError:
+                ## Another job got there first
+                shutil.rmtree(tmp)
+        return t_done
+
+    def add_netcon(self, netcon):
+        """Exchange variables with Kappa around the events of netcon,
+        if the scheme is event driven. The scheme wakes when an event
+        from the source of netcon arrives, i.e. netcon.delay after the
+        source fires. The events also trigger recording by any
+        KappaRecorder of the scheme with a window.
+        """
+        netcon.record(functools.partial(_netcon_event, weakref.ref(self), netcon))
+        self._netcons.append(netcon)
 
-            # print(k)
-            for kappa_sim in k._kappa_sims:
-                kappa_sim.runForTime(float(t_run), True)
+    def add_threshold(self, ref, threshold):
+        """Exchange variables with Kappa after the variable referenced
+        by ref, e.g. sec(0.5)._ref_v or sec(0.5)._ref_cai, crosses
+        threshold in either direction, if the scheme is event driven.
+        """
+        self._thresholds.append([ref, threshold, None])
+
+    def save_state(self, path):
+        """Save the state of the coupled NEURON and Kappa simulation.
+
+        The state of every sim of every Kappa scheme, the rxd state
+        vector, the NEURON state (as saved by SaveState) and the state
+        of the coupling between them are written to files in the
+        directory path, which is created if necessary. The state can be
+        restored with load_state() in a later run that sets up the same
+        model, for example to branch many stimulation protocols off one
+        equilibrated state.
+
+        SpatialKappa cannot save the state of a sim, so every Kappa
+        scheme must use backend="numpy"; otherwise RuntimeError is
+        raised.
+
+        As with run_free(), the result of a step still running in the
+        background in pipeline mode is discarded.
+
+        Keyword arguments:
+
+        path -- Directory in which to save the state.
+
+        """
+        header = _save_kappa_state(path)
+        header['t'] = h.t
+
+        numpy.save(os.path.join(path, 'rxd.npy'), nrr.node._get_states())
+        ss = h.SaveState()
+        ss.save()
+        f = h.File()
+        f.wopen(os.path.join(path, 'neuron.dat'))
+        ss.fwrite(f)
+        f.close()
+
+        with open(os.path.join(path, 'header.json'), 'w') as f:
+            json.dump(header, f, indent=2)
+
+    def load_state(self, path):
+        """Restore the state saved by save_state().
+
+        The model must have been set up in the same way as when the
+        state was saved, and initialised with finitialize(), which
+        load_state() then overrides.
+
+        Keyword arguments:
+
+        path -- Directory from which to load the state.
+
+        """
+        with open(os.path.join(path, 'header.json')) as f:
+            header = json.load(f)
+        _check_kappa_state(path, header)
+
+        ss = h.SaveState()
+        f = h.File()
+        f.ropen(os.path.join(path, 'neuron.dat'))
+        ss.fread(f)
+        f.close()
+        ss.restore()
+
+        states = nrr.node._get_states()
+        states[:] = numpy.load(os.path.join(path, 'rxd.npy'))
+
+        _load_kappa_state(path, header)
+
+        nrr._section1d_transfer_to_legacy()
+        if _get_cvode().active():
+            _get_cvode().re_init()
 
     def get_debug_output(self):
         """Get debug output from the SpatialKappa sims. Returns a string.
@@ -525,7 +1773,20 @@ class Kappa(GeneralizedReaction):
         init() time.
 
         """
-        report("KappaNEURON.re_init()")
+        report("KappaNEURON.re_init()", phase='init')
+        ## Discard any step still running in the background, and any
+        ## fluxes accumulated towards the next exchange
+        self._pipeline_wait()
+        self._coupling_count = 0
+        self._t_acc = 0.0
+        self._spread_left = 0.0
+        self._v_last = None
+        self._lag = None
+        if self._adaptive_coupling:
+            self._coupling_interval = 1
+        self._event_windows = []
+        for threshold in self._thresholds:
+            threshold[2] = None
         volumes = nrr.node._get_data()[0]
         ## FIXME: There's a problem here, since it is picking up existing states...
         states = nrr.node._get_states()[:]
@@ -563,12 +1824,14 @@ class Kappa(GeneralizedReaction):
 
         ## Create variables for voltage in Kappa
         self._update_v_ptrs()
+        self._update_exchange_arrays()
         for kappa_sim, v_ptr in zip(self._kappa_sims, self._v_ptrs):
             kappa_sim.addVariable("V", v_ptr[0])
 
         ## Initialise sims
         for kappa_sim in self._kappa_sims:
             kappa_sim.initialiseSim()
+        self._Stot = [None]*len(self._kappa_sims)
 
         ## Read numbers of species in Kappa back into NEURON
         for sptr in self._involved_species:
@@ -3,6 +3,7 @@ import pkgutil
 import tempfile
 import shutil
 import KappaNEURON
+from KappaNEURON.NumpyKappa import NumpyKappa
 import unittest
 import neuron
 from neuron import *
@@ -12,6 +13,8 @@ import matplotlib.pyplot as plt
 import re
 import platform
 import glob
+import warnings
+import importlib
 from neuron.rxd.generalizedReaction import molecules_per_mM_um3
 
 def compile_modfiles(dirpath='.'):
@@ -89,6 +92,14 @@ class TestCaAccumulation(unittest.TestCase):
     tol = 0.01
     KappaNEURON.verbose = False
     mechanism = None
+    ## Extra keyword arguments passed to KappaNEURON.Kappa()
+    kappa_kwargs = {}
+    kappa_thresholds = []
+    ## Keyword arguments of a KappaNEURON.KappaRecorder of self.kappa
+    kappa_recorder_kwargs = None
+    ## Directory of the kappa files used by injectCalcium(), if not
+    ## the tests directory
+    kappa_dir = None
 
     def assertEqualWithinTol(self, a, b, tol=None):
         if tol == None:
@@ -120,17 +131,23 @@ class TestCaAccumulation(unittest.TestCase):
         self.mechanism = mechanism
 
         ## Insert calcium pump into kappa section
+        kappa_dir = self.kappa_dir or os.path.dirname(KappaNEURON.__file__) + "/tests"
         if mechanism == 'caPump1':
             print(KappaNEURON.__file__)            
-            self.kappa = KappaNEURON.Kappa(membrane_species=[self.ca], kappa_file=os.path.dirname(KappaNEURON.__file__) + "/tests/" + mechanism + ".ka", regions=self.r)
+            self.kappa = KappaNEURON.Kappa(membrane_species=[self.ca], kappa_file=kappa_dir + "/" + mechanism + ".ka", regions=self.r, **self.kappa_kwargs)
         if mechanism == 'caPump2':
             self.P  = rxd.Species(self.r, name='P', charge=0, initial=self.P0)
-            self.kappa = KappaNEURON.Kappa(membrane_species=[self.ca], species=[self.P], kappa_file=os.path.dirname(KappaNEURON.__file__) + "/tests/" + mechanism + ".ka", regions=self.r)
+            self.kappa = KappaNEURON.Kappa(membrane_species=[self.ca], species=[self.P], kappa_file=kappa_dir + "/" + mechanism + ".ka", regions=self.r, **self.kappa_kwargs)
             self.kappa.setVariable('vol', self.sk.L*(self.sk.diam**2)/4*np.pi)
             self.kappa.setVariable('k2', self.k2)
             setattr(self.sm(0.5), 'k2_' + mechanism, self.k2)
             self.sm(0.5).P0_caPump2 = self.P0
 
+        for ref, threshold in self.kappa_thresholds:
+            self.kappa.add_threshold(ref, threshold)
+        if self.kappa_recorder_kwargs is not None:
+            self.kappa_recorder = KappaNEURON.KappaRecorder(self.kappa, **self.kappa_recorder_kwargs)
+
         ## Set variables
         self.kappa.setVariable('k1', self.k1)
         setattr(self.sm(0.5), 'k1_' + mechanism, self.k1)
@@ -343,6 +360,123 @@ class TestCaAccumulation(unittest.TestCase):
         init()
         self.assertEqual(rxd.rxd._curr_indices, [1])
 
+    def test_tauLeapStatistics(self):
+        ## Run many copies of the calcium pump, with calcium created at
+        ## a constant rate as by a membrane flux, exactly and with
+        ## tau-leaping, and compare the distributions of calcium
+        kappa_file = os.path.dirname(KappaNEURON.__file__) + "/tests/caPump1.ka"
+        nsims = 500
+        stats = {}
+        for tau_tol in [None, 0.03, 0.01]:
+            factory = NumpyKappa(tau_tol)
+            sims = []
+            for n in range(nsims):
+                kappa_sim = factory.kappa_sim('ms', False, n)
+                kappa_sim.loadFile(kappa_file)
+                kappa_sim.addTransition('Create ca', {}, {'ca': {'x': {}}}, 10.0)
+                kappa_sim.addVariable('ca', {'ca': {'x': {}}})
+                kappa_sim.setTransitionRateOrVariable('k1', 0.01)
+                kappa_sim.initialiseSim()
+                sims.append(kappa_sim)
+            group = factory.kappa_sim_group(sims, ['Create ca'], ['ca'], ['ca'])
+            group.run_free([100.0]*nsims)
+            ca = np.array([kappa_sim.getVariable('ca') for kappa_sim in sims])
+            stats[tau_tol] = (ca.mean(), ca.std())
+
+        ## Tau-leaping preserves the mean, but overestimates the
+        ## spread near equilibrium by an amount that falls with tau_tol
+        mean, sd = stats[None]
+        for tau_tol, sd_tol in [(0.03, 0.25), (0.01, 0.1)]:
+            self.assertLess(abs(stats[tau_tol][0] - mean)/mean, 0.01)
+            self.assertLess(abs(stats[tau_tol][1] - sd)/sd, sd_tol)
+
+    def test_noMembraneSpeciesNumpy(self):
+        ## A group with nothing to exchange or observe still runs
+        kappa_file = os.path.dirname(KappaNEURON.__file__) + "/tests/caMinimal.ka"
+        factory = NumpyKappa()
+        kappa_sim = factory.kappa_sim('ms', False, 1)
+        kappa_sim.loadFile(kappa_file)
+        kappa_sim.initialiseSim()
+        group = factory.kappa_sim_group([kappa_sim], [], [], [])
+        out = group.exchange(bytearray(np.array([-65.0]).astype('>f8').tobytes()), 0.1)
+        self.assertEqual(len(out), 0)
+
+        ## A scheme without membrane species only observes calcium,
+        ## which nothing changes
+        self.kappa = KappaNEURON.Kappa(species=[self.ca], kappa_file=kappa_file, regions=self.r, backend='numpy')
+        self.assertEqual(self.kappa._membrane_species, [])
+        for seg in self.sk:
+            seg.gbar_capulse = 0
+        neuron.h.finitialize(-65.0)
+        cai0 = self.sk(0.5).cai
+        run(0.5)
+        self.assertAlmostEqual(h.t, 0.5)
+        self.assertEqual(self.sk(0.5).cai, cai0)
+
+    def test_numpyBackendExports(self):
+        ## Building a scheme with the numpy backend, and importing the
+        ## submodules named after the classes they export, leaves the
+        ## classes bound on the package
+        self.kappa = KappaNEURON.Kappa(membrane_species=[self.ca], kappa_file=os.path.dirname(KappaNEURON.__file__) + "/tests/caPump1.ka", regions=self.r, backend='numpy')
+        importlib.import_module('KappaNEURON.NumpyKappa')
+        importlib.import_module('KappaNEURON.KappaRecorder')
+        self.assertIs(KappaNEURON.NumpyKappa, NumpyKappa)
+        kappa_sim = KappaNEURON.NumpyKappa().kappa_sim('ms', False, 1)
+        kappa_sim.loadFile(os.path.dirname(KappaNEURON.__file__) + "/tests/caMinimal.ka")
+        self.assertEqual(kappa_sim.getAgentDeclaration('ca').keys(), ['x'])
+        self.assertTrue(isinstance(KappaNEURON.KappaRecorder, type))
+
+    def test_kappaToRxd(self):
+        ## The pump in caPump1 removes calcium across the membrane, so
+        ## it is left to Kappa, which carries the current
+        kappa_file = os.path.dirname(KappaNEURON.__file__) + "/tests/caPump1.ka"
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self.reactions, converted = KappaNEURON.kappa_to_rxd(kappa_file, [self.ca], regions=[self.r], membrane_species=[self.ca])
+        self.assertEqual(converted, [])
+        self.assertEqual(self.reactions, [])
+        self.assertTrue(any('ca extrusion' in str(w.message) for w in caught))
+
+        ## The remaining kappa file still couples calcium and voltage
+        ## as the deterministic pump does
+        self.kappa_dir = tempfile.mkdtemp()
+        try:
+            KappaNEURON.write_remaining_kappa(kappa_file, converted, os.path.join(self.kappa_dir, 'caPump1.ka'))
+            self.t1 = 2
+            self.tstop = 2
+            self.k1 = 1
+            self.injectCalcium(ghk=0)
+        finally:
+            shutil.rmtree(self.kappa_dir)
+        self.do_plot()
+        Deltav, Deltaca, Deltav_theo, Deltaca_theo, volbyarea, vtocai, diffv, diffca = self.get_stats()
+
+        ## Calcium and voltage should be in sync, as charge is conserved
+        for mode in ['mod', 'kappa']:
+            self.assertEqualWithinTol(Deltav[mode], Deltaca[mode]/vtocai[mode])
+
+        ## Check that kappa and deterministic simulations agree to
+        ## within 15%
+        tol = 0.15
+        self.assertLess(abs((Deltav['kappa'] - Deltav['mod'])/(Deltav['mod'] - self.v0)), tol)
+        self.assertLess(abs((Deltaca['kappa'] - Deltaca['mod'])/Deltaca['mod']), tol)
+
+    def test_kappaToRxdShared(self):
+        ## Without Kappa the pump can be converted
+        kappa_file = os.path.dirname(KappaNEURON.__file__) + "/tests/caPump1.ka"
+        reactions, converted = KappaNEURON.kappa_to_rxd(kappa_file, [self.ca], regions=[self.r])
+        self.assertEqual(converted, ['ca extrusion'])
+        del reactions
+
+        ## If Kappa also observes calcium, it overwrites calcium at
+        ## every step, so the pump is left to Kappa
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            reactions, converted = KappaNEURON.kappa_to_rxd(kappa_file, [self.ca], regions=[self.r], kappa_species=[self.ca])
+        self.assertEqual(converted, [])
+        self.assertEqual(reactions, [])
+        self.assertTrue(any('ca extrusion' in str(w.message) and 'Kappa sets' in str(w.message) for w in caught))
+
     def test_twoMembraneSpecies(self):
         self.napulse = h.NaPulse(self.sk(0.5))
         ## import pdb; pdb.set_trace()
@@ -522,6 +656,569 @@ class TestCaAccumulation(unittest.TestCase):
         ## Calcium ion increments should be equal to voltage increments
         self.assertAlmostEqual(max(abs(vtocai['kappa']*diffv['kappa'][1:len(diffv['kappa'])-1] - diffca['kappa'][0:len(diffv['kappa'])-2])), 0, 2)
 
+    def test_injectCalciumWorkers(self):
+        self.kappa_kwargs = {'workers': 2}
+        self.tstop = self.t1 + h.dt
+        self.injectCalcium(ghk=0)
+        self.assertIsInstance(self.kappa._sim_group, KappaNEURON.KappaSimPool.KappaSimPool)
+        self.tstop = self.t1
+        Deltav, Deltaca, Deltav_theo, Deltaca_theo, volbyarea, vtocai, diffv, diffca = self.get_stats()
+
+        ## Calcium and voltage should be in sync
+        self.assertAlmostEqual(Deltav['kappa'], Deltaca['kappa']/vtocai['kappa'], 0)
+
+        ## All calcium ion increments should be integers
+        self.assertAlmostEqual(max(self.caitonum*diffca['kappa'] - np.round(self.caitonum*diffca['kappa'])), 0, 2)
+        ## Calcium ion increments should be equal to voltage increments
+        self.assertAlmostEqual(max(abs(vtocai['kappa']*diffv['kappa'][1:len(diffv['kappa'])-1] - diffca['kappa'][0:len(diffv['kappa'])-2])), 0, 2)
+
+    def test_injectCalciumServer(self):
+        ## Start a server, as "python -m KappaNEURON.KappaServer" would
+        import multiprocessing
+        import time
+        import KappaNEURON.KappaServer
+        server_dir = tempfile.mkdtemp()
+        address = os.path.join(server_dir, 'server.sock')
+        server = multiprocessing.Process(target=KappaNEURON.KappaServer.serve, args=(address,))
+        server.daemon = True
+        server.start()
+        self.addCleanup(shutil.rmtree, server_dir)
+        self.addCleanup(server.terminate)
+        while not os.path.exists(address):
+            time.sleep(0.1)
+
+        self.kappa_kwargs = {'server': address}
+        self.tstop = self.t1
+        self.injectCalcium(ghk=0)
+        self.assertIsInstance(self.kappa._sim_group, KappaNEURON.KappaServer.KappaServerPool)
+        Deltav, Deltaca, Deltav_theo, Deltaca_theo, volbyarea, vtocai, diffv, diffca = self.get_stats()
+
+        ## Calcium and voltage should be in sync
+        self.assertAlmostEqual(Deltav['kappa'], Deltaca['kappa']/vtocai['kappa'], 0)
+
+        ## All calcium ion increments should be integers
+        self.assertAlmostEqual(max(self.caitonum*diffca['kappa'] - np.round(self.caitonum*diffca['kappa'])), 0, 2)
+
+        ## The default socket is in a directory only the user can
+        ## enter, and a TCP port, which any local user can reach,
+        ## needs an authkey
+        default_dir = os.path.dirname(KappaNEURON.KappaServer.default_address())
+        self.assertEqual(os.stat(default_dir).st_mode & 0o077, 0)
+        self.assertRaises(RuntimeError, KappaNEURON.KappaServer.serve, ('localhost', 0))
+        self.assertRaises(RuntimeError, KappaNEURON.KappaServer.KappaServerPool, 1, ('localhost', 0))
+
+    def test_injectCalciumPipeline(self):
+        self.kappa_kwargs = {'pipeline': True}
+        self.tstop = self.t1 + h.dt
+        self.injectCalcium(ghk=0)
+        self.tstop = self.t1
+        Deltav, Deltaca, Deltav_theo, Deltaca_theo, volbyarea, vtocai, diffv, diffca = self.get_stats()
+
+        ## Calcium and voltage should still be in sync, despite the
+        ## lag of one step
+        self.assertAlmostEqual(Deltav['kappa'], Deltaca['kappa']/vtocai['kappa'], 0)
+
+        ## All calcium ion increments should be integers
+        self.assertAlmostEqual(max(self.caitonum*diffca['kappa'] - np.round(self.caitonum*diffca['kappa'])), 0, 2)
+
+    def test_injectCalciumCouplingInterval(self):
+        ## Exchange with Kappa every 4 NEURON steps
+        self.kappa_kwargs = {'coupling_interval': 4}
+        self.t1 = 2
+        self.tstop = 2
+        self.k1 = 1
+        self.injectCalcium(ghk=0)
+        self.do_plot()
+        Deltav, Deltaca, Deltav_theo, Deltaca_theo, volbyarea, vtocai, diffv, diffca = self.get_stats()
+
+        ## Calcium and voltage should be in sync, as charge is conserved
+        for mode in ['mod', 'kappa']:
+            self.assertEqualWithinTol(Deltav[mode], Deltaca[mode]/vtocai[mode])
+
+        ## Check that kappa and deterministic simulations agree to
+        ## within 15%
+        tol = 0.15
+        self.assertLess(abs((Deltav['kappa'] - Deltav['mod'])/(Deltav['mod'] - self.v0)), tol)
+        self.assertLess(abs((Deltaca['kappa'] - Deltaca['mod'])/Deltaca['mod']), tol)
+
+    def test_injectCalciumAdaptive(self):
+        ## Widen the coupling interval while nothing happens, i.e.
+        ## before and after the calcium pulse
+        KappaNEURON.enable_stats()
+        self.kappa_kwargs = {'coupling_interval': 'adaptive'}
+        self.t1 = 2
+        self.tstop = 4
+        self.k1 = 1
+        try:
+            self.injectCalcium(ghk=0)
+            stats = KappaNEURON.stats()
+        finally:
+            KappaNEURON.enable_stats(False)
+        self.do_plot()
+        self.tstop = self.t1
+        Deltav, Deltaca, Deltav_theo, Deltaca_theo, volbyarea, vtocai, diffv, diffca = self.get_stats()
+
+        ## There are fewer exchanges than steps
+        calls = stats['calls'].values()[0]
+        self.assertLess(calls['runForTime'], int(round(4/h.dt))/2)
+
+        ## Calcium and voltage should be in sync, as charge is conserved
+        for mode in ['mod', 'kappa']:
+            self.assertEqualWithinTol(Deltav[mode], Deltaca[mode]/vtocai[mode])
+
+        ## Calcium should be conserved as well as with fixed-step
+        ## coupling, so kappa and deterministic simulations agree to
+        ## within 15%
+        tol = 0.15
+        self.assertLess(abs((Deltav['kappa'] - Deltav['mod'])/(Deltav['mod'] - self.v0)), tol)
+        self.assertLess(abs((Deltaca['kappa'] - Deltaca['mod'])/Deltaca['mod']), tol)
+
+    def test_injectCalciumSkipQuiescent(self):
+        ## Let the sims sleep while nothing happens, i.e. before the
+        ## calcium pulse
+        KappaNEURON.enable_stats()
+        self.kappa_kwargs = {'skip_quiescent': True}
+        self.t1 = 2
+        self.tstop = 4
+        self.k1 = 1
+        try:
+            self.injectCalcium(ghk=0)
+            stats = KappaNEURON.stats()
+        finally:
+            KappaNEURON.enable_stats(False)
+        self.do_plot()
+        self.tstop = self.t1
+        Deltav, Deltaca, Deltav_theo, Deltaca_theo, volbyarea, vtocai, diffv, diffca = self.get_stats()
+
+        ## Some exchanges are skipped, so the sims are run less often
+        ## than at every step
+        nsteps = int(round(4/h.dt))
+        skipped = stats['skipped'].values()[0]
+        calls = stats['calls'].values()[0]
+        self.assertGreater(skipped, 0)
+        self.assertLess(calls['runForTime'], nsteps)
+
+        ## Calcium and voltage should be in sync, as charge is conserved
+        for mode in ['mod', 'kappa']:
+            self.assertEqualWithinTol(Deltav[mode], Deltaca[mode]/vtocai[mode])
+
+        ## Catching up should not change the outcome, so kappa and
+        ## deterministic simulations agree to within 15%
+        tol = 0.15
+        self.assertLess(abs((Deltav['kappa'] - Deltav['mod'])/(Deltav['mod'] - self.v0)), tol)
+        self.assertLess(abs((Deltaca['kappa'] - Deltaca['mod'])/Deltaca['mod']), tol)
+
+    def test_injectCalciumPump2Numpy(self):
+        ## Simulate the Kappa section without SpatialKappa
+        self.kappa_kwargs = {'backend': 'numpy'}
+        self.t1 = 2.0
+        self.tstop = 3.0
+        self.k1 = 1
+        self.k2 = 0
+        self.P0 = 0.20 
+        self.injectCalcium(ghk=0, mechanism='caPump2')
+        self.do_plot()
+
+        ## Run through both sections
+        times = np.array(self.rec_t)
+        i = 0
+        for sec in h.allsec():
+            v = np.array(self.rec_v[i])
+            self.assertAlmostEqual(v[np.where(np.isclose(times, self.t1 + 0.1))],
+                                   v[np.where(np.isclose(times, self.tstop))])
+            cai = np.array(self.rec_cai[i])
+            self.assertGreater(cai[np.where(np.isclose(times, self.t1 + 0.1))],
+                               cai[np.where(np.isclose(times, self.tstop))])
+            i += 1
+
+    def test_injectCalciumCvode(self):
+        ## Use variable-step integration, exchanging with Kappa every
+        ## 0.1ms
+        h.CVode().active(1)
+        try:
+            self.t1 = 2
+            self.tstop = 2
+            self.k1 = 1
+            self.injectCalcium(ghk=0)
+        finally:
+            h.CVode().active(0)
+        self.do_plot()
+        Deltav, Deltaca, Deltav_theo, Deltaca_theo, volbyarea, vtocai, diffv, diffca = self.get_stats()
+
+        ## Calcium and voltage should be in sync, as charge is conserved
+        for mode in ['mod', 'kappa']:
+            self.assertEqualWithinTol(Deltav[mode], Deltaca[mode]/vtocai[mode])
+
+        ## Check that kappa and deterministic simulations agree to
+        ## within 15%
+        tol = 0.15
+        self.assertLess(abs((Deltav['kappa'] - Deltav['mod'])/(Deltav['mod'] - self.v0)), tol)
+        self.assertLess(abs((Deltaca['kappa'] - Deltaca['mod'])/Deltaca['mod']), tol)
+
+    def test_injectCalciumEventDriven(self):
+        ## Only exchange with Kappa at every step while the calcium
+        ## pulse is on, by waking the scheme for 1ms when the membrane
+        ## potential of the kappa section crosses -60mV
+        KappaNEURON.enable_stats()
+        self.kappa_kwargs = {'event_driven': True, 'event_window': 1.0}
+        self.t1 = 2
+        self.tstop = 6
+        self.k1 = 1
+        self.kappa_thresholds = [(self.sk(0.5)._ref_v, -60.0)]
+        try:
+            self.injectCalcium(ghk=0)
+            stats = KappaNEURON.stats()
+        finally:
+            KappaNEURON.enable_stats(False)
+        self.do_plot()
+        self.tstop = self.t1
+        Deltav, Deltaca, Deltav_theo, Deltaca_theo, volbyarea, vtocai, diffv, diffca = self.get_stats()
+
+        ## The number of exchanges depends on the events, of which
+        ## there are at most two crossings, and on max_event_interval
+        ## rather than on the number of steps
+        nsteps = int(round(6/h.dt))
+        calls = stats['calls'].values()[0]
+        self.assertLess(calls['runForTime'], nsteps/2)
+
+        ## Calcium and voltage should be in sync, as charge is conserved
+        for mode in ['mod', 'kappa']:
+            self.assertEqualWithinTol(Deltav[mode], Deltaca[mode]/vtocai[mode])
+
+        ## The pulse lies within the window of the first crossing, so
+        ## kappa and deterministic simulations agree to within 15%
+        tol = 0.15
+        self.assertLess(abs((Deltav['kappa'] - Deltav['mod'])/(Deltav['mod'] - self.v0)), tol)
+        self.assertLess(abs((Deltaca['kappa'] - Deltaca['mod'])/Deltaca['mod']), tol)
+
+    def test_kappaRecorder(self):
+        ## Record the kappa section in chunks much shorter than the run
+        rec_dir = tempfile.mkdtemp()
+        path = os.path.join(rec_dir, 'rec.npz')
+        self.kappa_recorder_kwargs = {'path': path, 'interval': 0.1, 'chunk': 8, 'chunks': 2}
+        self.t1 = 2
+        self.tstop = 2
+        self.k1 = 1
+        self.injectCalcium(ghk=0)
+        self.kappa_recorder.close()
+        rec = KappaNEURON.load_recording(path)
+        shutil.rmtree(rec_dir)
+
+        self.assertEqual(rec['species_names'], ['ca'])
+        ## A sample due at the very end of the run may not be taken
+        self.assertIn(len(rec['t']), [int(round(self.tstop/0.1)), int(round(self.tstop/0.1)) + 1])
+        self.assertEqual(rec['species'].shape, (len(rec['t']), 1, 1))
+        ## Every sample is the concentration at some time step
+        cai = np.array(self.rec_cai[0])
+        for x in rec['species'][:, 0, 0]:
+            self.assertLess(min(abs(cai - x)), 1e-12)
+
+    def test_kappaRecorderPipeline(self):
+        ## Read observables from the sims at every step while they are
+        ## advanced in the background
+        rec_dir = tempfile.mkdtemp()
+        path = os.path.join(rec_dir, 'rec.npz')
+        self.kappa_kwargs = {'pipeline': True}
+        self.kappa_recorder_kwargs = {'path': path, 'interval': None, 'observables': ['ca'], 'chunk': 8}
+        self.t1 = 2
+        self.tstop = 2
+        self.k1 = 1
+        self.injectCalcium(ghk=0)
+        self.kappa_recorder.close()
+        rec = KappaNEURON.load_recording(path)
+        shutil.rmtree(rec_dir)
+
+        ## Each observable is read once the step has finished, so it is
+        ## a whole number of molecules
+        self.assertEqual(rec['observables'].shape, (len(rec['t']), 1, 1))
+        self.assertTrue(np.all(rec['observables'] >= 0))
+        self.assertTrue(np.array_equal(rec['observables'], np.round(rec['observables'])))
+
+    def test_kappaRecorderTraces(self):
+        ## Record to a trace store and read a time window back
+        rec_dir = tempfile.mkdtemp()
+        path = os.path.join(rec_dir, 'rec.traces')
+        self.kappa_recorder_kwargs = {'path': path, 'interval': 0.1, 'chunk': 8}
+        self.t1 = 2
+        self.tstop = 2
+        self.k1 = 1
+        self.injectCalcium(ghk=0)
+        self.kappa_recorder.close()
+        store = KappaNEURON.open_traces(path)
+        self.assertEqual(store.attrs['species_names'], ['ca'])
+        self.assertEqual(store.units('species'), 'mM')
+        win = store.window(0.5, 1.0)
+        self.assertTrue(np.all((win['t'] >= 0.5) & (win['t'] < 1.0)))
+        self.assertEqual(len(win['t']), len(win['species']))
+        rec = KappaNEURON.load_recording(path)
+        self.assertTrue(np.all(rec['species'][:, 0, 0] == store['species'][:, 0, 0]))
+        del store, win, rec
+        shutil.rmtree(rec_dir)
+
+    def test_kappaRecorderTracesRerun(self):
+        ## Running again into a trace store replaces the first run, so
+        ## that the times stay increasing
+        rec_dir = tempfile.mkdtemp()
+        path = os.path.join(rec_dir, 'rec.traces')
+        self.kappa_recorder_kwargs = {'path': path, 'interval': 0.1, 'chunk': 8}
+        self.t1 = 2
+        self.tstop = 2
+        self.k1 = 1
+        self.injectCalcium(ghk=0)
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            run(self.tstop)
+        self.assertTrue(any('Discarding' in str(x.message) for x in w))
+        self.kappa_recorder.close()
+        store = KappaNEURON.open_traces(path)
+        t = np.array(store['t'])
+        self.assertEqual(t[0], 0.0)
+        self.assertTrue(np.all(np.diff(t) > 0))
+        self.assertIn(len(t), [int(round(self.tstop/0.1)), int(round(self.tstop/0.1)) + 1])
+        del store
+        shutil.rmtree(rec_dir)
+
+    def test_kappaRecorderEnvelope(self):
+        ## Record every 8th step of the coupling loop, with the
+        ## envelope of the steps in between
+        rec_dir = tempfile.mkdtemp()
+        path = os.path.join(rec_dir, 'rec.npz')
+        self.kappa_recorder_kwargs = {'path': path, 'interval': None, 'decimate': 8, 'envelope': True, 'chunk': 8}
+        self.t1 = 2
+        self.tstop = 2
+        self.k1 = 1
+        self.injectCalcium(ghk=0)
+        self.kappa_recorder.close()
+        rec = KappaNEURON.load_recording(path)
+        shutil.rmtree(rec_dir)
+
+        nsteps = int(round(self.tstop/h.dt))
+        self.assertAlmostEqual(len(rec['t']), nsteps//8 + 1, delta=1)
+        ## The envelope contains the samples and every time step
+        self.assertTrue(np.all(rec['species_min'] <= rec['species']))
+        self.assertTrue(np.all(rec['species'] <= rec['species_max']))
+        cai = np.array(self.rec_cai[0])
+        self.assertAlmostEqual(min(rec['species_min'][:, 0, 0]), min(cai), 12)
+        self.assertAlmostEqual(max(rec['species_max'][:, 0, 0]), max(cai), 12)
+
+    def test_stats(self):
+        KappaNEURON.enable_stats()
+        self.t1 = 2
+        self.tstop = 2
+        self.k1 = 1
+        self.injectCalcium(ghk=0)
+        stats = KappaNEURON.stats()
+        KappaNEURON.enable_stats(False)
+        for phase in ['flux_push', 'kappa_advance', 'totals_readback',
+                      'reaction_matrix_solve', 'state_write_back',
+                      'transfer_to_legacy']:
+            self.assertIn(phase, stats['time'])
+        ## One scheme, which makes two calls to set the flux and
+        ## voltage of each sim at every step
+        self.assertEqual(len(stats['calls']), 1)
+        calls = stats['calls'].values()[0]
+        self.assertGreater(calls['setTransitionRateOrVariable'], 0)
+        self.assertEqual(calls['setTransitionRateOrVariable'] % 2, 0)
+        ## Each step makes one run and reads the total and observable
+        ## of ca once, the total at the end of a step being reused at
+        ## the start of the next; it is read at the start only in the
+        ## first step
+        nsteps = calls['runForTime']
+        self.assertEqual(calls['setTransitionRateOrVariable'], 2*nsteps)
+        self.assertEqual(calls['getVariable'], 2*nsteps + 1)
+        self.assertEqual(sorted(calls), ['getVariable', 'runForTime', 'setTransitionRateOrVariable'])
+
+    def test_injectCalciumBatchExchange(self):
+        ## Exchange with all the sims at once. SpatialKappa makes as
+        ## many gateway calls as when exchanging one by one, but they
+        ## are made concurrently.
+        KappaNEURON.enable_stats()
+        self.kappa_kwargs = {'batch_exchange': True}
+        self.t1 = 2
+        self.tstop = 2
+        self.k1 = 1
+        try:
+            self.injectCalcium(ghk=0)
+            stats = KappaNEURON.stats()
+        finally:
+            KappaNEURON.enable_stats(False)
+        self.assertIsNotNone(self.kappa._exchange_pool)
+        calls = stats['calls'].values()[0]
+        nsteps = calls['runForTime']
+        self.assertAlmostEqual(nsteps, int(round(self.tstop/h.dt)), delta=1)
+        ## At each step, the flux and V are set, and the total and the
+        ## observable of ca are read after the run. The total at the
+        ## start of the first step is read once.
+        self.assertEqual(calls['setTransitionRateOrVariable'], 2*nsteps)
+        self.assertEqual(calls['getVariable'], 2*nsteps + 1)
+        Deltav, Deltaca, Deltav_theo, Deltaca_theo, volbyarea, vtocai, diffv, diffca = self.get_stats()
+
+        ## Calcium and voltage should be in sync, as charge is conserved
+        for mode in ['mod', 'kappa']:
+            self.assertEqualWithinTol(Deltav[mode], Deltaca[mode]/vtocai[mode])
+
+    def test_injectCalciumSeed(self):
+        ## Each sim gets its own random number stream, and the first
+        ## sim uses the seed itself
+        seeds = [KappaNEURON._sim_seed(7, n) for n in range(100)]
+        self.assertEqual(seeds[0], 7)
+        self.assertEqual(len(set(seeds)), len(seeds))
+        self.assertEqual(KappaNEURON._sim_seed(None, 1), None)
+
+        ## Runs with the same seed are identical, and runs with
+        ## different seeds are not
+        self.t1 = 2
+        self.tstop = 2
+        self.k1 = 1
+        cai = []
+        for run_seed in [42, 42, 43]:
+            if cai:
+                self.kappa.__del__()
+            self.kappa_kwargs = {'seed': run_seed}
+            self.injectCalcium(ghk=0)
+            i = [self.get_mode(sec) for sec in h.allsec()].index('kappa')
+            cai.append(np.array(self.rec_cai[i]))
+        self.assertTrue(np.array_equal(cai[0], cai[1]))
+        self.assertFalse(np.array_equal(cai[0], cai[2]))
+
+    def test_injectCalciumModelCache(self):
+        cache_dir = tempfile.mkdtemp()
+        self.kappa_kwargs = {'model_cache': cache_dir, 'backend': 'numpy'}
+        self.t1 = 2
+        self.tstop = 2
+        self.k1 = 1
+        try:
+            self.injectCalcium(ghk=0)
+            ## The scheme fills the cache with the augmented model,
+            ## which a new sim can load without parsing the file
+            cache_files = glob.glob(os.path.join(cache_dir, 'caPump1-*.model'))
+            self.assertEqual(len(cache_files), 1)
+            kappa_sim = NumpyKappa().kappa_sim('ms', False)
+            kappa_sim.loadModel(cache_files[0])
+            self.assertTrue(kappa_sim.isVariable('Total ca'))
+        finally:
+            shutil.rmtree(cache_dir)
+        Deltav, Deltaca, Deltav_theo, Deltaca_theo, volbyarea, vtocai, diffv, diffca = self.get_stats()
+
+        ## Calcium and voltage should be in sync, as charge is conserved
+        for mode in ['mod', 'kappa']:
+            self.assertEqualWithinTol(Deltav[mode], Deltaca[mode]/vtocai[mode])
+
+    def test_saveLoadState(self):
+        ## Only sims of the numpy backend can save their state
+        self.kappa_kwargs = {'backend': 'numpy'}
+        self.t1 = 2
+        self.tstop = 2
+        self.k1 = 1
+        self.injectCalcium(ghk=0)
+        cai = self.sk(0.5).cai
+        state_dir = tempfile.mkdtemp()
+        try:
+            self.kappa.save_state(state_dir)
+            ## Reinitialising takes the model back to the start, and
+            ## loading the state returns it to the end of the run
+            neuron.h.finitialize(-65.0)
+            self.assertEqual(h.t, 0.0)
+            self.kappa.load_state(state_dir)
+        finally:
+            shutil.rmtree(state_dir)
+        self.assertAlmostEqual(h.t, self.tstop)
+        self.assertEqual(self.sk(0.5).cai, cai)
+
+    def test_saveLoadStateTrajectory(self):
+        ## Save the state during the pulse with a fixed seed, continue,
+        ## and check that continuing from the restored state repeats
+        ## the same trajectory
+        self.kappa_kwargs = {'backend': 'numpy', 'seed': 3}
+        self.t1 = 2
+        self.tstop = 1.5
+        self.k1 = 1
+        self.injectCalcium(ghk=0)
+        i = [self.get_mode(sec) for sec in h.allsec()].index('kappa')
+        state_dir = tempfile.mkdtemp()
+        try:
+            self.kappa.save_state(state_dir)
+            h.continuerun(3.0)
+            cai = np.array(self.rec_cai[i])
+            nsteps = int(round((3.0 - self.tstop)/h.dt))
+            neuron.h.finitialize(-65.0)
+            self.kappa.load_state(state_dir)
+            h.continuerun(3.0)
+        finally:
+            shutil.rmtree(state_dir)
+        ## The recording restarts at the initialisation, so only the
+        ## steps after the restored time are compared
+        cai_restored = np.array(self.rec_cai[i])
+        self.assertTrue(np.allclose(cai[-nsteps:], cai_restored[-nsteps:]))
+
+    def test_saveStateSpatialKappa(self):
+        ## SpatialKappa cannot save the state of its sims
+        self.t1 = 2
+        self.tstop = 2
+        self.k1 = 1
+        self.injectCalcium(ghk=0)
+        state_dir = tempfile.mkdtemp()
+        try:
+            self.assertRaises(RuntimeError, self.kappa.save_state, state_dir)
+        finally:
+            shutil.rmtree(state_dir)
+
+    def test_runFreeEquilibrationCache(self):
+        cache_dir = tempfile.mkdtemp()
+        self.kappa_kwargs = {'backend': 'numpy', 'seed': 1}
+        self.t1 = 2
+        self.tstop = 2
+        self.k1 = 1
+        args = (1000.0, 0.01, 1.0, 5)
+        try:
+            self.injectCalcium(ghk=0)
+            ## The calcium is pumped out, so the sims settle long
+            ## before the maximum time
+            neuron.h.finitialize(-65.0)
+            t_run = self.kappa.run_free(*args, equilibration_cache=cache_dir)
+            self.assertLess(t_run, args[0])
+            key = KappaNEURON._equilibration_key(*args)
+            self.assertEqual(os.listdir(cache_dir), [key])
+            observed = KappaNEURON._free_observables()
+
+            ## The same configuration restores the cached state
+            neuron.h.finitialize(-65.0)
+            self.assertEqual(self.kappa.run_free(*args, equilibration_cache=cache_dir), t_run)
+            self.assertTrue(np.array_equal(KappaNEURON._free_observables(), observed))
+
+            ## A different seed has its own entry
+            self.kappa._seed = 2
+            self.assertNotEqual(KappaNEURON._equilibration_key(*args), key)
+            self.kappa._seed = 1
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_runFreeThreads(self):
+        ## Give the kappa section two segments, and so two sims, with
+        ## enough calcium that their free runs are stochastic
+        self.sk.nseg = 2
+        self.ca.initial = 10.0
+        observed = []
+        try:
+            for threads in [1, 2]:
+                if observed:
+                    self.kappa.__del__()
+                self.kappa = KappaNEURON.Kappa(membrane_species=[self.ca], kappa_file=os.path.dirname(KappaNEURON.__file__) + "/tests/caPump1.ka", regions=self.r, seed=5)
+                self.kappa.setVariable('k1', 0.01)
+                neuron.h.finitialize(-65.0)
+                observed0 = KappaNEURON._free_observables()
+                self.kappa.run_free(50.0, threads=threads)
+                observed.append(KappaNEURON._free_observables())
+        finally:
+            self.sk.nseg = 1
+            self.ca.initial = 0.00005
+
+        ## The sims have been run, and running them concurrently gives
+        ## the same results as running them one after the other
+        self.assertEqual(len(observed[0]), 2)
+        self.assertTrue(np.all(observed[0] < observed0))
+        self.assertTrue(np.array_equal(observed[0], observed[1]))
+
     def test_injectCalciumPump(self):
         self.t1 = 2
         self.tstop = 2
@@ -618,7 +1315,8 @@ class TestCaAccumulation(unittest.TestCase):
             i += 1
 
     def tearDown(self):
-        self.kappa.__del__()
+        if hasattr(self, 'kappa'):
+            self.kappa.__del__()
         print(len(KappaNEURON._kappa_schemes))
         if not self.mechanism is None:
             h('uninsert ' + self.mechanism, sec=self.sm)
@@ -6,6 +6,7 @@ import re
 import matplotlib.pyplot as plt
 import matplotlib
 import numpy
+from KappaNEURON.TraceStore import write_traces, open_traces
 
 vinit = -70
 
@@ -58,19 +59,11 @@ def run_and_save(sh, rec_Pi, dataname='test_ca_pulse_mod'):
     init()
     run(30)
 
-    # get values from NEURON-vector format into Python format
-    times = [] # Use list to add another trace later.
-    voltages = []
-    cai = []
-    ica = []
-    Pi = []
-    times.append(list(rec_t)) # alternative to `list(rec_t)`: `numpy.array(rec_t)`
-    voltages.append(list(rec_v))
-    cai.append(list(rec_cai))
-    ica.append(list(rec_ica))
-    Pi.append(list(rec_Pi))
-
-    numpy.savez(dataname, t=times[0], cai=cai[0], Pi=Pi[0], ica=ica[0], voltages=voltages[0], diam=sh.diam)
+    ## Save the traces in a store that analysis code can memory-map
+    write_traces(dataname + '.traces',
+                 [('t', rec_t), ('voltages', rec_v), ('cai', rec_cai), ('ica', rec_ica), ('Pi', rec_Pi)],
+                 units={'t': 'ms', 'voltages': 'mV', 'cai': 'mM', 'ica': 'mA/cm2', 'Pi': 'mM'},
+                 time='t', attrs={'diam': sh.diam, 'segment': str(sh(0.5))})
 
 def plot_records(tcp_mod, tcp):
     font = {'family' : 'normal',
@@ -136,8 +129,8 @@ def compare_traces(diam=0.2, gbar=0.001,
                       P0=P0,
                       vclamp=vclamp)
     
-    tcp     = numpy.load("test_ca_pulse.npz")
-    tcp_mod = numpy.load("test_ca_pulse_mod.npz")
+    tcp     = open_traces("test_ca_pulse.traces")
+    tcp_mod = open_traces("test_ca_pulse_mod.traces")
 
     fig, ax = plot_records(tcp_mod, tcp)
 
@@ -158,8 +151,8 @@ def compare_traces(diam=0.2, gbar=0.001,
     # print('Mean Ca disparity in signal: %2.4f' % numpy.mean(tcp['Cai'][sigmask] - tcp_mod['Cai'][sigmask]))
 
 def animate_traces():
-    tcp     = numpy.load("test_ca_pulse.npz")
-    tcp_mod = numpy.load("test_ca_pulse_mod.npz")
+    tcp     = open_traces("test_ca_pulse.traces")
+    tcp_mod = open_traces("test_ca_pulse_mod.traces")
 
     fig, ax = plot_records(tcp_mod, tcp)
     Tmax = int(numpy.floor(max(tcp['t'])));
@@ -168,29 +161,30 @@ def animate_traces():
     cailim = [-1E-2, 0.2E-1]
     Pilim = [-1E-2, 1E-1]
     for T in numpy.nditer(numpy.arange(0, Tmax, 0.5)):
-        inds = numpy.array(tcp_mod['t']) <= T
+        ## Only the rows up to T are read from the store
+        win_mod = tcp_mod.window(None, T)
         ax[0].cla()
         ax[0].set_xlim([0, Tmax])
         ax[0].set_ylim(Vlim)
-        ax[0].plot(tcp_mod['t'][inds], tcp_mod['voltages'][inds])
+        ax[0].plot(win_mod['t'], win_mod['voltages'])
         ax[0].set_ylabel("V [mV]")
 
         ax[1].cla()
         ax[1].set_xlim([0, Tmax])
         ax[1].set_ylim(Ilim)
-        ax[1].plot(tcp_mod['t'][inds], tcp_mod['ica'][inds])
+        ax[1].plot(win_mod['t'], win_mod['ica'])
         ax[1].set_ylabel("ICa [mA/cm2]")
 
         ax[2].cla()
         ax[2].set_xlim([0, Tmax])
         ax[2].set_ylim(cailim)
-        ax[2].plot(tcp_mod['t'][inds], tcp_mod['cai'][inds])
+        ax[2].plot(win_mod['t'], win_mod['cai'])
         ax[2].set_ylabel("Ca [mM]")
 
         ax[3].cla()
         ax[3].set_xlim([0, Tmax])
         ax[3].set_ylim(Pilim)
-        ax[3].plot(tcp_mod['t'][inds], tcp_mod['Pi'][inds])
+        ax[3].plot(win_mod['t'], win_mod['Pi'])
         ax[3].set_ylabel("P [mM]")
 
         print(T)
@@ -199,33 +193,34 @@ def animate_traces():
         fig.savefig(filename)
 
     for T in numpy.nditer(numpy.arange(0, Tmax, 0.5)):
-        inds = numpy.array(tcp_mod['t']) <= T
+        ## Only the rows up to T are read from the store
+        win = tcp.window(None, T)
         ax[0].cla()
         ax[0].set_xlim([0, Tmax])
         ax[0].set_ylim(Vlim)
         ax[0].plot(tcp_mod['t'], tcp_mod['voltages'])
-        ax[0].plot(tcp['t'][inds], tcp['voltages'][inds], 'r')
+        ax[0].plot(win['t'], win['voltages'], 'r')
         ax[0].set_ylabel("V [mV]")
 
         ax[1].cla()
         ax[1].set_xlim([0, Tmax])
         ax[1].set_ylim(Ilim)
         ax[1].plot(tcp_mod['t'], tcp_mod['ica'])
-        ax[1].plot(tcp['t'][inds], tcp['ica'][inds], 'r')
+        ax[1].plot(win['t'], win['ica'], 'r')
         ax[1].set_ylabel("ICa [mA/cm2]")
 
         ax[2].cla()
         ax[2].set_xlim([0, Tmax])
         ax[2].set_ylim(cailim)
         ax[2].plot(tcp_mod['t'], tcp_mod['cai'])
-        ax[2].plot(tcp['t'][inds], tcp['cai'][inds], 'r')
+        ax[2].plot(win['t'], win['cai'], 'r')
         ax[2].set_ylabel("Ca [mM]")
 
         ax[3].cla()
         ax[3].set_xlim([0, Tmax])
         ax[3].set_ylim(Pilim)
         ax[3].plot(tcp_mod['t'], tcp_mod['Pi'])
-        ax[3].plot(tcp['t'][inds], tcp['Pi'][inds], 'r')
+        ax[3].plot(win['t'], win['Pi'], 'r')
         ax[3].set_ylabel("P [mM]")
 
         fig.savefig('animation/test_ca_pulse%04d.png' % ((T + Tmax)*10))
@@ -0,0 +1,52 @@
+"""Time how long importing KappaNEURON takes.
+
+Each import is timed in a fresh Python interpreter, so that nothing is
+already loaded. By default the copy of KappaNEURON in this checkout is
+timed. To compare with another version, check it out elsewhere, e.g.
+
+    git worktree add /tmp/KappaNEURON-old <commit>
+    python import_time.py /tmp/KappaNEURON-old
+
+and the import time of both versions is printed, along with the time
+taken by the work that KappaNEURON now defers to the first Kappa()
+object: importing SpatialKappa and py4j and starting Java.
+"""
+
+import os
+import sys
+import subprocess
+
+## Number of times each import is timed; the median is reported
+repeats = 5
+
+here = os.path.dirname(os.path.abspath(__file__))
+checkout = os.path.dirname(os.path.dirname(here))
+
+def time_code(code, path):
+    """Return the median time in seconds taken to run code in a fresh
+    interpreter with path at the start of the module search path."""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([path] + [p for p in [env.get('PYTHONPATH')] if p])
+    prog = 'import time\nt0 = time.time()\n%s\nprint(time.time() - t0)\n' % (code)
+    times = []
+    for i in range(repeats):
+        out = subprocess.check_output([sys.executable, '-c', prog], env=env, cwd=here)
+        times.append(float(out.decode().strip().split('\n')[-1]))
+    return sorted(times)[len(times)//2]
+
+def report(label, code, path):
+    print('%-50s %8.3f s' % (label, time_code(code, path)))
+
+if __name__ == '__main__':
+    ## Loading NEURON and rxd is needed by any version, so it is timed
+    ## separately
+    report('import neuron.rxd', 'import neuron.rxd', checkout)
+    report('import KappaNEURON (%s)' % (os.path.basename(checkout)),
+           'import KappaNEURON', checkout)
+    for old in sys.argv[1:]:
+        report('import KappaNEURON (%s)' % (os.path.basename(os.path.abspath(old))),
+               'import KappaNEURON', os.path.abspath(old))
+    report('deferred: import SpatialKappa, py4j',
+           'import SpatialKappa, py4j.protocol, py4j.java_collections', checkout)
+    report('deferred: import SpatialKappa and start Java',
+           'import SpatialKappa\nSpatialKappa.SpatialKappa()', checkout)
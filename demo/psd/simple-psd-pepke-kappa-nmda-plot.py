@@ -2,14 +2,17 @@ import matplotlib.pyplot as plt
 import matplotlib
 import numpy 
 from matplotlib.font_manager import FontProperties
+import KappaNEURON
 
-dat = numpy.load("simple-psd-pepke-kappa-nmda-comp.npz")
+dat = KappaNEURON.open_traces("simple-psd-pepke-kappa-nmda-comp.traces")
 def plot_data(dat, tmax=None, legend=True):
     font = {'family' : 'normal',
             'size'   : 7}
     matplotlib.rc('font', **font)
 
-    times = dat['times'][0]*1E-3
+    ## Only the rows up to tmax are read from the store
+    win = dat.window(None, tmax)
+    times = win['times']*1E-3
     if (tmax == None): 
         tmax = max(times)
     else:
@@ -20,7 +23,7 @@ def plot_data(dat, tmax=None, legend=True):
     fig, (ax1, ax2, ax3, ax4) = plt.subplots(nrows=4, ncols=1, figsize=(2.5, 2.65))
     plt.subplots_adjust(left=0.2, top=0.98, bottom=0.12, right=0.9)
 
-    ax1.plot(times, dat['voltages'][0])
+    ax1.plot(times, win['voltages'])
     ax1.set_xlabel("")
     ax1.set_ylabel("V (mV)")
     ax1.axis(ymin=-80, ymax=50)
@@ -28,7 +31,7 @@ def plot_data(dat, tmax=None, legend=True):
     ax1.xaxis.set_ticklabels([])
     ax1.yaxis.set_ticks([-80, 0])
 
-    ax2.plot(times, dat['ica'][0]*1E3)
+    ax2.plot(times, win['ica']*1E3)
     ax2.set_xlabel("")
     ax2.set_ylabel("ICa (uA/cm2)")
     ## ax2.axis(ymin=-1, ymax=0.1)
@@ -36,10 +39,10 @@ def plot_data(dat, tmax=None, legend=True):
     ax2.xaxis.set_ticklabels([])
     ax2.yaxis.set_ticks([0, -50])
 
-    ax3.plot(times, dat['rec_cai']*1E3)
-    ax3.plot(times, dat['rec_CaCBi']*1E3)
-    ax3.plot(times, dat['rec_CaCaMNi']*1E3)
-    ax3.plot(times, dat['rec_CaCaMCi']*1E3)
+    ax3.plot(times, win['rec_cai']*1E3)
+    ax3.plot(times, win['rec_CaCBi']*1E3)
+    ax3.plot(times, win['rec_CaCaMNi']*1E3)
+    ax3.plot(times, win['rec_CaCaMCi']*1E3)
     ax3.set_xlabel("")
     ax3.set_ylabel("(uM)")
     plt.axes(ax3)
@@ -51,9 +54,9 @@ def plot_data(dat, tmax=None, legend=True):
     ax3.xaxis.set_ticklabels([])
     ax3.yaxis.set_ticks([0, 50])
     
-    ax4.plot(times, dat['rec_KCaCaM2Ci']*1E3)
-    ax4.plot(times, dat['rec_CaMKIIpi']*1E3)
-    # ax4.plot(times, dat['rec_stargazinpi'])
+    ax4.plot(times, win['rec_KCaCaM2Ci']*1E3)
+    ax4.plot(times, win['rec_CaMKIIpi']*1E3)
+    # ax4.plot(times, win['rec_stargazinpi'])
     ax4.set_xlabel("Time (s)")
     ax4.set_ylabel("(uM)")
     plt.axes(ax4)
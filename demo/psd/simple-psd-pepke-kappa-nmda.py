@@ -109,7 +109,13 @@ stargazinp = rxd.Species(r, name='stargazinp', charge=0)
 ## the spine. Since Calcium crosses the membrane it is given in
 ## the membrane_species argument, whereas the pump molecule is
 ## defined in the species argument as it is purely internal. 
-kappa = KappaNEURON.Kappa(membrane_species=[ca, Glu], species=[NMDA, CB, cam, CaMKII, CaCB, CaCaMC, CaCaMN, KCaCaM2C, CaMKIIp, stargazinp], kappa_file='simple-psd-pepke-kappa-nmda.ka', regions=r)
+## The sims are exchanged with NEURON at every step for 20ms after
+## each synaptic event, and in between only every max_event_interval
+## ms (default 1ms), so the traces of the Kappa species are updated at
+## least that often
+kappa = KappaNEURON.Kappa(membrane_species=[ca, Glu], species=[NMDA, CB, cam, CaMKII, CaCB, CaCaMC, CaCaMN, KCaCaM2C, CaMKIIp, stargazinp], kappa_file='simple-psd-pepke-kappa-nmda.ka', regions=r, event_driven=True, event_window=20)
+## The synaptic events also mark the windows of dense recording below
+kappa.add_netcon(nmdanetcon)
 rxd.rxd.verbose=False
 
 ## Record Time from NEURON (neuron.h._ref_t)
@@ -146,6 +152,12 @@ rec_CaMKIIpi = h.Vector()
 rec_CaMKIIpi.record(sh(0.5)._ref_CaMKIIpi)
 rec_stargazinpi = h.Vector()
 rec_stargazinpi.record(sh(0.5)._ref_stargazinpi)
+## Also record every species of the Kappa scheme to a file, without
+## keeping the traces in memory: every step for 50ms after each
+## synaptic event, and otherwise every 40 steps (1ms), with the
+## envelope in between. Open it with KappaNEURON.open_traces()
+recorder = KappaNEURON.KappaRecorder(kappa, 'simple-psd-pepke-kappa-nmda-species.traces', interval=None,
+                                     decimate=40, envelope=True, window=50)
 
 
 ## Run
@@ -155,6 +167,7 @@ print("Running kappa-only to initialise")
 kappa.run_free(100)
 print("Running NEURON-kappa")
 run(6000)
+recorder.close()
 if (0):
     for i in range(1,60):
         print("Running kappa-only")
@@ -241,12 +254,16 @@ def plot_data(tmax=None):
 #             CaCaMN=numpy.array(CaCaMN), KCaCaM2C=numpy.array(KCaCaM2C),
 #             CaMKIIp=numpy.array(CaMKIIp), stargazinp=numpy.array(stargazinp))
 
-numpy.savez("simple-psd-pepke-kappa-nmda-comp", times=times, rec_cai=rec_cai, 
-            cami=cami, ica=ica, voltages=voltages, 
-            diam=sh.diam, rec_CaCBi=rec_CaCBi,
-            rec_CaMKIIi=rec_CaMKIIi, rec_CaCaMNi=rec_CaCaMNi,
-            rec_CaCaMCi=rec_CaCaMCi, rec_KCaCaM2Ci=rec_KCaCaM2Ci,
-            rec_CaMKIIpi=rec_CaMKIIpi,  rec_stargazinpi=rec_stargazinpi)
+## Save the traces in a store that the plotting script can memory-map
+traces = [('times', rec_t), ('voltages', rec_v), ('ica', rec_ica), ('cami', rec_cami),
+          ('rec_cai', rec_cai), ('rec_CaCBi', rec_CaCBi),
+          ('rec_CaMKIIi', rec_CaMKIIi), ('rec_CaCaMNi', rec_CaCaMNi),
+          ('rec_CaCaMCi', rec_CaCaMCi), ('rec_KCaCaM2Ci', rec_KCaCaM2Ci),
+          ('rec_CaMKIIpi', rec_CaMKIIpi), ('rec_stargazinpi', rec_stargazinpi)]
+units = dict((name, 'mM') for name, vec in traces)
+units.update({'times': 'ms', 'voltages': 'mV', 'ica': 'mA/cm2'})
+KappaNEURON.write_traces("simple-psd-pepke-kappa-nmda-comp.traces", traces, units=units,
+                         time='times', attrs={'diam': sh.diam, 'segment': str(sh(0.5))})
 
 plot_data()
 
@@ -115,8 +115,9 @@ rec_CaMKII_CaMi.record(sh(0.5)._ref_CaMKII_CaMi)
 ## Run
 init()
 print("Running kappa-only to initialise")
-## FIXME: put in some read-out to check when system has equilibriated.
-kappa.run_free(120*1000)
+## Run for up to 120s, stopping once the species have equilibrated
+t_equil = kappa.run_free(120*1000, tol=0.05, chunk=1000)
+print("Equilibrated after %f ms" % (t_equil))
 # for i in range(1,t_equil):
 #     run(h.t + 10)
 #     kappa.run_free(990)